@@ -1,24 +1,44 @@
 import os
 import sys
+import cer.client.daemon as daemon
+# pass the command on to rjmd if it is running, which saves importing everything and connecting again
+rc = daemon.run_script(__file__, sys.argv[1:])
+if rc is not None:
+  sys.exit(rc)
 import time
 import argparse
 import traceback
 import cer.client.ssh as ssh
 import cer.client.job as job
+import cer.client.job.polling as polling
+import cer.client.job.store as store
+import cer.client.job.template as template
 import cer.client.util as util
 import cer.client.util.config as config
+import cer.client.util.metrics as metrics
 from cer.client.util import Retry
 
 def cleanup():
+  if job_store:
+    try:
+      job_store.close()
+    except:
+      log.error('failed to write job store %s. %s' % (job_store.filename, traceback.format_exc().strip()))
   if ssh_conn:
     try:
       ssh.close_connection(ssh_conn)
     except:
       pass
+  if args.metricsfile:
+    try:
+      metrics.write(args.metricsfile, 'cancel')
+    except:
+      log.error('failed to write metrics file %s. %s' % (args.metricsfile, traceback.format_exc().strip()))
 
 # name of the file that contains the list of files to be downloaded after a job
 ssh_conn = None
 sftp_conn = None
+job_store = None
 
 # information displayed as help by argparse
 h = {
@@ -28,21 +48,46 @@ h = {
     'level of log verbosity. default: %s. ' % util.DEFAULT_LOG_LEVEL.lower() +
     'the higher the log level, more information will be printed.',
   'localjobdirfile':
-    'file that contains the names of the local job directories, one name per line.',
+    'file that contains the names of the local job directories, one name per line, ' +
+    'or a pattern of the local job directories: a glob pattern, e.g. \'runs/run_*\', or a pattern with ranges ' +
+    'of numbers, e.g. \'runs/run_{0..999}\', or the template of the local job directories of jobs generated from ' +
+    'a template, e.g. \'runs/run_{alpha}_{beta}\'. ' +
+    'may be specified multiple times to cancel several batches, which are then polled together.',
+  'arrayid':
+    'id of a job array. all tasks of the job array are cancelled. may be specified multiple times.',
+  'nameprefix':
+    'cancel all of your jobs whose name starts with this prefix. the name of a job is the name of its remote job ' +
+    'directory, i.e. the name of its local job directory followed by the date and time of submission. ' +
+    'may be specified multiple times.',
   'pollingintervalsec':
-    'number of seconds to wait between each check for status of the cancellation.',
+    'number of seconds to wait between each check for status of the cancellation. ' +
+    'the interval grows while polls fail.',
+  'maxpollingintervalsec':
+    'maximum number of seconds to wait between each check for status of the cancellation. ' +
+    'default: %s times pollingintervalsec.' % config.MAX_POLLING_BACKOFF_FACTOR,
+  'metricsfile':
+    'write the time spent in each phase (connect, cancel, poll), the remote calls and the retries to this file ' +
+    'when the cancellation has completed, as JSON, or as Prometheus text file if the name of the file ends with %s.' % metrics.PROMETHEUS_EXTENSION,
 }
 
 parser = argparse.ArgumentParser(description='cancel a batch of jobs and wait for the cancellation to complete.')
-parser.add_argument('-f','--localjobdirfile', help=h['localjobdirfile'], required=True, type=str)
+parser.add_argument('-f','--localjobdirfile', help=h['localjobdirfile'], required=False, type=str, action='append', default=[])
+parser.add_argument('-a','--arrayid', help=h['arrayid'], required=False, type=str, action='append', default=[])
+parser.add_argument('-p','--nameprefix', help=h['nameprefix'], required=False, type=str, action='append', default=[])
 parser.add_argument('-l','--logfile', help=h['logfile'], required=False, type=str)
 parser.add_argument('-ll','--loglevel', help=h['loglevel'], required=False, type=str, choices=['debug','info','warn','error','critical'])
+parser.add_argument('-M','--metricsfile', help=h['metricsfile'], required=False, type=str)
+parser.add_argument('-x','--maxpollingintervalsec', help=h['maxpollingintervalsec'], required=False, type=int)
 parser.add_argument('-z','--pollingintervalsec', help=h['pollingintervalsec'], required=True, type=int)
 args = parser.parse_args()
+if not (args.localjobdirfile or args.arrayid or args.nameprefix):
+  parser.error('at least one of --localjobdirfile, --arrayid and --nameprefix is required')
 
 if args.logfile or args.loglevel:
   util.setup_logging(args.logfile, args.loglevel)
 log = util.get_log()
+if args.metricsfile:
+  metrics.enable()
 
 # read central configuration file
 try:
@@ -54,87 +99,145 @@ except:
 
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
 def get_local_job_directories(localjobdirfile):
-  ''' get the list of local job directories from file. '''
-  return util.get_local_job_directories(localjobdirfile)
+  ''' generate the local job directories from file or pattern. the local job directories of jobs generated from a
+      template, see rjm_batch_submit.py --parameters, are read from the job store. '''
+  if template.is_template(localjobdirfile):
+    return job_store.get_batch_directories(store.get_batch_name(localjobdirfile))
+  return util.iter_local_job_directories(localjobdirfile)
 
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
-def read_job_config_file(job_config_file):
-  ''' read the local configuration file of a job (ini-format). '''
-  return config.read_job_config_file(job_config_file)
+def get_jobs(localdirs, batch):
+  ''' get the state of the jobs of a batch from the job store. '''
+  return job_store.get_jobs(localdirs, batch)
 
+@metrics.timed('cancel')
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
 def cancel_jobs(ssh_conn, jobids):
   ''' cancel jobs '''
   job.cancel_jobs(ssh_conn, jobids)
+
+@metrics.timed('cancel')
+@Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
+def cancel_batch(ssh_conn, jobids, arrayids, name_prefixes):
+  ''' cancel jobs and get the outcome for each job, or None if the cluster doesn't support this '''
+  return job.cancel_batch(ssh_conn, jobids, arrayids, name_prefixes)
   
-# read local job directories from file
+# open the job store
 try:
-  localdirs = get_local_job_directories(args.localjobdirfile)
+  job_store = store.JobStore()
 except:
-  log.critical('failed to read list of local job directories or invalid entries in list')
+  log.critical('failed to open job store. %s' % traceback.format_exc().strip())
   cleanup()
   sys.exit(1)
 
-# stop if no job directories are listed
-if len(localdirs) == 0:
-  log.info('no job directories. nothing to cancel. exiting.')
-  cleanup()
-  sys.exit(0)
-  
 jobids = []
+cancelled = []
 
-# read the configuration file for each job
-# the configuration files contains the job id and the remote job directory
-for localdir in localdirs:
-  job_config_file = '%s%s.job.ini' % (localdir, os.path.sep)
-  try:
-    job_config = read_job_config_file(job_config_file)
-    if 'id' in job_config['JOB']:
-      jobids.append(job_config['JOB']['id'])
-    else:
-      log.warn('no job id for local directory %s. probably job has not started yet. skipping job.' % localdir)
-  except:
-    log.warn('failed to read job config file %s. skipping job.' % job_config_file)
+# read the local job directories of each batch, and load the state of their jobs from the job store, window by window.
+# the state of each job contains the job id and the remote job directory
+try:
+  for localjobdirfile in args.localjobdirfile:
+    batch = store.get_batch_name(localjobdirfile)
+    for window in util.chunks(get_local_job_directories(localjobdirfile), config.JOB_WINDOW_SIZE):
+      job_configs = get_jobs(window, batch)
+      for localdir in window:
+        try:
+          job_config = job_configs[localdir]
+          if 'id' in job_config['JOB']:
+            jobids.append(job_config['JOB']['id'])
+            if not eval(job_config['JOB'].get('download_done', 'False')):
+              cancelled.append((localdir, job_config['JOB']['id']))
+          else:
+            log.warn('no job id for local directory %s. probably job has not started yet. skipping job.' % localdir)
+        except:
+          log.warn('no job state for local directory %s. skipping job.' % localdir)
+except:
+  log.critical('failed to read list of local job directories or job store. %s' % traceback.format_exc().strip())
+  cleanup()
+  sys.exit(1)
+
+# stop if there are no jobs
+if len(jobids) == 0 and not (args.arrayid or args.nameprefix):
+  log.info('no jobs. nothing to cancel. exiting.')
+  cleanup()
+  sys.exit(0)
 
 # cancel jobs
 # set up SSH connection
 try:
-  ssh_conn = ssh.open_connection_ssh_agent(conf['CLUSTER']['remote_host'], conf['CLUSTER']['remote_user'], conf['CLUSTER']['ssh_priv_key_file'])
+  ssh_conn = ssh.get_cluster_connection(conf)
 except:
   log.critical('failed to set up ssh connection')
   log.critical(traceback.format_exc())
   cleanup()
   sys.exit(1)
 
-cancel_jobs(ssh_conn, jobids)
-
+# the cluster reports the outcome for each job. only jobs that are still in the queue then are polled.
+# clusters that don't support this only cancel the jobs, and all jobs are polled
 try:
-  ssh.close_connection(ssh_conn)
+  outcomes = cancel_batch(ssh_conn, jobids, args.arrayid, args.nameprefix)
+  if outcomes is None:
+    if args.nameprefix:
+      raise Exception('the cluster does not support cancelling jobs by name')
+    cancel_jobs(ssh_conn, jobids + args.arrayid)
+    outcomes = dict([(jobid, job.CANCEL_REQUESTED) for jobid in jobids + args.arrayid])
 except:
-  pass 
+  log.critical('failed to cancel jobs')
+  log.critical(traceback.format_exc())
+  cleanup()
+  sys.exit(1)
 
-log.info('waiting for jobs to be cancelled (polling every %s seconds)...' % args.pollingintervalsec)
-while True:
+# jobs that had already finished keep their state, and so do jobs that could not be cancelled
+for localdir, jobid in cancelled:
+  if outcomes.get(jobid, job.CANCEL_REQUESTED) in [job.CANCEL_CANCELLED, job.CANCEL_REQUESTED]:
+    job_store.update(localdir, {}, state=store.STATE_CANCELLED, export=False)
+
+jobids = [jobid for jobid in jobids if jobid not in outcomes]
+for jobid, outcome in sorted(outcomes.items()):
+  if outcome == job.CANCEL_REQUESTED:
+    jobids.append(jobid)
+  elif outcome == job.CANCEL_CANCELLED:
+    log.info('job %s was cancelled.' % jobid)
+  elif outcome == job.CANCEL_FINISHED:
+    log.info('job %s had already finished.' % jobid)
+  else:
+    log.error('failed to cancel job %s. %s' % (jobid, outcome))
+
+scheduler = polling.PollScheduler(args.pollingintervalsec, args.maxpollingintervalsec)
+if jobids:
+  log.info('waiting for jobs to be cancelled (polling every %s seconds)...' % args.pollingintervalsec)
+unknown_polls = dict([(jobid, 0) for jobid in jobids])
+while jobids:
   try:
     log.info('waiting for cancellation of %s jobs...' % len(jobids))
     error_occured = False
     jobids_new = []
-    ssh_conn = ssh.open_connection_ssh_agent(conf['CLUSTER']['remote_host'], conf['CLUSTER']['remote_user'], conf['CLUSTER']['ssh_priv_key_file'])
+    ssh_conn = ssh.get_cluster_connection(conf)
     log.debug('getting job statuses')
-    jobmap = job.get_job_statuses(ssh_conn)
+    with metrics.span('poll'):
+      jobmap = job.get_job_details(ssh_conn, jobids)
     for jobid in jobids:
-      if jobid not in jobmap:
-        log.info('job %s was cancelled.' % jobid)
-      else:
+      state = jobmap[jobid]['state']
+      if state == job.STATE_UNKNOWN:
+        # the job has left the queue, but the accounting system doesn't know it (yet)
+        unknown_polls[jobid] += 1
+        if unknown_polls[jobid] < config.MAX_UNKNOWN_POLLS:
+          jobids_new.append(jobid)
+          continue
+      elif not job.has_left_queue(state):
+        unknown_polls[jobid] = 0
         jobids_new.append(jobid)
+        continue
+      log.info('job %s was cancelled.' % jobid)
   except:
     error_occured = True
     log.warn('failed to get status. only critical if happens repeatedly. %s' % traceback.format_exc().strip())
-  finally:
+    # don't reuse a connection that may be broken
     try:
       ssh.close_connection(ssh_conn)
     except:
       pass
+    ssh_conn = None
     
   if len(jobids_new) > 0:
     jobids = jobids_new
@@ -142,6 +245,11 @@ while True:
     if not error_occured:
       break
 
-  time.sleep(args.pollingintervalsec)
+  if error_occured:
+    interval = scheduler.error_interval()
+  else:
+    interval = scheduler.next_interval(dict([(jobid, jobmap[jobid]) for jobid in jobids]))
+  log.debug('next poll in %.1f seconds' % interval)
+  time.sleep(interval)
 
 cleanup()
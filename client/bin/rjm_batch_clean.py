@@ -1,22 +1,43 @@
 import os
 import sys
+import cer.client.daemon as daemon
+# pass the command on to rjmd if it is running, which saves importing everything and connecting again
+rc = daemon.run_script(__file__, sys.argv[1:])
+if rc is not None:
+  sys.exit(rc)
 import argparse
+import posixpath
 import traceback
 import cer.client.ssh as ssh
+import cer.client.job as job
+import cer.client.job.store as store
+import cer.client.job.template as template
 import cer.client.util as util
 import cer.client.util.config as config
+import cer.client.util.metrics as metrics
 from cer.client.util import Retry
 
 def cleanup():
+  if job_store:
+    try:
+      job_store.close()
+    except:
+      log.error('failed to write job store %s. %s' % (job_store.filename, traceback.format_exc().strip()))
   if ssh_conn:
     try:
       ssh.close_connection(ssh_conn)
     except:
       pass
+  if args.metricsfile:
+    try:
+      metrics.write(args.metricsfile, 'clean')
+    except:
+      log.error('failed to write metrics file %s. %s' % (args.metricsfile, traceback.format_exc().strip()))
 
 # name of the file that contains the list of files to be downloaded after a job
 ssh_conn = None
 sftp_conn = None
+job_store = None
 
 # information displayed as help by argparse
 h = {
@@ -26,18 +47,35 @@ h = {
     'level of log verbosity. default: %s. ' % util.DEFAULT_LOG_LEVEL.lower() +
     'the higher the log level, more information will be printed.',
   'localjobdirfile':
-    'file that contains the names of the local job directories, one name per line.',
+    'file that contains the names of the local job directories, one name per line, ' +
+    'or a pattern of the local job directories: a glob pattern, e.g. \'runs/run_*\', or a pattern with ranges ' +
+    'of numbers, e.g. \'runs/run_{0..999}\', or the template of the local job directories of jobs generated from ' +
+    'a template, e.g. \'runs/run_{alpha}_{beta}\'.',
+  'remotedir':
+    'remote directory the job directories have been created in. only job directories inside this directory are removed. ' +
+    'if no remote directory is specified, each job directory is removed only if it is inside the directory it has ' +
+    'been created in, as recorded when the job was submitted.',
+  'concurrency':
+    'number of remote job directories removed at the same time on the cluster. default: %s.' % config.DEFAULT_CLEAN_CONCURRENCY,
+  'metricsfile':
+    'write the time spent in each phase (connect, clean), the remote calls and the retries to this file when all ' +
+    'directories have been removed, as JSON, or as Prometheus text file if the name of the file ends with %s.' % metrics.PROMETHEUS_EXTENSION,
 }
 
 parser = argparse.ArgumentParser(description='delete the remote job directories of a batch of jobs.')
 parser.add_argument('-f','--localjobdirfile', help=h['localjobdirfile'], required=True, type=str)
+parser.add_argument('-d','--remotedir', help=h['remotedir'], required=False, type=str)
+parser.add_argument('-n','--concurrency', help=h['concurrency'], required=False, type=int, default=config.DEFAULT_CLEAN_CONCURRENCY)
 parser.add_argument('-l','--logfile', help=h['logfile'], required=False, type=str)
 parser.add_argument('-ll','--loglevel', help=h['loglevel'], required=False, type=str, choices=['debug','info','warn','error','critical'])
+parser.add_argument('-M','--metricsfile', help=h['metricsfile'], required=False, type=str)
 args = parser.parse_args()
 
 if args.logfile or args.loglevel:
   util.setup_logging(args.logfile, args.loglevel)
 log = util.get_log()
+if args.metricsfile:
+  metrics.enable()
 
 # read central configuration file
 try:
@@ -49,67 +87,131 @@ except:
 
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
 def get_local_job_directories(localjobdirfile):
-  ''' get the list of local job directories from file. '''
-  return util.get_local_job_directories(localjobdirfile)
+  ''' generate the local job directories from file or pattern. the local job directories of jobs generated from a
+      template, see rjm_batch_submit.py --parameters, are read from the job store. '''
+  if template.is_template(localjobdirfile):
+    return job_store.get_batch_directories(store.get_batch_name(localjobdirfile))
+  return util.iter_local_job_directories(localjobdirfile)
 
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
-def read_job_config_file(job_config_file):
-  ''' read the local configuration file of a job (ini-format). '''
-  return config.read_job_config_file(job_config_file)
+def get_jobs(localdirs, batch):
+  ''' get the state of the jobs of a batch from the job store. '''
+  return job_store.get_jobs(localdirs, batch)
 
+@metrics.timed('clean')
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
 def remove_directory(ssh_conn, remote_directory):
-  ''' remote remote directory '''
-  cmd = "rm -rf %s" % remote_directory
+  ''' remove remote directory '''
+  cmd = 'rm -rf "%s"' % remote_directory
   log.debug('executing remotely: %s' % cmd)
   rc, stdout, stderr = ssh.run(cmd, ssh_conn)
   if rc != 0:
     msg = 'Error: Failed to remove remote directory %s%s' % (remote_directory, os.linesep)
     msg += '%s%s%s' % (os.linesep, stderr, os.linesep)
     raise Exception(msg)
-  
-# read local job directories from file
+
+@metrics.timed('clean')
+@Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
+def remove_directories(ssh_conn, basedir, remote_directories):
+  ''' remove remote directories inside basedir with a single remote call. return a dictionary remote directory ->
+      error message, or None if the cluster doesn't support removing directories in bulk. '''
+  return job.remove_job_directories(ssh_conn, basedir, remote_directories, args.concurrency)
+
+def get_basedir(remote_directory):
+  ''' the directory a remote job directory must be inside to be removed: the remote directory specified, or else
+      the directory the job directory has been created in '''
+  return args.remotedir or posixpath.dirname(remote_directory.rstrip('/'))
+
+def check_remote_directory(basedir, remote_directory):
+  ''' raise an exception if a remote job directory is not inside basedir, like clean_jobs does '''
+  path = posixpath.normpath(remote_directory)
+  if not posixpath.isabs(path) or posixpath.basename(path) in ['', '.', '..'] or [c for c in '"$`\\' if c in path]:
+    raise Exception('invalid remote directory %s' % remote_directory)
+  if not path.startswith(posixpath.normpath(basedir).rstrip('/') + '/'):
+    raise Exception('remote directory %s is not inside the base directory %s' % (remote_directory, basedir))
+
+def get_remote_directories(localdirs, batch):
+  ''' generate (local job directory, remote job directory) for each job, with the state of the jobs loaded from the
+      job store window by window. '''
+  for window in util.chunks(localdirs, config.JOB_WINDOW_SIZE):
+    job_configs = get_jobs(window, batch)
+    for localdir in window:
+      try:
+        job_config = job_configs[localdir]
+        if 'remote_directory' in job_config['JOB']:
+          yield (localdir, job_config['JOB']['remote_directory'])
+        else:
+          log.warn('no remote directory for local directory %s. skipping job.' % localdir)
+      except KeyError:
+        log.warn('no job state for local directory %s. skipping job.' % localdir)
+
 try:
-  localdirs = get_local_job_directories(args.localjobdirfile)
+  job_store = store.JobStore()
 except:
-  log.critical('failed to read list of local job directories or invalid entries in list')
+  log.critical('failed to open job store. %s' % traceback.format_exc().strip())
   cleanup()
   sys.exit(1)
 
-# stop if no job directories are listed
-if len(localdirs) == 0:
-  log.info('no job directories. nothing to cancel. exiting.')
+# read local job directories from file or pattern. the directories are read as they are cleaned up
+try:
+  localdirs = get_local_job_directories(args.localjobdirfile)
+except:
+  log.critical('failed to read list of local job directories or invalid entries in list')
   cleanup()
-  sys.exit(0)
-  
-remote_directories = []
-
-# read the configuration file for each job
-# the configuration files contains the job id and the remote job directory
-for localdir in localdirs:
-  job_config_file = '%s%s.job.ini' % (localdir, os.path.sep)
-  try:
-    job_config = read_job_config_file(job_config_file)
-    if 'remote_directory' in job_config['JOB']:
-      remote_directories.append(job_config['JOB']['remote_directory'])
-    else:
-      log.warn('no remote directory for local directory %s. skipping job.' % localdir)
-  except:
-    log.warn('failed to read job config file %s. skipping job.' % job_config_file)
+  sys.exit(1)
 
 try:
-  log.info('cleaning up %s remote directories...' % len(remote_directories))
-  ssh_conn = ssh.open_connection_ssh_agent(conf['CLUSTER']['remote_host'], conf['CLUSTER']['remote_user'], conf['CLUSTER']['ssh_priv_key_file'])
-  for remote_directory in remote_directories:
-    jobids_new = {}
-    log.info('removing remote directory %s.' % remote_directory)
-    try:
-      remove_directory(ssh_conn, remote_directory)
-    except:
-      log.error('failed to delete remote directory %s. %s' % (remote_directory, traceback.format_exc().strip()))
+  log.info('cleaning up remote directories...')
+  ssh_conn = ssh.get_cluster_connection(conf)
+  # remove the directories in bulk, with one remote call per chunk. fall back to one remote call per directory
+  # if the cluster doesn't support that
+  bulk = True
+  cleaned = 0
+  failed = 0
+  for chunk in util.chunks(get_remote_directories(localdirs, store.get_batch_name(args.localjobdirfile)), config.CLEAN_BATCH_SIZE):
+    # the directories of a chunk are removed in one remote call per base directory
+    groups = {}
+    for localdir, remote_directory in chunk:
+      groups.setdefault(get_basedir(remote_directory), []).append((localdir, remote_directory))
+    for basedir, group in sorted(groups.items()):
+      errors = remove_directories(ssh_conn, basedir, [remote_directory for localdir, remote_directory in group]) if bulk else None
+      if errors is None:
+        if bulk:
+          log.debug('removing remote directories one by one.')
+          bulk = False
+        for localdir, remote_directory in group:
+          log.info('removing remote directory %s.' % remote_directory)
+          try:
+            check_remote_directory(basedir, remote_directory)
+          except:
+            log.error('failed to delete remote directory %s: %s' % (remote_directory, sys.exc_info()[1]))
+            failed += 1
+            continue
+          try:
+            with metrics.job(localdir):
+              remove_directory(ssh_conn, remote_directory)
+            job_store.update(localdir, {}, state=store.STATE_CLEANED, export=False)
+            cleaned += 1
+          except:
+            log.error('failed to delete remote directory %s. %s' % (remote_directory, traceback.format_exc().strip()))
+            failed += 1
+        continue
+      for localdir, remote_directory in group:
+        if remote_directory in errors:
+          log.error('failed to delete remote directory %s: %s' % (remote_directory, errors[remote_directory]))
+          failed += 1
+        else:
+          log.debug('removed remote directory %s.' % remote_directory)
+          job_store.update(localdir, {}, state=store.STATE_CLEANED, export=False)
+          cleaned += 1
+  log.info('cleaned up %s remote directories.' % cleaned)
 except:
   log.critical('failed to delete remote directories')
   log.critical(traceback.format_exc().strip())
-  sys.exit(1)
-finally:
   cleanup()
+  sys.exit(1)
+cleanup()
+
+if failed:
+  log.error('failed to delete %s remote directories.' % failed)
+  sys.exit(1)
@@ -1,38 +1,126 @@
 import os
 import sys
+import cer.client.daemon as daemon
+# pass the command on to rjmd if it is running, which saves importing everything and connecting again
+rc = daemon.run_script(__file__, sys.argv[1:])
+if rc is not None:
+  sys.exit(rc)
+import json
+import posixpath
 import argparse
+import threading
 import traceback
 import cer.client.ssh as ssh
 import cer.client.job as job
+import cer.client.job.journal as journal
+import cer.client.job.store as store
+import cer.client.job.template as template
+import cer.client.transfer.archive as archive
+import cer.client.transfer.cache as cache
+import cer.client.transfer.delta as delta
 import cer.client.util as util
 import cer.client.util.config as config
+import cer.client.util.metrics as metrics
 from cer.client.util import Retry
 
 def cleanup():
-  ''' close ssh connection. '''
+  ''' save upload history, close submission journal, job store and ssh connection. '''
+  if history:
+    try:
+      history.save()
+    except:
+      log.warn('failed to save upload history %s' % history.filename)
+  if job_journal:
+    try:
+      job_journal.close()
+    except:
+      log.error('failed to write submission journal %s. %s' % (job_journal.filename, traceback.format_exc().strip()))
+  if job_store:
+    try:
+      job_store.close()
+    except:
+      log.error('failed to write job store %s. %s' % (job_store.filename, traceback.format_exc().strip()))
   if ssh_conn:
     try:
       ssh.close_connection(ssh_conn)
     except:
       pass
+  if args.metricsfile:
+    try:
+      metrics.write(args.metricsfile, 'submit')
+    except:
+      log.error('failed to write metrics file %s. %s' % (args.metricsfile, traceback.format_exc().strip()))
 
 # help information displayed by argparse
 h = {
+  'array':
+    'submit the jobs as job arrays of up to %s jobs, with one scheduler submission per array. ' % config.PREPARE_BATCH_SIZE +
+    'requires a scheduler that supports job arrays, i.e. slurm or local. ' +
+    'the job id of each job is recorded as <arrayid>_<index>. implies --bulkprepare.',
+  'bulkprepare':
+    'create the remote job directories and job description files of up to %s jobs with a single remote call. ' % config.PREPARE_BATCH_SIZE +
+    'requires a version of the remote prepare_job script that supports --manifest.',
+  'downloadsfile':
+    'together with --parameters or --range: file that contains the names of the result files of each job, ' +
+    'one name per line, relative to the remote job directory. names may contain placeholders of parameters. ' +
+    'the local job directory of a job is created when its results are downloaded. ' +
+    'default: the downloads file specified in %s, in the current directory.' % config.get_config_file(),
+  'delta':
+    'upload only the blocks of an input file of at least %s bytes that differ from the copy ' % config.DELTA_MIN_SIZE +
+    'uploaded last time, if that copy still exists on the cluster. ' +
+    'where local files have been uploaded to is recorded in %s. ' % os.path.join(config.get_config_dir(), config.UPLOAD_HISTORY_FILE_NAME) +
+    'not used together with --tar.',
   'cmd': 
     'command to run. multiple commands can be specified, and they will be executed one after the other as part ' +
     'of the same job',
+  'concurrency':
+    'number of jobs to prepare, upload and submit at the same time. default: %s. ' % config.DEFAULT_SUBMIT_CONCURRENCY +
+    'each job in flight uses up to 2 channels of the SSH connection. ' +
+    'the SSH server may limit the number of channels per connection (OpenSSH: MaxSessions, default 10).',
   'jobtype':
     'type of the job. the number of processes and threads is specified separated by colons. ' +
     'For serial/multi-threaded jobs: serial[:<#threads>]. ' +
     'For mpi jobs: mpi:<#processes>[:<#threads>]. ' +
     'Examples: serial, serial:5, mpi:4, mpi:5:4',
   'localjobdirfile':
-    'file that contains the names of the local job directories, one name per line.',
+    'template of the local job directories, e.g. \'runs/run_{alpha}_{beta}\', if --parameters or --range is ' +
+    'specified. the template must give every job a different directory. otherwise, file that contains the names of the local job directories, one name per line, ' +
+    'or a pattern of the local job directories: a glob pattern, e.g. \'runs/run_*\', or a pattern with ranges ' +
+    'of numbers, e.g. \'runs/run_{0..999}\'. the directories are read as the jobs are processed.',
+  'parameters':
+    'generate the jobs from a template: CSV file with a header line of parameter names, and one job per line. ' +
+    'placeholders {<name>} in the commands and in the local job directory template are replaced by the values ' +
+    'of the parameters of each job. no local job directories are needed to submit the jobs, and the shared input ' +
+    'files, see --uploadsfile, are uploaded once through the remote cache, see --cache. ' +
+    'can be combined with --range and with --pack. not used together with --array.',
+  'pack':
+    'pack up to this number of jobs into a single job, a task farm, with one scheduler submission per task farm. ' +
+    'the task farm runs the jobs as tasks inside its allocation, as many at the same time as fit in its cores, ' +
+    'see --packcores, each in its own job directory, so that rjm_batch_wait and rjm_batch_clean see the results ' +
+    'job by job. the walltime of the task farm is the walltime of a job times the number of rounds it takes to ' +
+    'run all its jobs. the job id of each job is recorded as <packid>:<index>. cancelling a job cancels its task ' +
+    'farm with all its jobs. requires serial or multi-threaded jobs, and a scheduler that supports task farms, ' +
+    'i.e. slurm or local. implies --bulkprepare. not used together with --array.',
+  'packcores':
+    'together with --pack: number of cores of each task farm. default: %s, ' % config.DEFAULT_PACK_CORES +
+    'or as many as it takes to run all jobs of a task farm at the same time, if that is fewer.',
+  'range':
+    'generate the jobs from a template, see --parameters, for every combination of the values of parameters. ' +
+    'the values of a parameter are specified as <name>=<first>..<last>[..<step>], e.g. alpha=0..99, ' +
+    'or as <name>=<value>,<value>,..., e.g. beta=x,y,z. may be specified multiple times.',
+  'uploadsfile':
+    'together with --parameters or --range: file that contains the names of the input files shared by all jobs, ' +
+    'one name per line, relative to the current directory. ' +
+    'default: the uploads file specified in %s, in the current directory.' % config.get_config_file(),
   'logfile':
     'logfile. if not specified, all messages will be printed to the terminal.', 
   'loglevel':
     'level of log verbosity. default: %s. ' % util.DEFAULT_LOG_LEVEL.lower() +
     'the higher the log level, more information will be printed.',
+  'metricsfile':
+    'write the time spent in each phase (connect, prepare, stage_in, submit), per job and in total, the remote calls, ' +
+    'the bytes transferred and the retries to this file when the submission has finished, as JSON, ' +
+    'or as Prometheus text file if the name of the file ends with %s.' % metrics.PROMETHEUS_EXTENSION,
   'mem':
     'amount of memory required by this job. Has to be postfixed with one of the following units: M,G, ' +
     'indicating megabytes, gigabytes. ' +
@@ -40,9 +128,26 @@ h = {
   'projectcode':
     'project code this job will run under, e.g. uoa00042, ' +
     'if no project code is specified, the default project code, as specified in %s, is used.' % config.get_config_file(),
+  'resume':
+    'resume an interrupted submission of the batch. jobs that have been submitted are skipped, and jobs that have ' +
+    'been prepared, or whose input files have been uploaded, continue from there. the phases of the jobs of a batch ' +
+    'are recorded in a journal in %s.' % os.path.join(config.get_config_dir(), config.JOURNAL_DIR_NAME),
   'remotedir':
     'remote directory where the individual job directories for each job will be created. ' +
     'if no remote directory is specified, the default remote directory as specified in %s is used.' % config.get_config_file(),
+  'tar':
+    'upload the input files of a job as a single tar stream, extracted on the fly on the cluster. ' +
+    'together with --bulkprepare or --array, the input files of all jobs prepared with one remote call are ' +
+    'uploaded as a single tar stream. a file that is used by several jobs is uploaded only once, and ' +
+    'hard-linked into the other job directories. so jobs must not modify their input files in place.',
+  'compress':
+    'together with --tar: compress the tar stream with gzip.',
+  'cache':
+    'upload input files through a cache of files in the remote directory, keyed by the SHA-256 hash of their content. ' +
+    'only files that are not in the cache yet are uploaded, and they are hard-linked into the job directories, ' +
+    'read-only, so that a job that writes to an input file in place fails instead of changing the file for other ' +
+    'jobs. together with --bulkprepare or --array, the cache is queried ' +
+    'once for all jobs prepared with one remote call. takes precedence over --tar.',
   'walltime':
     'wall clock time this job will run for, specified in hours(h), minutes(m) and seconds(s) in format h[h*]:m[m]:s[s]. ' +
     'the job will be terminated if it has not finished after the specified duration. ' +
@@ -50,22 +155,55 @@ h = {
 }
 
 parser = argparse.ArgumentParser(description='')
+parser.add_argument('-a','--array', help=h['array'], required=False, action='store_true')
+parser.add_argument('-b','--bulkprepare', help=h['bulkprepare'], required=False, action='store_true')
+parser.add_argument('-P','--parameters', help=h['parameters'], required=False, type=str)
+parser.add_argument('-R','--range', help=h['range'], required=False, type=str, action='append', default=[])
+parser.add_argument('-i','--uploadsfile', help=h['uploadsfile'], required=False, type=str)
+parser.add_argument('-o','--downloadsfile', help=h['downloadsfile'], required=False, type=str)
 parser.add_argument('-c','--cmd', help=h['cmd'], required=True, type=str, action='append')
 parser.add_argument('-d','--remotedir', help=h['remotedir'], required=False, type=str)
 parser.add_argument('-f','--localjobdirfile', help=h['localjobdirfile'], required=True, type=str)
 parser.add_argument('-j','--jobtype', help=h['jobtype'], required=True, type=str)
+parser.add_argument('-k','--pack', help=h['pack'], required=False, type=int)
+parser.add_argument('-K','--packcores', help=h['packcores'], required=False, type=int, default=config.DEFAULT_PACK_CORES)
 parser.add_argument('-l','--logfile', help=h['logfile'], required=False, type=str)
 parser.add_argument('-ll','--loglevel', help=h['loglevel'], required=False, type=str, choices=['debug','info','warn','error','critical'])
 parser.add_argument('-m','--mem', help=h['mem'], required=True, type=str)
+parser.add_argument('-M','--metricsfile', help=h['metricsfile'], required=False, type=str)
+parser.add_argument('-n','--concurrency', help=h['concurrency'], required=False, type=int, default=config.DEFAULT_SUBMIT_CONCURRENCY)
 parser.add_argument('-p','--projectcode', help=h['projectcode'], required=False, type=str)
+parser.add_argument('-r','--delta', help=h['delta'], required=False, action='store_true')
+parser.add_argument('-s','--cache', help=h['cache'], required=False, action='store_true')
+parser.add_argument('-u','--resume', help=h['resume'], required=False, action='store_true')
+parser.add_argument('-t','--tar', help=h['tar'], required=False, action='store_true')
 parser.add_argument('-w','--walltime', help=h['walltime'], required=True, type=str)
+parser.add_argument('-z','--compress', help=h['compress'], required=False, action='store_true')
 args = parser.parse_args()
+# jobs are generated from a template, rather than read from local job directories
+templated = bool(args.parameters or args.range)
+if templated and args.array:
+  parser.error('--array can not be used together with --parameters or --range')
+if args.pack is not None and args.array:
+  parser.error('--pack can not be used together with --array')
+if args.pack is not None and (args.pack < 1 or args.packcores < 1):
+  parser.error('--pack and --packcores must be at least 1')
+if args.pack and not args.jobtype.startswith('serial'):
+  parser.error('--pack requires serial or multi-threaded jobs')
+if templated:
+  # the shared input files are uploaded once, through the remote cache
+  args.cache = True
 
 if args.logfile or args.loglevel:
   util.setup_logging(args.logfile, args.loglevel)
 log = util.get_log()
+if args.metricsfile:
+  metrics.enable()
 
 ssh_conn = None
+job_store = None
+job_journal = None
+history = None
 
 # read central configuration file
 try:
@@ -75,29 +213,102 @@ except:
   log.critical(traceback.format_exc())
   cleanup()
   sys.exit(1)
-  
-@Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
-def get_local_job_directories(localjobdirfile):
-  ''' get the list of local job directories from file. '''
-  return util.get_local_job_directories(localjobdirfile)
 
+try:
+  scheduler = job.get_scheduler()
+except:
+  log.critical('failed to select scheduler. %s' % sys.exc_info()[1])
+  cleanup()
+  sys.exit(1)
+if args.array and not scheduler.supports_arrays:
+  log.critical('the scheduler %s does not support job arrays. submit the jobs without --array.' % scheduler.name)
+  cleanup()
+  sys.exit(1)
+if args.pack and not scheduler.supports_packing:
+  log.critical('the scheduler %s does not support task farms. submit the jobs without --pack.' % scheduler.name)
+  cleanup()
+  sys.exit(1)
+  
+@metrics.timed('prepare')
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
-def prepare_job(ssh_conn, args):
-  ''' create remote job directory and job description file. '''
+def prepare_job(ssh_conn, jobname, args, cmds=None):
+  ''' create remote job directory and job description file. the commands of the job default to args.cmd '''
   log.debug('creating job directory...')
-  remote_jobdir, remote_job_desc_file = job.prepare_job(ssh_conn, args.remotedir, args.jobname, args.cmd,
+  remote_jobdir, remote_job_desc_file = job.prepare_job(ssh_conn, args.remotedir, jobname, cmds or args.cmd,
     args.mem, args.walltime, args.jobtype, args.projectcode)
   log.debug('Remote job directory: %s' % remote_jobdir)
   return (remote_jobdir, remote_job_desc_file)
 
+@metrics.timed('prepare')
+@Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
+def prepare_jobs(ssh_conn, jobnames, args, array=False, cmds=None, pack=False):
+  ''' create remote job directories and job description files for many jobs with a single remote call.
+      cmds are the commands of each job, which default to args.cmd. if pack is True, the jobs are prepared as
+      tasks of a task farm with args.packcores cores.
+  '''
+  log.debug('creating %s job directories...' % len(jobnames))
+  cmds = cmds or [args.cmd] * len(jobnames)
+  records = [{ 'jobname': jobname, 'cmds': job_cmds, 'mem': args.mem, 'walltime': args.walltime,
+               'jobtype': args.jobtype, 'projectcode': args.projectcode } for jobname, job_cmds in zip(jobnames, cmds)]
+  return job.prepare_jobs(ssh_conn, args.remotedir, records, array, args.packcores if pack else None)
+
+def stage_in_file_delta(localfile, basefile, remotefile, readonly=False):
+  ''' upload the blocks of an individual input file that differ from a copy on the cluster.
+      return False if the delta upload is not possible, e.g. because the copy doesn't exist anymore.
+  '''
+  try:
+    sent = delta.upload(ssh_conn, localfile, basefile, remotefile, cache.get_hash(localfile), readonly=readonly)
+  except:
+    log.debug('delta upload of local file %s failed. uploading the whole file. %s' % (localfile, sys.exc_info()[1]))
+    return False
+  log.debug('uploaded %s of %s bytes of local file %s to remote file %s' % (sent, os.path.getsize(localfile), localfile, remotefile))
+  return True
+
+def use_delta(localfile):
+  ''' return True if an input file should be uploaded by delta upload, if possible. '''
+  return args.delta and os.path.getsize(localfile) >= config.DELTA_MIN_SIZE
+
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
-def stage_in_file(localfile, remotefile):
+def stage_in_file(sftp, localfile, remotefile):
   ''' upload individual input file. '''
+  if use_delta(localfile):
+    previous = history.get(localfile)
+    if previous and stage_in_file_delta(localfile, previous['remotefile'], remotefile):
+      history.record(localfile, remotefile, cache.get_hash(localfile))
+      return
   log.debug('Uploading local file %s to remote file %s' % (localfile, remotefile))
-  sftp.put(localfile, remotefile)
+  ssh.put(sftp, localfile, remotefile)
+  if use_delta(localfile):
+    history.record(localfile, remotefile, cache.get_hash(localfile))
 
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
-def get_inputfile_names(uploads_file):
+def upload_archive(ssh_conn, jobs):
+  ''' upload the input files of several jobs as a single tar stream. '''
+  log.debug('uploading input files of %s jobs as archive...' % len(jobs))
+  archive.upload_archive(ssh_conn, jobs, args.compress)
+
+@Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
+def get_missing_cache_files(ssh_conn, hashes):
+  ''' get the hashes of the files that are not in the remote cache. '''
+  return cache.get_missing(ssh_conn, args.remotedir, hashes)
+
+@Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
+def upload_to_cache(sftp, localfile, digest, base_digest=None):
+  ''' upload an individual file to the remote cache.
+      if the hash of a cached earlier version of the file is specified, only the blocks that differ are uploaded.
+  '''
+  cachedir = cache.get_cache_dir(args.remotedir)
+  if base_digest and stage_in_file_delta(localfile, posixpath.join(cachedir, base_digest), posixpath.join(cachedir, digest), True):
+    return
+  cache.upload(sftp, localfile, args.remotedir, digest)
+
+@Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
+def link_cache_files(ssh_conn, links):
+  ''' link files of the remote cache into job directories. '''
+  return cache.link(ssh_conn, args.remotedir, links)
+
+@Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
+def get_inputfile_names(uploads_file, localdir):
   ''' get the names of the local files to be uploaded prior to starting the job. '''  
   filenames = []
   if os.path.isfile(uploads_file):
@@ -105,42 +316,232 @@ def get_inputfile_names(uploads_file):
     for name in filenamestmp:
       if not os.path.isabs(name):
         name = '%s%s%s' % (localdir, os.path.sep, name)
-        filenames.append(name)
+      filenames.append(name)
   return filenames
   
+@metrics.timed('submit')
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
-def submit_job(ssh_conn, remote_job_desc_file):
-  ''' submit a job. '''
+def submit_job(ssh_conn, remote_job_desc_file, array_indices=None, pack=False):
+  ''' submit a job, or a job array if array indices are specified, or the tasks of a task farm if pack is True. '''
   log.debug('submitting job...')
-  jobid = job.submit_job(ssh_conn, remote_job_desc_file)
+  jobid = job.submit_job(ssh_conn, remote_job_desc_file, array_indices, pack)
   log.debug('Job ID: %s' % jobid)
   return jobid
 
+@metrics.timed('submit')
+@Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
+def get_submissions(ssh_conn, remote_job_desc_files):
+  ''' get the ids of the jobs that have been submitted from job description files. '''
+  return job.get_submissions(ssh_conn, remote_job_desc_files)
+
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
-def create_or_update_job_config_file(localdir, props_dict):
-  ''' create metadata file for job in local job directory (ini-format) '''
-  config.create_or_update_job_config_file(localdir, props_dict)
+def update_job(localdir, props_dict, state):
+  ''' record the state of a job in the job store, which also exports it to the job config file in the local job directory,
+      if the local job directory exists. the local job directory of a job generated from a template doesn't exist yet.
+  '''
+  job_store.update(localdir, props_dict, batch=batch, state=state, export=os.path.isdir(localdir))
+
+def get_job_inputfiles(localdir):
+  ''' get the names of the local input files of a job: the shared input files for jobs generated from a template,
+      otherwise the files listed in the uploads file of the local job directory.
+  '''
+  if templated:
+    return shared_inputfiles
+  uploads_file = '%s%s%s' % (localdir, os.path.sep, conf['FILE_TRANSFER']['uploads_file'])
+  return get_inputfile_names(uploads_file, localdir)
 
-def stage_in(sftp, uploads_file, remotedir):
+@metrics.timed('stage_in')
+def stage_in(sftp, localdir, remotedir):
   ''' upload all input files, if any. '''
-  localfiles = get_inputfile_names(uploads_file)
+  localfiles = get_job_inputfiles(localdir)
   log.debug('files to upload: %s' % str(localfiles))
+  if args.cache:
+    if stage_in_cache([(localfiles, remotedir)]):
+      raise Exception('failed to link input files from the remote cache')
+    return
+  if args.tar:
+    if localfiles:
+      upload_archive(ssh_conn, [(localfiles, remotedir)])
+    return
   for localfile in localfiles:
     remotefile = '%s/%s' % (remotedir, os.path.basename(localfile))
-    stage_in_file(localfile, remotefile)
+    stage_in_file(sftp, localfile, remotefile)
+
+def stage_in_cache(jobs):
+  ''' upload the input files of several jobs through the remote cache. only files that are not cached yet are uploaded.
+      jobs is a list of (local files, remote job directory) tuples.
+      return the remote job directories of the jobs whose files could not be linked from the cache.
+  '''
+  hashes = {}
+  for localfiles, remotedir in jobs:
+    for localfile in localfiles:
+      hashes[localfile] = cache.get_hash(localfile)
+  # hashes of the cached earlier versions of files, for delta uploads
+  base_hashes = {}
+  for localfile, digest in hashes.items():
+    previous = history.get(localfile) if use_delta(localfile) else None
+    if previous and previous['hash'] and previous['hash'] != digest:
+      base_hashes[localfile] = previous['hash']
+  missing = set(get_missing_cache_files(ssh_conn, list(hashes.values()) + list(base_hashes.values())))
+  # each missing file is uploaded only once, no matter how many jobs use it
+  uploads = dict([(digest, localfile) for localfile, digest in hashes.items() if digest in missing])
+  log.info('uploading %s of %s distinct input files to the remote cache' % (len(uploads), len(set(hashes.values()))))
+  def upload(item):
+    digest, localfile = item
+    base_digest = base_hashes.get(localfile)
+    upload_to_cache(get_sftp(), localfile, digest, None if base_digest in missing else base_digest)
+  util.run_concurrently(upload, uploads.items(), args.concurrency)
+  for localfile, digest in hashes.items():
+    if use_delta(localfile):
+      history.record(localfile, posixpath.join(cache.get_cache_dir(args.remotedir), digest), digest)
 
-# read local job directories from file
+  links = []
+  for localfiles, remotedir in jobs:
+    for localfile in localfiles:
+      links.append((hashes[localfile], '%s/%s' % (remotedir, os.path.basename(localfile))))
+  errors = link_cache_files(ssh_conn, links)
+  for remotefile, error in errors.items():
+    log.error('failed to link %s from the remote cache: %s' % (remotefile, error))
+  return set([posixpath.dirname(remotefile) for remotefile in errors])
+
+@metrics.timed('stage_in')
+def stage_in_together(jobs):
+  ''' upload the input files of several jobs together, through the remote cache or as a single tar stream.
+      jobs is a list of (localdir, remote_jobdir) tuples. return the local job directories of the jobs whose files
+      have been uploaded. jobs whose input files can't be read are skipped. raise an exception if the upload fails.
+  '''
+  uploads = []
+  localdirs = []
+  for localdir, remote_jobdir in jobs:
+    try:
+      update_job(localdir, { 'JOB': { 'remote_directory': remote_jobdir, 'download_done': False, 'walltime': args.walltime } }, store.STATE_PREPARED)
+      localfiles = get_job_inputfiles(localdir)
+      for localfile in localfiles:
+        if not os.path.isfile(localfile):
+          raise Exception('input file does not exist: %s' % localfile)
+      uploads.append((localfiles, remote_jobdir))
+      localdirs.append(localdir)
+    except:
+      log.error('problem staging in files for job in local directory %s. skipping job. %s' % (localdir, sys.exc_info()[1]))
+  if uploads and args.cache:
+    failed = stage_in_cache(uploads)
+    for localdir, (localfiles, remote_jobdir) in zip(list(localdirs), uploads):
+      if remote_jobdir in failed:
+        log.error('problem staging in files for job in local directory %s. skipping job.' % localdir)
+        localdirs.remove(localdir)
+  elif uploads:
+    log.info('uploading input files of %s jobs' % len(uploads))
+    upload_archive(ssh_conn, uploads)
+  for localdir in localdirs:
+    job_journal.record(localdir, journal.PHASE_UPLOADED)
+  return localdirs
+
+def get_sftp():
+  ''' get the SFTP session of the current thread. sessions are opened on the shared SSH connection. '''
+  if not hasattr(thread_data, 'sftp'):
+    thread_data.sftp = ssh_conn.open_sftp()
+  return thread_data.sftp
+
+def prepare_in_bulk(localdirs):
+  ''' prepare the jobs of the local job directories in chunks, with one remote call per chunk.
+      generate (localdir, (remote_jobdir, remote_job_desc_file)) for each job that has been prepared.
+      if the remote call for a chunk fails, generate (localdir, None) for its jobs, so they get prepared one by one.
+  '''
+  for chunk in util.chunks(localdirs, config.PREPARE_BATCH_SIZE):
+    try:
+      results = prepare_jobs(ssh_conn, [os.path.basename(localdir) for localdir in chunk], args)
+    except:
+      log.error('failed to prepare %s jobs in bulk. preparing them one by one.' % len(chunk))
+      results = [None] * len(chunk)
+    for localdir, result in zip(chunk, results):
+      if result and 'error' in result:
+        log.error('failed to prepare job for local directory %s: %s. skipping job.' % (localdir, result['error']))
+      elif result:
+        log.debug('Remote job directory: %s' % result['jobdir'])
+        job_journal.record(localdir, journal.PHASE_PREPARED, remote_directory=result['jobdir'], jobscript=result['jobscript'])
+    # the remote job directories of the chunk exist now. record them before anything else happens
+    job_journal.flush()
+    for localdir, result in zip(chunk, results):
+      if result is None:
+        yield (localdir, None)
+      elif 'error' not in result:
+        yield (localdir, (result['jobdir'], result['jobscript']))
+
+def stage_in_bulk(prepared):
+  ''' upload the input files of chunks of prepared jobs together, see stage_in_together.
+      prepared generates (localdir, prepared) tuples, see prepare_in_bulk.
+      generate (localdir, prepared, staged) for each job. staged is True if the files of the job have been uploaded.
+  '''
+  for chunk in util.chunks(prepared, config.PREPARE_BATCH_SIZE):
+    jobs = [(localdir, p[0]) for localdir, p in chunk if p]
+    try:
+      staged = stage_in_together(jobs)
+    except:
+      log.error('failed to upload input files of %s jobs together. uploading them job by job.' % len(jobs))
+      staged = None
+    for localdir, p in chunk:
+      if staged is None or not p:
+        yield (localdir, p, False)
+      elif localdir in staged:
+        yield (localdir, p, True)
+
+def submit(item):
+  ''' create remote job directory, stage files in and submit the job of a local job directory.
+      item is a tuple (localdir, prepared[, staged]). prepared is None, or the remote job directory and job description
+      file if the job has already been prepared. staged is True if the input files have already been uploaded.
+  '''
+  localdir, prepared = item[:2]
+  staged = len(item) > 2 and item[2]
+  try:
+    log.info('submitting job from %s' % localdir)
+    with metrics.job(localdir):
+      if prepared:
+        remote_jobdir, remote_job_desc_file = prepared
+      else:
+        remote_jobdir, remote_job_desc_file = prepare_job(ssh_conn, os.path.basename(localdir), args)
+        job_journal.record(localdir, journal.PHASE_PREPARED, remote_directory=remote_jobdir, jobscript=remote_job_desc_file)
+      if not staged:
+        update_job(localdir, { 'JOB': { 'remote_directory': remote_jobdir, 'download_done': False, 'walltime': args.walltime } }, store.STATE_PREPARED)
+        stage_in(None if args.tar else get_sftp(), localdir, remote_jobdir)
+        job_journal.record(localdir, journal.PHASE_UPLOADED)
+      jobid = submit_job(ssh_conn, remote_job_desc_file)
+    job_journal.record(localdir, journal.PHASE_SUBMITTED, id=jobid)
+    update_job(localdir, { 'JOB': { 'id': jobid } }, store.STATE_SUBMITTED)
+  except:
+    log.error('problem submitting job in local directory %s. skipping job.' % localdir)
+
+# read local job directories from file, or generate the jobs from the template.
+# jobs generated from a template are (local job directory, parameters) tuples
+try:
+  if templated:
+    localdirs = template.iter_jobs(args.localjobdirfile, template.iter_parameters(args.parameters, args.range))
+    shared_inputfiles = get_inputfile_names(args.uploadsfile or conf['FILE_TRANSFER']['uploads_file'], os.getcwd())
+    for localfile in shared_inputfiles:
+      if not os.path.isfile(localfile):
+        raise Exception('input file does not exist: %s' % localfile)
+    downloads_file = args.downloadsfile or conf['FILE_TRANSFER']['downloads_file']
+    downloads = util.read_lines_from_file(downloads_file) if os.path.isfile(downloads_file) else []
+  else:
+    localdirs = util.iter_local_job_directories(args.localjobdirfile)
+except:
+  log.critical('failed to read list of local job directories or job template')
+  log.critical(traceback.format_exc())
+  cleanup()
+  sys.exit(1)
+
+# open the job store. jobs are recorded as part of the batch of the local job directory file
 try:
-  localdirs = get_local_job_directories(args.localjobdirfile)
+  job_store = store.JobStore()
+  batch = store.get_batch_name(args.localjobdirfile)
 except:
-  log.critical('failed to read list of local job directories')
+  log.critical('failed to open job store')
   log.critical(traceback.format_exc())
   cleanup()
   sys.exit(1)
     
 # set up SSH connection
 try:
-  ssh_conn = ssh.open_connection_ssh_agent(conf['CLUSTER']['remote_host'], conf['CLUSTER']['remote_user'], conf['CLUSTER']['ssh_priv_key_file'])
+  ssh_conn = ssh.get_cluster_connection(conf)
 except:
   log.critical('failed to set up ssh connection')
   log.critical(traceback.format_exc())
@@ -150,20 +551,232 @@ except:
 args.projectcode = conf['CLUSTER']['default_project_code'] if not args.projectcode else args.projectcode
 args.remotedir = conf['CLUSTER']['default_remote_directory'] if not args.remotedir else args.remotedir
 
-sftp = ssh_conn.open_sftp()
+def submit_from_template(jobs):
+  ''' prepare jobs generated from the template with a single remote call, link the shared input files into their
+      job directories and submit them. jobs is a list of (local job directory, parameters) tuples.
+  '''
+  cmds = [[template.expand(cmd, params) for cmd in args.cmd] for localdir, params in jobs]
+  try:
+    results = prepare_jobs(ssh_conn, [os.path.basename(localdir) for localdir, params in jobs], args, False, cmds, bool(args.pack))
+  except:
+    log.error('failed to prepare %s jobs in bulk. preparing them one by one.' % len(jobs))
+    results = [None] * len(jobs)
+  prepared = []
+  for (localdir, params), job_cmds, result in zip(jobs, cmds, results):
+    try:
+      if result is None:
+        result = dict(zip(['jobdir', 'jobscript'], prepare_job(ssh_conn, os.path.basename(localdir), args, job_cmds)))
+      elif 'error' in result:
+        raise Exception(result['error'])
+      log.debug('Remote job directory: %s' % result['jobdir'])
+      job_journal.record(localdir, journal.PHASE_PREPARED, remote_directory=result['jobdir'], jobscript=result['jobscript'],
+        **get_task_props(result))
+      update_job(localdir, { 'JOB': { 'remote_directory': result['jobdir'], 'download_done': False, 'walltime': args.walltime,
+        'downloads': json.dumps([template.expand(name, params) for name in downloads]) } }, store.STATE_PREPARED)
+      prepared.append((localdir, result))
+    except:
+      log.error('failed to prepare job for local directory %s: %s. skipping job.' % (localdir, sys.exc_info()[1]))
+  # the remote job directories exist now. record them before anything else happens
+  job_journal.flush()
+  try:
+    with metrics.span('stage_in'):
+      failed = stage_in_cache([(shared_inputfiles, result['jobdir']) for localdir, result in prepared]) if shared_inputfiles else set()
+  except:
+    log.error('failed to upload the shared input files of %s jobs. skipping jobs. %s' % (len(prepared), traceback.format_exc().strip()))
+    return
+  staged = []
+  packed = []
+  for localdir, result in prepared:
+    if result['jobdir'] in failed:
+      log.error('problem staging in files for job in local directory %s. skipping job.' % localdir)
+    else:
+      job_journal.record(localdir, journal.PHASE_UPLOADED)
+      if 'packscript' in result:
+        packed.append((localdir, result))
+      else:
+        staged.append((localdir, (result['jobdir'], result['jobscript']), True))
+  if packed:
+    submit_array_tasks([], packed)
+  util.run_concurrently(submit, staged, args.concurrency)
+
+def get_task_props(result):
+  ''' get the job array description or task farm description of a prepared job, and its index, if there is one '''
+  return dict([(key, result[key]) for key in ['arrayscript', 'packscript', 'index'] if key in result])
+
+def get_task_id(groupid, result):
+  ''' get the job id of a job of a job array or task farm, from the id of the job array or task farm '''
+  if 'packscript' in result:
+    return job.get_pack_task_id(groupid, result['index'])
+  return '%s_%s' % (groupid, result['index'])
 
-# create remote job directories, stage files in, submit jobs
-for localdir in localdirs:
+def submit_job_array(localdirs):
+  ''' prepare the jobs of the local job directories as one job array, or as one task farm if --pack is specified,
+      stage files in and submit the job array or task farm. '''
   try:
-    log.info('submitting job from %s' % localdir)
-    args.jobname = os.path.basename(localdir)
-    remote_jobdir, remote_job_desc_file = prepare_job(ssh_conn, args)
-    create_or_update_job_config_file(localdir, { 'JOB': { 'remote_directory': remote_jobdir, 'download_done': False } })
-    uploads_file = '%s%s%s' % (localdir, os.path.sep, conf['FILE_TRANSFER']['uploads_file'])
-    stage_in(sftp, uploads_file, remote_jobdir)
-    jobid = submit_job(ssh_conn, remote_job_desc_file)
-    create_or_update_job_config_file(localdir, { 'JOB': { 'id': jobid } })
+    results = prepare_jobs(ssh_conn, [os.path.basename(localdir) for localdir in localdirs], args, not args.pack, None, bool(args.pack))
   except:
-    log.error('problem submitting job in local directory %s. skipping job.' % localdir)
+    log.error('failed to prepare %s for %s jobs. submitting them one by one.' % ('task farm' if args.pack else 'job array', len(localdirs)))
+    util.run_concurrently(submit, ((localdir, None) for localdir in localdirs), args.concurrency)
+    return
+
+  prepared = []
+  for localdir, result in zip(localdirs, results):
+    if 'error' in result:
+      log.error('failed to prepare job for local directory %s: %s. skipping job.' % (localdir, result['error']))
+    else:
+      prepared.append((localdir, result))
+      job_journal.record(localdir, journal.PHASE_PREPARED, remote_directory=result['jobdir'], jobscript=result['jobscript'],
+        **get_task_props(result))
+  # the remote job directories exist now. record them before anything else happens
+  job_journal.flush()
+  if prepared:
+    submit_array_tasks(prepared)
+
+def submit_array_tasks(prepared, uploaded=None):
+  ''' stage files in for prepared tasks of a job array or task farm and submit them.
+      prepared and uploaded are lists of (localdir, result) tuples, result as returned by prepare_jobs.
+      the input files of the tasks in uploaded have already been uploaded.
+  '''
+  uploaded = uploaded or []
+  staged = list(uploaded)
+  staged_lock = threading.Lock()
+
+  def stage_in_array_task(item):
+    ''' stage files in for a single job of the job array or task farm. '''
+    localdir, result = item
+    try:
+      log.info('staging in files for job from %s' % localdir)
+      update_job(localdir, { 'JOB': { 'remote_directory': result['jobdir'], 'download_done': False, 'walltime': args.walltime } }, store.STATE_PREPARED)
+      with metrics.job(localdir):
+        stage_in(get_sftp(), localdir, result['jobdir'])
+      job_journal.record(localdir, journal.PHASE_UPLOADED)
+      with staged_lock:
+        staged.append((localdir, result))
+    except:
+      log.error('problem staging in files for job in local directory %s. skipping job.' % localdir)
+
+  if prepared and (args.tar or args.cache):
+    try:
+      localdirs_staged = stage_in_together([(localdir, result['jobdir']) for localdir, result in prepared])
+      staged.extend([(localdir, result) for localdir, result in prepared if localdir in localdirs_staged])
+    except:
+      log.error('failed to upload input files of %s jobs together. uploading them job by job.' % len(prepared))
+      util.run_concurrently(stage_in_array_task, prepared, args.concurrency)
+  elif prepared:
+    util.run_concurrently(stage_in_array_task, prepared, args.concurrency)
+
+  # only the jobs whose files have been staged in successfully become array tasks
+  if staged:
+    first = (prepared or uploaded)[0][1]
+    pack = 'packscript' in first
+    kind = 'task farm' if pack else 'job array'
+    try:
+      arrayid = submit_job(ssh_conn, first.get('packscript', first.get('arrayscript')), [result['index'] for localdir, result in staged], pack)
+    except:
+      log.error('problem submitting %s for %s jobs. skipping jobs.' % (kind, len(staged)))
+      return
+    log.info('submitted %s %s with %s jobs' % (kind, arrayid, len(staged)))
+    for localdir, result in staged:
+      jobid = get_task_id(arrayid, result)
+      job_journal.record(localdir, journal.PHASE_SUBMITTED, id=jobid)
+      try:
+        update_job(localdir, { 'JOB': { 'id': jobid } }, store.STATE_SUBMITTED)
+      except:
+        log.error('failed to record job id %s in local directory %s.' % (jobid, localdir))
+
+def resume(localdirs, get_localdir=lambda localdir: localdir):
+  ''' continue the submission of the jobs whose submission has been interrupted, as recorded in the journal.
+      generate the local job directories of the jobs whose submission has not started yet.
+      the local job directories are resumed in windows of JOB_WINDOW_SIZE directories.
+      for jobs generated from a template, get_localdir gets the local job directory of a job.
+  '''
+  for window in util.chunks(localdirs, config.JOB_WINDOW_SIZE):
+    resume_window([get_localdir(item) for item in window])
+    for item in window:
+      if not job_journal.get(get_localdir(item)):
+        yield item
+
+def resume_window(localdirs):
+  ''' continue the submission of the jobs of a window of local job directories, see resume. '''
+  started = [(localdir, job_journal.get(localdir)) for localdir in localdirs if job_journal.get(localdir)]
+  # jobs may have been submitted after the last records of the journal have been written
+  jobfiles = set([j.get('packscript', j.get('arrayscript', j['jobscript'])) for localdir, j in started if j['phase'] != journal.PHASE_SUBMITTED])
+  submissions = get_submissions(ssh_conn, list(jobfiles)) if jobfiles else {}
+  jobs = []
+  arrays = {}
+  for localdir, j in started:
+    if j['phase'] != journal.PHASE_SUBMITTED:
+      if 'index' in j:
+        groupscript = j.get('packscript', j.get('arrayscript'))
+        # the ids of the tasks with the index of the job, e.g. 1234_5 or 1234:5
+        jobids = [jobid for jobid in submissions.get(groupscript, []) if jobid.endswith(get_task_id('', j))]
+      else:
+        jobids = submissions.get(j['jobscript'], [])
+      if jobids:
+        job_journal.record(localdir, journal.PHASE_SUBMITTED, id=jobids[-1])
+        j = job_journal.get(localdir)
+    if j['phase'] == journal.PHASE_SUBMITTED:
+      log.info('job from %s has already been submitted as job %s. skipping job.' % (localdir, j['id']))
+      job_config = job_store.get(localdir)
+      if not job_config or job_config.get('JOB', {}).get('id') != j['id']:
+        update_job(localdir, { 'JOB': { 'remote_directory': j['remote_directory'], 'download_done': False, 'walltime': args.walltime,
+          'id': j['id'] } }, store.STATE_SUBMITTED)
+      continue
+    update_job(localdir, { 'JOB': { 'remote_directory': j['remote_directory'], 'download_done': False, 'walltime': args.walltime } }, store.STATE_PREPARED)
+    if 'index' in j:
+      result = dict(get_task_props(j), jobdir=j['remote_directory'], jobscript=j['jobscript'])
+      arrays.setdefault(j.get('packscript', j.get('arrayscript')), ([], []))[j['phase'] == journal.PHASE_UPLOADED].append((localdir, result))
+    else:
+      log.info('resuming submission of job from %s after phase %s' % (localdir, j['phase']))
+      jobs.append((localdir, (j['remote_directory'], j['jobscript']), j['phase'] == journal.PHASE_UPLOADED))
+  util.run_concurrently(submit, jobs, args.concurrency)
+  for arrayscript, (prepared, uploaded) in arrays.items():
+    log.info('resuming submission of %s tasks of %s' % (len(prepared) + len(uploaded), arrayscript))
+    submit_array_tasks(prepared, uploaded)
+
+# SFTP sessions of the submission threads
+thread_data = threading.local()
+
+# where input files have been uploaded to, for delta uploads
+history = delta.UploadHistory() if args.delta else None
+
+# open the submission journal of the batch. when resuming, the journal is continued
+try:
+  job_journal = journal.SubmissionJournal(journal.get_journal_file(batch), args.resume)
+except:
+  log.critical('failed to open submission journal')
+  log.critical(traceback.format_exc())
+  cleanup()
+  sys.exit(1)
+
+if args.resume and templated:
+  localdirs = resume(localdirs, lambda item: item[0])
+elif args.resume:
+  localdirs = resume(localdirs)
+
+# create remote job directories, stage files in, submit jobs.
+# up to args.concurrency jobs are processed at the same time over the shared SSH connection.
+# the local job directories are read as the jobs are submitted, so a failure to read them stops the submission,
+# and the jobs submitted until then are recorded before exiting
+try:
+  if templated:
+    for chunk in util.chunks(localdirs, args.pack or config.PREPARE_BATCH_SIZE):
+      submit_from_template(chunk)
+  elif args.array or args.pack:
+    for chunk in util.chunks(localdirs, args.pack or config.PREPARE_BATCH_SIZE):
+      submit_job_array(chunk)
+  else:
+    if args.bulkprepare and (args.tar or args.cache):
+      jobs = stage_in_bulk(prepare_in_bulk(localdirs))
+    elif args.bulkprepare:
+      jobs = prepare_in_bulk(localdirs)
+    else:
+      jobs = ((localdir, None) for localdir in localdirs)
+    util.run_concurrently(submit, jobs, args.concurrency)
+except:
+  log.critical('failed to submit jobs. stopping submission.')
+  log.critical(traceback.format_exc())
+  cleanup()
+  sys.exit(1)
 
 cleanup()
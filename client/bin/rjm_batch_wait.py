@@ -1,23 +1,51 @@
 import os
 import sys
+import cer.client.daemon as daemon
+# pass the command on to rjmd if it is running, which saves importing everything and connecting again
+rc = daemon.run_script(__file__, sys.argv[1:])
+if rc is not None:
+  sys.exit(rc)
+import json
 import time
 import argparse
+import posixpath
 import traceback
 import cer.client.ssh as ssh
 import cer.client.job as job
+import cer.client.job.polling as polling
+import cer.client.job.store as store
+import cer.client.job.template as template
+import cer.client.transfer as transfer
 import cer.client.util as util
 import cer.client.util.config as config
+import cer.client.util.metrics as metrics
 from cer.client.util import Retry
 
 def cleanup():
+  if watcher:
+    watcher.stop()
+  if downloads:
+    downloads.close()
+  if job_store:
+    try:
+      job_store.close()
+    except:
+      log.error('failed to write job store %s. %s' % (job_store.filename, traceback.format_exc().strip()))
   if ssh_conn:
     try:
       ssh.close_connection(ssh_conn)
     except:
       pass
+  if args.metricsfile:
+    try:
+      metrics.write(args.metricsfile, 'wait')
+    except:
+      log.error('failed to write metrics file %s. %s' % (args.metricsfile, traceback.format_exc().strip()))
 
 ssh_conn = None
-sftp_conn = None
+watcher = None
+downloads = None
+job_store = None
 
 # information displayed as help by argparse
 h = {
@@ -27,21 +55,52 @@ h = {
     'level of log verbosity. default: %s. ' % util.DEFAULT_LOG_LEVEL.lower() +
     'the higher the log level, more information will be printed.',
   'localjobdirfile':
-    'file that contains the names of the local job directories, one name per line.',
+    'file that contains the names of the local job directories, one name per line, ' +
+    'or a pattern of the local job directories: a glob pattern, e.g. \'runs/run_*\', or a pattern with ranges ' +
+    'of numbers, e.g. \'runs/run_{0..999}\', or the template of the local job directories of jobs generated from ' +
+    'a template, e.g. \'runs/run_{alpha}_{beta}\'. ' +
+    'may be specified multiple times to wait for several batches, which are then polled together.',
   'pollingintervalsec':
-    'number of seconds to wait between attempts to poll for job status.',
+    'number of seconds to wait between attempts to poll for job status. ' +
+    'the interval grows while all jobs are pending or polls fail, and shrinks when a job reaches its walltime.',
+  'maxpollingintervalsec':
+    'maximum number of seconds to wait between attempts to poll for job status. ' +
+    'default: %s times pollingintervalsec.' % config.MAX_POLLING_BACKOFF_FACTOR,
+  'concurrency':
+    'number of files downloaded at the same time, while polling for job status goes on. ' +
+    'default: %s.' % config.DEFAULT_DOWNLOAD_CONCURRENCY,
+  'archive':
+    'download the result files of all jobs that have finished at the same time as a single tar archive, ' +
+    'created on the fly on the cluster. saves a round trip per file if jobs have many small result files.',
+  'compress':
+    'together with --archive: compress the archive with gzip.',
+  'events':
+    'get notified by the cluster as soon as a job finishes, instead of waiting for the next poll. ' +
+    'the job status is still polled every pollingintervalsec seconds, so a long polling interval can be used.',
+  'metricsfile':
+    'write the time spent in each phase (connect, poll, stage_out), per job and in total, the remote calls, ' +
+    'the bytes transferred and the retries to this file when all jobs have finished, as JSON, ' +
+    'or as Prometheus text file if the name of the file ends with %s.' % metrics.PROMETHEUS_EXTENSION,
 }
 
 parser = argparse.ArgumentParser(description='wait for all jobs of the batch to finish and download results.')
-parser.add_argument('-f','--localjobdirfile', help=h['localjobdirfile'], required=True, type=str)
+parser.add_argument('-a','--archive', help=h['archive'], required=False, action='store_true')
+parser.add_argument('-c','--compress', help=h['compress'], required=False, action='store_true')
+parser.add_argument('-e','--events', help=h['events'], required=False, action='store_true')
+parser.add_argument('-f','--localjobdirfile', help=h['localjobdirfile'], required=True, type=str, action='append')
 parser.add_argument('-l','--logfile', help=h['logfile'], required=False, type=str)
+parser.add_argument('-M','--metricsfile', help=h['metricsfile'], required=False, type=str)
+parser.add_argument('-n','--concurrency', help=h['concurrency'], required=False, type=int, default=config.DEFAULT_DOWNLOAD_CONCURRENCY)
 parser.add_argument('-ll','--loglevel', help=h['loglevel'], required=False, type=str, choices=['debug','info','warn','error','critical'])
+parser.add_argument('-x','--maxpollingintervalsec', help=h['maxpollingintervalsec'], required=False, type=int)
 parser.add_argument('-z','--pollingintervalsec', help=h['pollingintervalsec'], required=True, type=int)
 args = parser.parse_args()
 
 if args.logfile or args.loglevel:
   util.setup_logging(args.logfile, args.loglevel)
 log = util.get_log()
+if args.metricsfile:
+  metrics.enable()
 
 # read central configuration file
 try:
@@ -53,132 +112,193 @@ except:
 
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
 def get_local_job_directories(localjobdirfile):
-  ''' get the list of local job directories from file. '''
-  return util.get_local_job_directories(localjobdirfile)
+  ''' generate the local job directories from file or pattern. the local job directories of jobs generated from a
+      template, see rjm_batch_submit.py --parameters, are read from the job store. '''
+  if template.is_template(localjobdirfile):
+    return job_store.get_batch_directories(store.get_batch_name(localjobdirfile))
+  return util.iter_local_job_directories(localjobdirfile)
 
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
-def read_job_config_file(job_config_file):
-  ''' read the local configuration file of a job (ini-format). '''
-  return config.read_job_config_file(job_config_file)
+def get_jobs(localdirs, batch):
+  ''' get the state of the jobs of a batch from the job store. '''
+  return job_store.get_jobs(localdirs, batch)
   
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
-def stage_out_file(sftp, remotefile, localfile):
-  ''' download an individual file. '''
-  log.debug('downloading remote file %s to local file %s' % (remotefile, localfile))
-  sftp.get(remotefile, localfile)
-
-@Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
-def get_outputfile_names(files_out, remotedir):
-  ''' get the full path of the remote files to be downloaded after a job is done '''
+def get_outputfile_names(files_out):
+  ''' get the names of the remote files to be downloaded after a job is done, relative to the remote job directory '''
   filenames = []
   if os.path.isfile(files_out):
-    filenamestmp = util.read_lines_from_file(files_out)
-    filenames = ['%s/%s' % (remotedir, name) for name in filenamestmp]
+    filenames = util.read_lines_from_file(files_out)
   return filenames
-  
 
 @Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
-def rename_file(old, new):
-  ''' rename a file.
-      note, that on Windows os.rename() causes an exception if the new file already exists.
-      that's the reason for removing the existing file first.
+def update_job(localdir, props_dict, state):
+  ''' record the state of a job in the job store, which also exports it to the job config file in the local job directory '''
+  job_store.update(localdir, props_dict, state=state)
+
+def download_done(localdir):
+  ''' record that the results of a job have been downloaded '''
+  update_job(localdir, { 'JOB': { 'download_done': True } }, store.STATE_DOWNLOADED)
+  log.info('done downloading results into directory %s' % localdir)
+
+def stage_out(finished):
+  ''' queue the result files of finished jobs for download, if they have not already been downloaded.
+      finished is a list of (local job directory, remote job directory) tuples.
+      in archive mode, the files of all jobs are downloaded as a single tar stream.
   '''
-  log.debug('renaming %s to %s' % (old, new))
-  if os.path.exists(new):
-    os.remove(new)
-  os.rename(old, new)
-  if not os.path.isfile(new):
-    raise Exception('renaming file %s to %s failed.' % (old, new))
+  archive_jobs = []
+  for localdir, remotedir in finished:
+    try:
+      job_config = job_store.get(localdir)
+      if eval(job_config['JOB']['download_done']):
+        log.info('results have already been downloaded for job in local directory %s' % localdir)
+        continue
+      if 'downloads' in job_config['JOB']:
+        # the job has been generated from a template. its local job directory is created to receive the results
+        names = json.loads(job_config['JOB']['downloads'])
+        if names and not os.path.isdir(localdir):
+          os.makedirs(localdir)
+      else:
+        files_out = '%s%s%s' % (localdir, os.path.sep, conf['FILE_TRANSFER']['downloads_file'])
+        names = get_outputfile_names(files_out)
+      log.debug('files to download: %s' % str(names))
+      if not names:
+        continue
+      if args.archive:
+        archive_jobs.append((remotedir, names, localdir))
+      else:
+        files = [('%s/%s' % (remotedir, name), '%s%s%s' % (localdir, os.path.sep, os.path.basename(name))) for name in names]
+        downloads.download(files, lambda failed, localdir=localdir: download_done(localdir))
+    except:
+      log.warn('failed to queue the result files of job %s for download' % localdir)
+  if archive_jobs:
+    downloads.download_archives(archive_jobs, args.compress, lambda localdir, failed: download_done(localdir))
 
-@Retry(conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
-def create_or_update_job_config_file(localdir, props_dict):
-  ''' create metadata file for job in local job directory (ini-format) '''
-  config.create_or_update_job_config_file(localdir, props_dict)
-
-def stage_out(sftp, localdir, remotedir, downloads_file):
-  ''' download all files for this job, if they have not already been downloaded '''
-  job_config = read_job_config_file('%s%s.job.ini' % (localdir, os.path.sep))
-  if not eval(job_config['JOB']['download_done']):
-    files_out = '%s%s%s' % (localdir, os.path.sep, downloads_file)
-    remotefiles = get_outputfile_names(files_out, remotedir)
-    log.debug('files to download: %s' % str(remotefiles))
-    if remotefiles:
-      for remotefile in remotefiles:
-        name = os.path.basename(remotefile)
-        localtempfile = '%s%s.%s' % (localdir, os.path.sep, name)
-        localfile = '%s%s%s' % (localdir, os.path.sep, name)
-        try:
-          stage_out_file(sftp, remotefile, localtempfile)
-        except:
-          log.warn('failed to download file %s to %s' % (remotefile, localfile))
-          continue
-        rename_file(localtempfile, localfile)
-      create_or_update_job_config_file(localdir, { 'JOB': { 'download_done': True } })
-      log.info('done downloading results into directory %s' % localdir)
-  else:
-    log.info('results have already been downloaded for job in local directory %s' % localdir)
+def wait_for_events(timeout):
+  ''' queue the results of jobs for download as soon as the watcher reports them finished, until the timeout has passed '''
+  global jobs
+  deadline = time.time() + timeout
+  while jobs and watcher.is_alive() and time.time() < deadline:
+    job_ids = dict([(posixpath.normpath(j['remote_directory']), job_id) for job_id, j in jobs.items()])
+    finished = []
+    for remote_directory, rc in watcher.get_finished(deadline - time.time()):
+      job_id = job_ids.get(posixpath.normpath(remote_directory))
+      if job_id in jobs:
+        log.info('job %s finished (exit code %s).' % (jobs[job_id]['local_directory'], rc))
+        finished.append((jobs[job_id]['local_directory'], jobs[job_id]['remote_directory']))
+        del jobs[job_id]
+    stage_out(finished)
+  if jobs:
+    # the watcher has ended early, e.g. because the connection was lost. poll again after the timeout
+    time.sleep(max(deadline - time.time(), 0))
 
-# read local job directories from file
+# open the job store
 try:
-  localdirs = get_local_job_directories(args.localjobdirfile)
+  job_store = store.JobStore()
 except:
-  log.critical('failed to read list of local job directories or invalid entries in list')
+  log.critical('failed to open job store. %s' % traceback.format_exc().strip())
   cleanup()
   sys.exit(1)
 
-# stop if no job directories are listed
-if len(localdirs) == 0:
-  log.info('no job directories. nothing to wait for. exiting')
-  cleanup()
-  sys.exit(0)
-  
 jobs = {}
 
-# read the configuration file for each job
-# the configuration files contains the job id and the remote job directory
-for localdir in localdirs:
-  job_config_file = '%s%s.job.ini' % (localdir, os.path.sep)
-  try:
-    job_config = read_job_config_file(job_config_file)
-    job_id = job_config['JOB']['id']
-    remote_directory = job_config['JOB']['remote_directory']
-    jobs[job_id] = { 'remote_directory': remote_directory, 'local_directory': localdir }
-  except:
-    log.warn('failed to read job config file %s. skipping job.' % job_config_file)
+# read the local job directories of each batch, and load the state of their jobs from the job store, window by window.
+# the state of each job contains the job id and the remote job directory
+try:
+  for localjobdirfile in args.localjobdirfile:
+    batch = store.get_batch_name(localjobdirfile)
+    for window in util.chunks(get_local_job_directories(localjobdirfile), config.JOB_WINDOW_SIZE):
+      job_configs = get_jobs(window, batch)
+      for localdir in window:
+        try:
+          job_config = job_configs[localdir]
+          job_id = job_config['JOB']['id']
+          remote_directory = job_config['JOB']['remote_directory']
+          walltime = polling.get_seconds(job_config['JOB'].get('walltime'))
+          jobs[job_id] = { 'remote_directory': remote_directory, 'local_directory': localdir, 'unknown_polls': 0, 'walltime': walltime }
+        except:
+          log.warn('no job id or remote directory for local directory %s. skipping job.' % localdir)
+except:
+  log.critical('failed to read list of local job directories or job store. %s' % traceback.format_exc().strip())
+  cleanup()
+  sys.exit(1)
 
+# stop if there are no jobs
+if len(jobs) == 0:
+  log.info('no jobs. nothing to wait for. exiting')
+  cleanup()
+  sys.exit(0)
+
+downloads = transfer.DownloadPool(lambda: ssh.get_cluster_connection(conf), args.concurrency,
+  conf['RETRY']['max_attempts'], conf['RETRY']['min_wait_s'], conf['RETRY']['max_wait_s'])
+scheduler = polling.PollScheduler(args.pollingintervalsec, args.maxpollingintervalsec)
 log.info('waiting for jobs to finish (polling every %s seconds)...' % args.pollingintervalsec)
 while True:
   try:
     log.info('checking for job status of %s jobs...' % len(jobs))
     error_occured = False
     jobs_new = {}
-    ssh_conn = ssh.open_connection_ssh_agent(conf['CLUSTER']['remote_host'], conf['CLUSTER']['remote_user'], conf['CLUSTER']['ssh_priv_key_file'])
+    finished = []
+    ssh_conn = ssh.get_cluster_connection(conf)
     log.debug('getting job statuses')
-    jobmap = job.get_job_statuses(ssh_conn)
+    with metrics.span('poll'):
+      jobmap = job.get_job_details(ssh_conn, jobs.keys())
     for job_id in jobs.keys():
-      if job_id not in jobmap:
-        log.info('job %s finished.' % jobs[job_id]['local_directory'])
-        try:
-          stage_out(ssh_conn.open_sftp(), jobs[job_id]['local_directory'], jobs[job_id]['remote_directory'], conf['FILE_TRANSFER']['downloads_file'])
-        except:
-          log.warn('failed to download or rename some of the result files for job into %s' % jobs[job_id]['local_directory'])
-      else:
+      state = jobmap[job_id]['state']
+      if state == job.STATE_UNKNOWN:
+        # the job has left the queue, but the accounting system doesn't know it (yet)
+        jobs[job_id]['unknown_polls'] += 1
+        if jobs[job_id]['unknown_polls'] < config.MAX_UNKNOWN_POLLS:
+          log.debug('job %s is unknown to the scheduler. checking again.' % job_id)
+          jobs_new[job_id] = jobs[job_id]
+          continue
+        log.warn('job %s has been unknown to the scheduler %s times in a row. assuming it has finished.' % (job_id, config.MAX_UNKNOWN_POLLS))
+      elif not job.has_left_queue(state):
+        jobs[job_id]['unknown_polls'] = 0
         jobs_new[job_id] = jobs[job_id]
+        continue
+      log.info('job %s finished (%s).' % (jobs[job_id]['local_directory'], state))
+      finished.append((jobs[job_id]['local_directory'], jobs[job_id]['remote_directory']))
+    stage_out(finished)
+    job_store.flush()
   except:
     error_occured = True
     log.warn('failed to get status. only critical if happens repeatedly. %s' % traceback.format_exc().strip())
-  finally:
+    # don't reuse a connection that may be broken
     try:
       ssh.close_connection(ssh_conn)
     except:
       pass
+    ssh_conn = None
     
   if len(jobs_new) > 0:
     jobs = jobs_new
   else:
     if not error_occured:
       break
+
+  if error_occured:
+    interval = scheduler.error_interval()
+  else:
+    interval = scheduler.next_interval(dict([(job_id, jobmap[job_id]) for job_id in jobs]),
+                                       dict([(job_id, jobs[job_id]['walltime']) for job_id in jobs]))
+  log.debug('next poll in %.1f seconds' % interval)
+
+  if args.events and ssh_conn:
+    try:
+      if watcher is None or not watcher.is_alive():
+        log.debug('starting to watch for finished jobs')
+        watcher = job.CompletionWatcher(ssh_conn, [j['remote_directory'] for j in jobs.values()])
+      wait_for_events(interval)
+      if not jobs:
+        break
+      continue
+    except:
+      log.warn('failed to watch for finished jobs. polling instead. %s' % traceback.format_exc().strip())
+      watcher = None
   
-  time.sleep(args.pollingintervalsec)
-  
+  time.sleep(interval)
+
+log.info('waiting for downloads to finish...')
+downloads.wait()
 cleanup()
@@ -0,0 +1,66 @@
+import sys
+import json
+import time
+import argparse
+import traceback
+import cer.client.daemon as daemon
+import cer.client.util as util
+import cer.client.util.config as config
+
+# information displayed as help by argparse
+h = {
+  'action':
+    'start: start rjmd in the background. while rjmd is running, rjm_batch_submit, rjm_batch_wait, rjm_batch_cancel ' +
+    'and rjm_batch_clean pass their commands on to rjmd, unless the environment variable %s is set. ' % daemon.DISABLE_ENV +
+    'rjmd reads %s when it starts, so restart it after changing the configuration. ' % config.get_config_file() +
+    'stop: stop rjmd. commands that are still running are interrupted. ' +
+    'status: show the commands rjmd is running. ' +
+    'events: show changes of job states as rjmd sees them, until interrupted.',
+  'logfile':
+    'logfile of rjmd. default: %s' % config.DAEMON_LOG_FILE_NAME + ' in the configuration directory.',
+  'loglevel':
+    'level of log verbosity of rjmd. default: %s. ' % util.DEFAULT_LOG_LEVEL.lower() +
+    'the higher the log level, more information will be printed.',
+}
+
+parser = argparse.ArgumentParser(description='control rjmd, the rjm daemon, which runs rjm commands without starting a new python process for each.')
+parser.add_argument('action', help=h['action'], type=str, choices=['start', 'stop', 'status', 'events'])
+parser.add_argument('-l','--logfile', help=h['logfile'], required=False, type=str)
+parser.add_argument('-ll','--loglevel', help=h['loglevel'], required=False, type=str, choices=['debug','info','warn','error','critical'])
+args = parser.parse_args()
+
+log = util.get_log()
+
+if not daemon.is_supported():
+  log.critical('rjmd is not supported on this platform')
+  sys.exit(1)
+
+if args.action in ['status', 'events'] and not daemon.is_running():
+  log.info('rjmd is not running')
+  sys.exit(3)
+
+try:
+  if args.action == 'start':
+    daemon.start(args.logfile, args.loglevel)
+    log.info('rjmd is running')
+  elif args.action == 'stop':
+    if daemon.is_running():
+      daemon.stop()
+      log.info('rjmd stopped')
+    else:
+      log.info('rjmd is not running')
+  elif args.action == 'status':
+    status = daemon.get_status()
+    print('rjmd (pid %s) running for %d seconds, watching %s jobs' % (status['pid'], status['uptime_s'], status['watched_jobs']))
+    for command in status['commands']:
+      print('%s: %s %s (in %s, running for %d seconds)' % (command['pid'], command['script'], ' '.join(command['argv']),
+        command['cwd'], time.time() - command['started']))
+  elif args.action == 'events':
+    for event in daemon.get_events():
+      print(json.dumps(event))
+      sys.stdout.flush()
+except KeyboardInterrupt:
+  pass
+except:
+  log.critical('failed to %s rjmd. %s' % (args.action, traceback.format_exc().strip()))
+  sys.exit(1)
@@ -0,0 +1,189 @@
+'''
+  Client side of rjmd, the rjm daemon.
+
+  rjmd is a long-running process that runs rjm commands on behalf of the rjm scripts. It has imported everything
+  rjm needs, so a command passed on to rjmd doesn't pay for importing paramiko on every invocation. Each command
+  runs in a process forked from rjmd, with the arguments, working directory and environment of the script, and
+  its output is streamed back to the script. The commands reach the cluster through the shared SSH session
+  (see cer.client.ssh.control), and job statuses are polled by rjmd for all commands together, so that
+  commands running at the same time share one view of the scheduler.
+
+  The rjm scripts import this module before anything else, so it only imports modules that load quickly.
+
+  Messages on the socket of rjmd are JSON objects, one per line. A client sends a request with the key type,
+  and reads messages until it has got what it asked for.
+'''
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+import cer.client.util.config as config
+
+# environment variable that is set for the commands run by rjmd
+CHILD_ENV = 'RJMD_CHILD'
+# environment variable that stops the rjm scripts from passing commands on to rjmd
+DISABLE_ENV = 'RJM_NO_DAEMON'
+
+# time the current process has last got job states from rjmd
+last_job_details = 0
+
+def is_supported():
+  ''' return True if rjmd can be used on this platform. '''
+  # commands are run in forked processes, and rjmd is started as 'python -m ...'
+  return hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork') and not getattr(sys, 'frozen', False)
+
+def is_child():
+  ''' return True if the current process is a command run by rjmd. '''
+  return CHILD_ENV in os.environ
+
+def get_socket_path():
+  ''' get the absolute path of the socket rjmd listens on. '''
+  return os.path.join(config.get_config_dir(), config.DAEMON_SOCKET_NAME)
+
+def send_message(sock, message):
+  ''' send a single message. '''
+  sock.sendall(('%s\n' % json.dumps(message)).encode('utf-8'))
+
+def read_messages(sock):
+  ''' generate the messages received on a socket until it is closed. '''
+  f = sock.makefile('rb')
+  try:
+    for line in iter(f.readline, b''):
+      yield json.loads(line.decode('utf-8'))
+  finally:
+    f.close()
+
+def connect(socket_path=None):
+  ''' connect to rjmd. return None if rjmd is not running. '''
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path or get_socket_path())
+  except socket.error:
+    sock.close()
+    return None
+  return sock
+
+def request(message):
+  ''' send a request to rjmd and return its reply. raise an exception if rjmd is not running or the request fails. '''
+  sock = connect()
+  if sock is None:
+    raise Exception('rjmd is not running')
+  try:
+    send_message(sock, message)
+    for reply in read_messages(sock):
+      if 'error' in reply:
+        raise Exception('rjmd: %s' % reply['error'])
+      return reply
+    raise Exception('rjmd closed the connection')
+  finally:
+    sock.close()
+
+def is_running():
+  ''' return True if rjmd is running and accepts requests. '''
+  try:
+    request({ 'type': 'ping' })
+    return True
+  except:
+    return False
+
+def __write(stream, data):
+  ''' write output of a command, received as latin-1 text, as the original bytes. '''
+  data = data.encode('latin-1')
+  stream.flush()
+  if hasattr(stream, 'buffer'):
+    stream.buffer.write(data)
+  else:
+    stream.write(data)
+  stream.flush()
+
+def run_script(script, argv):
+  '''
+    Run an rjm script through rjmd, if rjmd is running, and return its exit code.
+    Return None if the script has to run in the current process instead: if rjmd is not running, if rjmd is not
+    supported on this platform, if the environment variable RJM_NO_DAEMON is set, or if the current process is
+    already a command run by rjmd.
+  '''
+  if is_child() or DISABLE_ENV in os.environ or not is_supported():
+    return None
+  sock = connect()
+  if sock is None:
+    return None
+  try:
+    send_message(sock, { 'type': 'run', 'script': os.path.abspath(script), 'argv': argv, 'cwd': os.getcwd(),
+                         'env': dict(os.environ) })
+    for message in read_messages(sock):
+      if 'stdout' in message:
+        __write(sys.stdout, message['stdout'])
+      elif 'stderr' in message:
+        __write(sys.stderr, message['stderr'])
+      elif 'exit' in message:
+        return message['exit']
+      elif 'error' in message:
+        sys.stderr.write('Error: rjmd failed to run %s: %s%s' % (script, message['error'], os.linesep))
+        return 1
+    sys.stderr.write('Error: lost connection to rjmd while running %s%s' % (script, os.linesep))
+    return 1
+  except KeyboardInterrupt:
+    # closing the connection makes rjmd interrupt the command
+    return 130
+  finally:
+    sock.close()
+
+def get_job_details(jobids, max_age_s=config.DAEMON_MAX_STATUS_AGE_S):
+  '''
+    Get the state of jobs from rjmd, in the format of cer.client.job.get_job_details. States that rjmd has polled
+    for any command since the current process has last asked, and within the last max_age_s seconds, are reused.
+    Otherwise rjmd polls the states with a single remote call.
+  '''
+  global last_job_details
+  details = request({ 'type': 'job_details', 'jobids': list(jobids), 'max_age_s': max_age_s, 'since': last_job_details })['details']
+  last_job_details = time.time()
+  return details
+
+def get_status():
+  ''' get the status of rjmd: its process id, uptime, the commands it is running and the number of jobs it watches. '''
+  return request({ 'type': 'status' })
+
+def get_events():
+  ''' generate the changes of job states seen by rjmd, as dictionaries with the keys jobid, state and time. '''
+  sock = connect()
+  if sock is None:
+    raise Exception('rjmd is not running')
+  try:
+    send_message(sock, { 'type': 'events' })
+    for message in read_messages(sock):
+      if 'error' in message:
+        raise Exception('rjmd: %s' % message['error'])
+      yield message
+  finally:
+    sock.close()
+
+def start(logfile=None, loglevel=None):
+  ''' start rjmd in the background, unless it is already running. wait until it accepts requests. '''
+  if is_running():
+    return
+  cmd = [sys.executable, '-m', 'cer.client.daemon.server']
+  if logfile:
+    cmd.extend(['--logfile', logfile])
+  if loglevel:
+    cmd.extend(['--loglevel', loglevel])
+  devnull = open(os.devnull, 'r+b')
+  try:
+    subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+  finally:
+    devnull.close()
+  deadline = time.time() + config.DAEMON_START_TIMEOUT_S
+  while not is_running():
+    if time.time() > deadline:
+      raise Exception('rjmd has not started within %s seconds. see %s' % (config.DAEMON_START_TIMEOUT_S,
+        logfile or os.path.join(config.get_config_dir(), config.DAEMON_LOG_FILE_NAME)))
+    time.sleep(0.1)
+
+def stop():
+  ''' stop rjmd and wait until it has exited. commands that are still running are interrupted. '''
+  request({ 'type': 'stop' })
+  deadline = time.time() + config.DAEMON_START_TIMEOUT_S
+  while os.path.exists(get_socket_path()) and time.time() < deadline:
+    time.sleep(0.1)
@@ -0,0 +1,371 @@
+'''
+  rjmd, the rjm daemon. See cer.client.daemon for the client side.
+
+  Requests:
+    ping         reply { 'ok': true }
+    run          run an rjm script in a forked process. stream { 'stdout': ... } and { 'stderr': ... } messages
+                 with its output, then { 'exit': <exit code> }. the script is interrupted if the client goes away.
+    job_details  reply { 'details': ... } with the states of jobs, see DaemonServer.get_job_details
+    status       reply with the process id and uptime of rjmd, the commands it runs and the jobs it watches
+    events       stream { 'jobid': ..., 'state': ..., 'time': ... } for each change of a job state
+    stop         reply { 'ok': true } and stop rjmd
+'''
+import os
+import sys
+import json
+import time
+import errno
+import runpy
+import select
+import signal
+import socket
+import logging
+import argparse
+import threading
+import traceback
+try:
+  import socketserver
+except ImportError:
+  import SocketServer as socketserver
+try:
+  import queue as Queue
+except ImportError:
+  import Queue
+import cer.client.daemon as daemon
+import cer.client.util as util
+import cer.client.util.config as config
+import cer.client.ssh as ssh
+import cer.client.job as job
+# modules used by the rjm scripts. imported here once, so that the commands don't have to
+import cer.client.job.polling
+import cer.client.job.scheduler
+import cer.client.job.store
+import cer.client.job.journal
+import cer.client.job.template
+import cer.client.transfer
+import cer.client.transfer.archive
+import cer.client.transfer.cache
+import cer.client.transfer.delta
+# cer.client.ssh imports paramiko and pycrypto only when they are first needed, so that commands that don't connect
+# start quickly. rjmd imports them here instead, so that no command run by rjmd has to. commands that need them fail
+# with the usual error if they are not installed
+try:
+  import paramiko
+except ImportError:
+  pass
+try:
+  import Crypto.PublicKey.RSA
+except ImportError:
+  pass
+
+BUFSIZE = 32768
+
+def run_command(message, stdout_fd, stderr_fd):
+  ''' run an rjm script in the current, forked process, with its output written to stdout_fd and stderr_fd. return its exit code. '''
+  devnull = os.open(os.devnull, os.O_RDONLY)
+  os.dup2(devnull, 0)
+  os.dup2(stdout_fd, 1)
+  os.dup2(stderr_fd, 2)
+  for fd in [devnull, stdout_fd, stderr_fd]:
+    os.close(fd)
+  signal.signal(signal.SIGINT, signal.default_int_handler)
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  os.chdir(message['cwd'])
+  os.environ.clear()
+  os.environ.update(message['env'])
+  os.environ[daemon.CHILD_ENV] = '1'
+  # connections and logging configuration of rjmd are not for the command
+  ssh.forget_connections()
+  log = util.get_log()
+  for h in list(log.handlers):
+    log.removeHandler(h)
+  handler = logging.StreamHandler()
+  handler.setFormatter(logging.Formatter(util.FORMAT))
+  log.addHandler(handler)
+  log.setLevel(getattr(logging, util.DEFAULT_LOG_LEVEL))
+  sys.argv = [message['script']] + message['argv']
+  try:
+    runpy.run_path(message['script'], run_name='__main__')
+    rc = 0
+  except SystemExit as e:
+    if e.code is None or isinstance(e.code, int):
+      rc = e.code or 0
+    else:
+      sys.stderr.write('%s%s' % (e.code, os.linesep))
+      rc = 1
+  except KeyboardInterrupt:
+    rc = 130
+  except:
+    traceback.print_exc()
+    rc = 1
+  sys.stdout.flush()
+  sys.stderr.flush()
+  return rc
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+  ''' serve a single request on the socket of rjmd. '''
+  def handle(self):
+    try:
+      line = self.rfile.readline()
+      if not line:
+        return
+      message = json.loads(line.decode('utf-8'))
+      message_type = message.get('type')
+      try:
+        if message_type == 'ping':
+          self.send({ 'ok': True })
+        elif message_type == 'run':
+          self.__run(message)
+        elif message_type == 'job_details':
+          self.send({ 'details': self.server.get_job_details(message['jobids'],
+            message.get('max_age_s', config.DAEMON_MAX_STATUS_AGE_S), message.get('since', 0)) })
+        elif message_type == 'status':
+          self.send(self.server.get_status())
+        elif message_type == 'events':
+          self.__events()
+        elif message_type == 'stop':
+          self.send({ 'ok': True })
+          t = threading.Thread(target=self.server.shutdown)
+          t.daemon = True
+          t.start()
+        else:
+          self.send({ 'error': 'unknown request type %s' % message_type })
+      except socket.error:
+        raise
+      except:
+        util.get_log().error('failed to serve %s request: %s' % (message_type, traceback.format_exc().strip()))
+        self.send({ 'error': str(sys.exc_info()[1]) })
+    except socket.error:
+      pass
+
+  def send(self, message):
+    daemon.send_message(self.request, message)
+
+  def __run(self, message):
+    ''' run a command in a forked process and relay its output, until it has finished. '''
+    with self.server.fork_lock:
+      stdout_r, stdout_w = os.pipe()
+      stderr_r, stderr_w = os.pipe()
+      pid = self.server.fork()
+      if pid == 0:
+        rc = 1
+        try:
+          os.close(stdout_r)
+          os.close(stderr_r)
+          self.server.socket.close()
+          rc = run_command(message, stdout_w, stderr_w)
+        finally:
+          os._exit(rc)
+      os.close(stdout_w)
+      os.close(stderr_w)
+    util.get_log().info('running %s %s (pid %s)' % (message['script'], ' '.join(message['argv']), pid))
+    self.server.command_started(pid, message)
+    try:
+      rc = self.__relay(pid, { stdout_r: 'stdout', stderr_r: 'stderr' })
+    finally:
+      self.server.command_finished(pid)
+    util.get_log().info('%s (pid %s) finished with exit code %s' % (message['script'], pid, rc))
+
+  def __relay(self, pid, pipes):
+    ''' pass the output of a command on to the client. interrupt the command if the client goes away. '''
+    client = self.request
+    kill_deadline = None
+    while pipes:
+      timeout = None if kill_deadline is None else max(kill_deadline - time.time(), 0)
+      readable, writable, exceptional = select.select(list(pipes.keys()) + ([client] if client else []), [], [], timeout)
+      if kill_deadline is not None and time.time() >= kill_deadline:
+        util.get_log().warn('command (pid %s) did not exit after being interrupted. killing it.' % pid)
+        os.kill(pid, signal.SIGKILL)
+        kill_deadline = None
+      for fd in readable:
+        if fd is client:
+          if not client.recv(BUFSIZE):
+            util.get_log().info('client of command (pid %s) has gone away. interrupting it.' % pid)
+            os.kill(pid, signal.SIGINT)
+            client = None
+            kill_deadline = time.time() + config.DAEMON_KILL_GRACE_S
+          continue
+        data = os.read(fd, BUFSIZE)
+        if not data:
+          os.close(fd)
+          del pipes[fd]
+        elif client:
+          try:
+            self.send({ pipes[fd]: data.decode('latin-1') })
+          except socket.error:
+            client = None
+    pid, status = os.waitpid(pid, 0)
+    rc = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+    if client:
+      self.send({ 'exit': rc })
+    return rc
+
+  def __events(self):
+    ''' stream changes of job states until the client goes away. '''
+    events = self.server.subscribe()
+    try:
+      while True:
+        try:
+          event = events.get(timeout=1)
+        except Queue.Empty:
+          if select.select([self.request], [], [], 0)[0] and not self.request.recv(BUFSIZE):
+            break
+          continue
+        self.send(event)
+    finally:
+      self.server.unsubscribe(events)
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  ''' rjmd. keeps track of the commands it runs and the states of the jobs they have asked for. '''
+  daemon_threads = True
+
+  def __init__(self, socket_path, conf):
+    socketserver.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+    self.conf = conf
+    self.started = time.time()
+    self.lock = threading.Lock()
+    self.poll_lock = threading.Lock()
+    # held from creating the pipes of a command until the parent has closed their write ends, so that no other
+    # command is forked in between and inherits them, which would keep the pipes open until that command exits
+    self.fork_lock = threading.Lock()
+    self.commands = {}
+    # job id -> (time polled, details)
+    self.details = {}
+    # job id -> time a command has last asked for the job
+    self.watched = {}
+    self.subscribers = []
+
+  def fork(self):
+    ''' fork a process for a command. '''
+    # don't let the command inherit the logging lock while another thread holds it. python 3.7 and later do this
+    # themselves, and give the forked process a new lock
+    if hasattr(os, 'register_at_fork'):
+      return os.fork()
+    logging._lock.acquire()
+    try:
+      return os.fork()
+    finally:
+      logging._lock.release()
+
+  def command_started(self, pid, message):
+    with self.lock:
+      self.commands[pid] = { 'pid': pid, 'script': message['script'], 'argv': message['argv'], 'cwd': message['cwd'],
+                             'started': time.time() }
+
+  def command_finished(self, pid):
+    with self.lock:
+      del self.commands[pid]
+
+  def get_job_details(self, jobids, max_age_s, since=0):
+    '''
+      Get the states of jobs, in the format of cer.client.job.get_job_details. States that have been polled
+      after since, e.g. for another command after the caller has last asked, and within the last max_age_s seconds
+      are reused. Otherwise, the states of all jobs that any command has asked for within DAEMON_WATCH_TTL_S are
+      polled together, with a single remote call.
+    '''
+    now = time.time()
+    with self.lock:
+      for jobid in jobids:
+        self.watched[jobid] = now
+    with self.poll_lock:
+      oldest = max(since, now - max_age_s)
+      if [jobid for jobid in jobids if jobid not in self.details or self.details[jobid][0] <= oldest]:
+        with self.lock:
+          for jobid in [jobid for jobid, t in self.watched.items() if t < now - config.DAEMON_WATCH_TTL_S]:
+            del self.watched[jobid]
+            self.details.pop(jobid, None)
+          watched = list(self.watched.keys())
+        self.__poll(watched)
+      return dict([(jobid, self.details[jobid][1]) for jobid in jobids])
+
+  def __poll(self, jobids):
+    util.get_log().debug('polling the states of %s jobs' % len(jobids))
+    ssh_conn = ssh.get_cluster_connection(self.conf)
+    try:
+      details = job.get_job_details(ssh_conn, jobids)
+    except:
+      # don't reuse a connection that may be broken
+      ssh.close_connection(ssh_conn)
+      raise
+    now = time.time()
+    for jobid, d in details.items():
+      previous = self.details.get(jobid)
+      self.details[jobid] = (now, d)
+      if previous is None or previous[1]['state'] != d['state']:
+        self.publish({ 'jobid': jobid, 'state': d['state'], 'time': now })
+
+  def publish(self, event):
+    with self.lock:
+      for subscriber in self.subscribers:
+        subscriber.put(event)
+
+  def subscribe(self):
+    events = Queue.Queue()
+    with self.lock:
+      self.subscribers.append(events)
+    return events
+
+  def unsubscribe(self, events):
+    with self.lock:
+      self.subscribers.remove(events)
+
+  def get_status(self):
+    with self.lock:
+      return { 'pid': os.getpid(), 'uptime_s': time.time() - self.started, 'commands': list(self.commands.values()),
+               'watched_jobs': len(self.watched), 'subscribers': len(self.subscribers) }
+
+  def stop_commands(self):
+    ''' interrupt the commands that are still running. '''
+    with self.lock:
+      pids = list(self.commands.keys())
+    for pid in pids:
+      try:
+        os.kill(pid, signal.SIGINT)
+      except OSError:
+        pass
+
+def run_server(socket_path, conf):
+  ''' serve requests until rjmd is stopped. '''
+  if os.path.exists(socket_path):
+    if daemon.is_running():
+      util.get_log().info('rjmd is already running')
+      return
+    os.remove(socket_path)
+  old_umask = os.umask(0o077)
+  try:
+    server = DaemonServer(socket_path, conf)
+  except socket.error as e:
+    if e.errno == errno.EADDRINUSE:
+      return
+    raise
+  finally:
+    os.umask(old_umask)
+  util.get_log().info('rjmd (pid %s) listening on %s' % (os.getpid(), socket_path))
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    server.stop_commands()
+    try:
+      os.remove(socket_path)
+    except OSError:
+      pass
+    util.get_log().info('rjmd stopped')
+
+def main():
+  parser = argparse.ArgumentParser(description='rjmd, the rjm daemon. runs rjm commands on behalf of the rjm scripts.')
+  parser.add_argument('-l','--logfile', required=False, type=str,
+    default=os.path.join(config.get_config_dir(), config.DAEMON_LOG_FILE_NAME))
+  parser.add_argument('-ll','--loglevel', required=False, type=str, choices=['debug','info','warn','error','critical'])
+  args = parser.parse_args()
+  util.setup_logging(args.logfile, args.loglevel)
+
+  conf = config.get_config()
+  # make sure the socket gets removed when rjmd is terminated
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  run_server(daemon.get_socket_path(), conf)
+
+if __name__ == '__main__':
+  main()
@@ -1,14 +1,74 @@
 import os
+import re
+import posixpath
+import threading
+import traceback
+try:
+  import queue as Queue
+except ImportError:
+  import Queue
 import cer.client.util as util
 import cer.client.util.config as config
 import cer.client.ssh as ssh
+import cer.client.daemon as daemon
 
-# get central configuration
-conf = config.get_config()
-cluster = conf['CLUSTER']
+# state of a job that has left the queue and is not known to the accounting system
+STATE_UNKNOWN = 'UNKNOWN'
+# state of a job that has left the queue, if the accounting system is not available
+STATE_GONE = 'GONE'
+# states of jobs that wait in the queue, as reported by get_job_details and get_job_statuses
+PENDING_STATES = ['PENDING', 'PD']
+# states of jobs that are running, as reported by get_job_details and get_job_statuses
+RUNNING_STATES = ['RUNNING', 'R']
+# states of jobs that have left the queue
+FINISHED_STATES = ['BOOT_FAIL', 'CANCELLED', 'COMPLETED', 'DEADLINE', 'FAILED', 'NODE_FAIL', 'OUT_OF_MEMORY',
+                   'PREEMPTED', 'TIMEOUT', STATE_GONE]
+
+# outcomes of the cancellation of a job, as reported by cancel_batch: the job has left the queue, the job is still in
+# the queue (e.g. while its processes are killed), or the job had already left the queue before
+CANCEL_CANCELLED = 'cancelled'
+CANCEL_REQUESTED = 'requested'
+CANCEL_FINISHED = 'finished'
+
+# the backend of the scheduler, and the name it has been created for
+__scheduler = {}
+
+# job id of a task of a Slurm job array: <arrayid>_<index>, or <arrayid>_[<ranges>] for several tasks
+array_task_pattern = re.compile(r'^(\d+)_(\d+|\[[\d,\-%]+\])$')
+# job id of a task of a task farm, see prepare_jobs: <packid>:<index>, or <packid>:[<ranges>] for several tasks
+pack_task_pattern = re.compile(r'^(\d+):(\d+|\[[\d,\-]+\])$')
+
+def get_cluster_config():
+  '''
+    Get the cluster section of the central configuration. The configuration is read when it is first needed,
+    not when this module is imported, so that importing it is cheap and doesn't fail without a configuration.
+  '''
+  return config.get_config()['CLUSTER']
+
+def get_remote_command(name):
+  '''
+    Get the path of a remote command.
+    Commands that are not listed in the configuration file are expected in the directory of remote_prepare_job.
+  '''
+  cluster = get_cluster_config()
+  key = 'remote_%s' % name
+  if key in cluster:
+    return cluster[key]
+  return posixpath.join(posixpath.dirname(cluster['remote_prepare_job']), name)
+
+def get_scheduler():
+  '''
+    Get the backend of the scheduler of the cluster, as selected by the option scheduler of the configuration
+    file. See cer.client.job.scheduler.
+  '''
+  from cer.client.job import scheduler
+  name = get_cluster_config().get('scheduler', scheduler.DEFAULT_SCHEDULER)
+  if __scheduler.get('name') != name:
+    __scheduler.update(name=name, backend=scheduler.create_scheduler(name))
+  return __scheduler['backend']
 
 def prepare_job(ssh_conn, basedir, jobname, cmds, mem, walltime, jobtype, projectcode):  
-  commandline = '%s ' % cluster['remote_prepare_job'] + \
+  commandline = '%s ' % get_remote_command('prepare_job') + \
     '--basedir "%s" ' % basedir + \
     '--jobname "%s" ' % jobname.replace(" ", "_") + \
     '--mem %s ' % mem + \
@@ -27,18 +87,88 @@ def prepare_job(ssh_conn, basedir, jobname, cmds, mem, walltime, jobtype, projec
   jobdir, jobscript = stdout.split(',')
   return (jobdir.strip(), jobscript.strip())
   
-def submit_job(ssh_conn, remote_job_description_file):
-  cmd = '%s %s' % (cluster['remote_submit_job'], remote_job_description_file)
-  rc, stdout, stderr = ssh.run(cmd, ssh_conn)
+def prepare_jobs(ssh_conn, basedir, records, array=False, pack_cores=None):
+  '''
+    Create the job directories and job description files for many jobs with a single remote call.
+    Each record is a dictionary with the keys jobname, cmds, mem, walltime, jobtype and projectcode.
+    Return one dictionary per record, in the same order as the records, with either the keys
+    jobdir and jobscript, or the key error if the job could not be prepared.
+    If array is True, a job array description for all prepared jobs is created as well, and the
+    dictionaries also contain the keys arrayscript and index. All records must then have the same
+    cmds, mem, walltime, jobtype and projectcode.
+    If pack_cores is specified, a task farm description is created instead: a single job with pack_cores cores,
+    that runs the prepared jobs as tasks, as many at the same time as fit in its cores. The dictionaries then
+    contain the keys packscript and index. All records must then be serial jobs with the same mem, walltime,
+    jobtype and projectcode.
+  '''
+  return get_scheduler().prepare(ssh_conn, basedir, records, array, pack_cores)
+
+def submit_job(ssh_conn, remote_job_description_file, array_indices=None, pack=False):
+  '''
+    Submit a job and return its job id.
+    If array_indices are specified, the job description file is a job array description, and the id of the
+    job array is returned. The id of an individual array task is <arrayid>_<index>.
+    If pack is True, the job description file is a task farm description, and array_indices are the indices of
+    the tasks to run. The id of an individual task is <packid>:<index>, see get_pack_task_id.
+  '''
+  return get_scheduler().submit(ssh_conn, remote_job_description_file, array_indices, pack)
+
+def get_submissions(ssh_conn, remote_job_description_files):
+  '''
+    Get the ids of the jobs that have been submitted from job description files, with a single remote call.
+    The remote submit_job records each submission next to the job description file, in <file>.submitted.
+    Return a dictionary job description file -> list of job ids. For a job array description, the list contains
+    the ids of the individual array tasks, <arrayid>_<index>, and for a task farm description the ids of its tasks,
+    <packid>:<index>. Files that have never been submitted are not listed.
+  '''
+  cmd = 'while IFS= read -r f; do if [ -f "${f}.submitted" ]; then ' + \
+        'while read -r line; do printf "%s\\t%s\\n" "${f}" "${line}"; done < "${f}.submitted"; fi; done'
+  rc, stdout, stderr = ssh.run(cmd, ssh_conn, stdin=''.join(['%s\n' % f for f in remote_job_description_files]))
   if rc != 0:
-    msg = 'Error: Failed to submit job%s' % os.linesep
+    msg = 'Error: Failed to get submitted jobs%s' % os.linesep
     msg += '%s%s%s' % (os.linesep, stderr, os.linesep)
     raise Exception(msg)
-  jobid = stdout.strip()
-  return jobid
+  submissions = {}
+  for line in stdout.splitlines():
+    jobfile, sep, submission = line.partition('\t')
+    tokens = submission.split()
+    if not tokens:
+      continue
+    if len(tokens) > 1:
+      jobids = expand_job_id('%s_[%s]' % (tokens[0], tokens[1]))
+    else:
+      jobids = expand_job_id(tokens[0])
+    submissions.setdefault(jobfile, []).extend(jobids)
+  return submissions
+
+def remove_job_directories(ssh_conn, basedir, remote_directories, concurrency=config.DEFAULT_CLEAN_CONCURRENCY):
+  '''
+    Remove remote job directories with a single remote call. The remote command clean_jobs removes only
+    directories inside basedir, and removes up to concurrency directories at the same time.
+    Return a dictionary remote directory -> error message, for the directories that could not be removed,
+    or None if the remote command clean_jobs does not exist.
+  '''
+  if not remote_directories:
+    return {}
+  cmd = '%s --basedir "%s" --concurrency %s' % (get_remote_command('clean_jobs'), basedir, concurrency)
+  rc, stdout, stderr = ssh.run(cmd, ssh_conn, stdin=''.join(['%s\n' % d for d in remote_directories]))
+  if rc == 127:
+    util.get_log().debug('remote command clean_jobs not found.')
+    return None
+  if rc != 0:
+    raise Exception('Error: Failed to remove remote job directories.%s%s%s' % (os.linesep, stderr, os.linesep))
+  lines = stdout.splitlines()
+  if len(lines) != len(remote_directories):
+    raise Exception('Expected results for %s directories, but got %s' % (len(remote_directories), len(lines)))
+  errors = {}
+  for line in lines:
+    remote_directory, result = line.split('\t', 1)
+    if result != 'ok':
+      errors[remote_directory] = result
+  return errors
   
 def has_finished(ssh_conn, jobid):
-  cmd = '%s %s' % (cluster['remote_is_job_done'], jobid)
+  cmd = '%s %s' % (get_remote_command('is_job_done'), jobid)
   rc, stdout, stderr = ssh.run(cmd, ssh_conn)
   if rc != 0:
     msg = 'Error: Failed to get job status for job %s%s' % (jobid,os.linesep)
@@ -47,7 +177,7 @@ def has_finished(ssh_conn, jobid):
   return eval(str(stdout).strip())
   
 def get_job_statuses(ssh_conn):
-  cmd = '%s' % (cluster['remote_get_job_statuses'])
+  cmd = '%s' % (get_remote_command('get_job_statuses'))
   rc, stdout, stderr = ssh.run(cmd, ssh_conn)
   if rc != 0:
     msg = 'Error: Failed to get job statuses.%s' % (os.linesep)
@@ -58,15 +188,191 @@ def get_job_statuses(ssh_conn):
     tokens = line.split(' ')
     if len(tokens) != 2:
       raise Exception('Too many columns in result from call to getting remote job statuses: "%s"' % line)
-    statusMap[tokens[0]] = tokens[1]
+    for jobid in expand_job_id(tokens[0]):
+      statusMap[jobid] = tokens[1]
   return statusMap
 
+def get_job_details(ssh_conn, jobids):
+  '''
+    Get the state of jobs with a single remote call.
+    Return a dictionary with an entry for each job id, with the keys state, reason, elapsed and node.
+    For jobs that have left the queue, the state is taken from the accounting system, and reason contains
+    the exit code. The state is STATE_UNKNOWN if the accounting system doesn't know a job (e.g. due to a
+    transient error), and STATE_GONE if the accounting system is not available.
+    In a command run by rjmd, the states are polled by rjmd, together with the jobs of other commands.
+  '''
+  jobids = list(jobids)
+  if not jobids:
+    return {}
+  if daemon.is_child():
+    return daemon.get_job_details(jobids)
+  return get_scheduler().status(ssh_conn, jobids)
+
+def get_job_accounting(ssh_conn, jobids):
+  '''
+    Get the final state of jobs that have left the queue.
+    Return a dictionary job id -> dictionary with the keys state, exit_code, elapsed and node, for the jobs that
+    have left the queue. exit_code is None if the scheduler doesn't report it.
+  '''
+  jobids = list(jobids)
+  if not jobids:
+    return {}
+  return get_scheduler().accounting(ssh_conn, jobids)
+
+def has_left_queue(state):
+  ''' return True if a job in the given state has left the queue. '''
+  return state in FINISHED_STATES
+
+class CompletionWatcher(object):
+  '''
+    Get notified about finished jobs instead of polling the scheduler.
+    The job scripts record their completion, and the remote command watch_jobs reports each job as soon as it
+    has finished, over a channel that stays open until all watched jobs have finished.
+  '''
+
+  def __init__(self, ssh_conn, remote_directories):
+    ''' start watching the jobs in the given remote job directories '''
+    self.__events = Queue.Queue()
+    self.__stopped = False
+    stdin, stdout, stderr = ssh_conn.exec_command(get_remote_command('watch_jobs'))
+    self.__channel = stdin.channel
+    stdin.write(''.join(['%s\n' % d.rstrip('/') for d in remote_directories]) + '\n')
+    stdin.flush()
+    self.__thread = threading.Thread(target=self.__read_events, args=(stdout,))
+    self.__thread.daemon = True
+    self.__thread.start()
+
+  def __read_events(self, stdout):
+    ''' queue a (remote directory, exit code) tuple for each finished job. queue None once the watcher has ended '''
+    try:
+      for line in stdout:
+        if isinstance(line, bytes) and not isinstance(line, str):
+          line = line.decode('utf-8')
+        tokens = line.strip().split('|')
+        # empty lines are heartbeats
+        if len(tokens) == 2:
+          self.__events.put((tokens[0], tokens[1]))
+    except:
+      util.get_log().debug('watching jobs failed: %s' % traceback.format_exc().strip())
+    finally:
+      self.__events.put(None)
+
+  def get_finished(self, timeout):
+    '''
+      Return a list of (remote directory, exit code) tuples of the jobs that have finished since the last call.
+      Wait up to timeout seconds for the first job to finish.
+    '''
+    finished = []
+    if self.__stopped:
+      return finished
+    try:
+      event = self.__events.get(True, max(timeout, 0))
+      while True:
+        if event is None:
+          self.__stopped = True
+          break
+        finished.append(event)
+        event = self.__events.get_nowait()
+    except Queue.Empty:
+      pass
+    return finished
+
+  def is_alive(self):
+    ''' return False once the remote watcher has ended, e.g. because all jobs have finished or the connection was lost '''
+    return not self.__stopped
+
+  def stop(self):
+    ''' stop watching '''
+    self.__stopped = True
+    try:
+      self.__channel.close()
+    except:
+      pass
+
 def cancel_jobs(ssh_conn, jobids):
   if jobids:
-    cmd = '%s %s' % (cluster['remote_cancel_jobs'], ' '.join(jobids))
+    cmd = '%s %s' % (get_remote_command('cancel_jobs'), ' '.join(["'%s'" % jobid for jobid in compress_job_ids(jobids)]))
     rc, stdout, stderr = ssh.run(cmd, ssh_conn)
     if rc != 0:
       msg = 'Error: Failed to cancel jobs.%s' % (os.linesep)
       msg += '%s%s%s' % (os.linesep, stderr, os.linesep)
       raise Exception(msg)
-    
+
+def cancel_batch(ssh_conn, jobids, arrayids=[], name_prefixes=[], wait_s=config.CANCEL_WAIT_S):
+  '''
+    Cancel jobs with a single remote call. The remote command cancel_batch reads the jobs from stdin and
+    cancels them in chunks, and waits up to wait_s seconds for them to leave the queue.
+    Besides jobs by id, all tasks of job arrays can be cancelled by the id of the array, and all jobs of the user
+    whose name starts with a prefix by the prefix. The name of a job is the name of its remote job directory.
+    Return a dictionary job id -> outcome, with an entry for each cancelled job: CANCEL_CANCELLED,
+    CANCEL_REQUESTED, CANCEL_FINISHED, or 'error: <message>'. Return None if the remote command
+    cancel_batch does not exist.
+  '''
+  return get_scheduler().cancel(ssh_conn, jobids, arrayids, name_prefixes, wait_s)
+
+
+def format_index_ranges(indices):
+  ''' format a list of array indices as ranges, e.g. [0,1,2,3,5] as 0-3,5 '''
+  ranges = []
+  for index in sorted(set(int(i) for i in indices)):
+    if ranges and ranges[-1][1] == index - 1:
+      ranges[-1][1] = index
+    else:
+      ranges.append([index, index])
+  return ','.join([('%s' % first) if first == last else ('%s-%s' % (first, last)) for first, last in ranges])
+
+def expand_job_id(jobid):
+  '''
+    Return the list of job ids that a job id as reported by the scheduler stands for.
+    For the pending tasks of a Slurm job array, e.g. 1234_[0-2,5%10], these are the ids of the individual
+    tasks: 1234_0, 1234_1, 1234_2 and 1234_5. Likewise for the tasks of a task farm, e.g. 1234:[0-2].
+    Any other job id stands only for itself.
+  '''
+  match = array_task_pattern.match(jobid)
+  separator = '_'
+  if not match:
+    match = pack_task_pattern.match(jobid)
+    separator = ':'
+  if not match or not match.group(2).startswith('['):
+    return [jobid]
+  jobids = []
+  for r in match.group(2).strip('[]').split('%')[0].split(','):
+    first, sep, last = r.partition('-')
+    for index in range(int(first), int(last or first) + 1):
+      jobids.append('%s%s%s' % (match.group(1), separator, index))
+  return jobids
+
+def compress_job_ids(jobids):
+  '''
+    Combine the ids of tasks of the same Slurm job array, e.g. 1234_0, 1234_1 and 1234_3 into 1234_[0-1,3].
+    The tasks of a task farm can only be cancelled together, so their ids are combined into the id of the task farm.
+    Other job ids are returned unchanged.
+  '''
+  result = []
+  arrays = {}
+  for jobid in jobids:
+    packid = get_pack_id(jobid)
+    if packid:
+      if packid not in result:
+        result.append(packid)
+      continue
+    match = array_task_pattern.match(jobid)
+    if match and not match.group(2).startswith('['):
+      if match.group(1) not in arrays:
+        arrays[match.group(1)] = []
+        result.append(match.group(1))
+      arrays[match.group(1)].append(match.group(2))
+    else:
+      result.append(jobid)
+  return [('%s_[%s]' % (jobid, format_index_ranges(arrays[jobid]))) if jobid in arrays else jobid for jobid in result]
+
+def get_pack_task_id(packid, index):
+  ''' get the job id of a task of a task farm '''
+  return '%s:%s' % (packid, index)
+
+def get_pack_id(jobid):
+  ''' get the id of the task farm of a task of a task farm, or None if the job is not a task of a task farm '''
+  match = pack_task_pattern.match(jobid)
+  if not match or match.group(2).startswith('['):
+    return None
+  return match.group(1)
@@ -0,0 +1,99 @@
+'''
+Journal of the phases of the jobs of a batch while it is submitted, so that an interrupted submission can be resumed.
+Each job goes through the phases prepared (remote job directory and job description created), uploaded (input files
+staged in) and submitted. A phase is appended to the journal as one JSON object per line, together with what is
+needed to continue from there, e.g. the remote job directory.
+'''
+import os
+import json
+import hashlib
+import threading
+import cer.client.util as util
+import cer.client.util.config as config
+
+PHASE_PREPARED = 'prepared'
+PHASE_UPLOADED = 'uploaded'
+PHASE_SUBMITTED = 'submitted'
+
+def get_journal_file(batch):
+  ''' get the name of the journal file of a batch, see store.get_batch_name '''
+  name = hashlib.sha1(batch if isinstance(batch, bytes) else batch.encode('utf-8')).hexdigest()
+  return os.path.join(config.get_config_dir(), config.JOURNAL_DIR_NAME, '%s.log' % name)
+
+class SubmissionJournal(object):
+  '''
+    Records are written in groups: once group_size records are pending or the oldest pending record is flush_interval_s
+    seconds old, and whenever flush() is called. A group is written with a single write and fsync.
+    If the process dies, only the phases of the last group may be lost.
+    Only the jobs of a resumed journal are kept in memory, so that the journal of a batch of any size can be written.
+  '''
+
+  def __init__(self, filename, resume=False, group_size=config.JOURNAL_GROUP_SIZE, flush_interval_s=config.JOURNAL_FLUSH_INTERVAL_S):
+    self.filename = filename
+    self.group_size = group_size
+    self.flush_interval_s = flush_interval_s
+    self.lock = threading.Lock()
+    self.jobs = {}
+    self.pending = []
+    self.timer = None
+    if not os.path.isdir(os.path.dirname(filename)):
+      os.makedirs(os.path.dirname(filename))
+    if resume and os.path.isfile(filename):
+      self._replay()
+    self.f = open(filename, 'a' if resume else 'w')
+
+  def get(self, localdir):
+    '''
+      get the last recorded phase of a job of the resumed journal, as dictionary with the key phase and the properties
+      recorded so far, or None if the job is not in the resumed journal
+    '''
+    with self.lock:
+      return self.jobs.get(os.path.abspath(localdir))
+
+  def record(self, localdir, phase, **props):
+    ''' record that a job has completed a phase '''
+    localdir = os.path.abspath(localdir)
+    with self.lock:
+      if localdir in self.jobs:
+        self.jobs[localdir] = dict(self.jobs[localdir], phase=phase, **props)
+      self.pending.append('%s\n' % json.dumps(dict(props, localdir=localdir, phase=phase)))
+      if len(self.pending) >= self.group_size:
+        self._flush()
+      elif self.timer is None:
+        self.timer = threading.Timer(self.flush_interval_s, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+  def flush(self):
+    ''' write all pending records '''
+    with self.lock:
+      self._flush()
+
+  def close(self):
+    ''' write all pending records and close the journal '''
+    with self.lock:
+      self._flush()
+      self.f.close()
+
+  def _flush(self):
+    if self.timer:
+      self.timer.cancel()
+      self.timer = None
+    if not self.pending or self.f.closed:
+      return
+    self.f.write(''.join(self.pending))
+    self.f.flush()
+    os.fsync(self.f.fileno())
+    self.pending = []
+
+  def _replay(self):
+    ''' read the phases of the jobs from the journal file. an incomplete last line, if the process died while writing it, is ignored '''
+    with open(self.filename) as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          util.get_log().debug('ignoring incomplete record in journal %s: %s' % (self.filename, line.strip()))
+          continue
+        localdir = record.pop('localdir')
+        self.jobs[localdir] = dict(self.jobs.get(localdir, {}), **record)
@@ -0,0 +1,70 @@
+import re
+import random
+import cer.client.util.config as config
+import cer.client.job as job
+
+# durations as used by Slurm for walltimes and elapsed times:
+# minutes, minutes:seconds, hours:minutes:seconds, days-hours, days-hours:minutes, days-hours:minutes:seconds
+duration_pattern = re.compile(r'^(?:(\d+)-)?(\d+)(?::(\d+))?(?::(\d+))?$')
+
+def get_seconds(duration):
+  ''' convert a duration to seconds. return None if the duration is not specified or can't be parsed. '''
+  m = duration_pattern.match(str(duration or '').strip())
+  if not m:
+    return None
+  days, a, b, c = m.groups()
+  if days is not None:
+    hours, minutes, seconds = a, b, c
+  elif c is not None:
+    hours, minutes, seconds = a, b, c
+  else:
+    hours, minutes, seconds = 0, a, b
+  return ((int(days or 0) * 24 + int(hours or 0)) * 60 + int(minutes or 0)) * 60 + int(seconds or 0)
+
+class PollScheduler(object):
+  '''
+    Decide how long to wait before the next status poll, based on the states of the jobs waited for.
+    - While all jobs are pending, the interval doubles with each poll, up to max_interval_s.
+    - If a running job reaches its walltime before the next poll, the poll is brought forward to just after that.
+    - After failed polls, the interval doubles with each failure, up to max_interval_s, with random jitter
+      so that many clients don't retry in lockstep.
+  '''
+
+  def __init__(self, interval_s, max_interval_s=None):
+    self.interval_s = float(interval_s)
+    if max_interval_s is None:
+      max_interval_s = self.interval_s * config.MAX_POLLING_BACKOFF_FACTOR
+    self.max_interval_s = max(float(max_interval_s), self.interval_s)
+    self.pending_polls = 0
+    self.failed_polls = 0
+
+  def next_interval(self, details, walltimes={}):
+    '''
+      Return the number of seconds to wait after a successful poll.
+      details is the result of job.get_job_details for the jobs still waited for.
+      walltimes maps job ids to the walltime of the job in seconds.
+    '''
+    self.failed_polls = 0
+    states = [d['state'] for d in details.values()]
+    if states and all([state in job.PENDING_STATES for state in states]):
+      self.pending_polls += 1
+      interval = min(self.interval_s * 2 ** self.pending_polls, self.max_interval_s)
+    else:
+      self.pending_polls = 0
+      interval = self.interval_s
+    for jobid, d in details.items():
+      if d['state'] not in job.RUNNING_STATES:
+        continue
+      walltime = walltimes.get(jobid)
+      elapsed = get_seconds(d['elapsed'])
+      if walltime is None or elapsed is None:
+        continue
+      remaining = walltime - elapsed + config.WALLTIME_GRACE_S
+      interval = min(interval, max(remaining, config.MIN_POLLING_INTERVAL_S))
+    return interval
+
+  def error_interval(self):
+    ''' return the number of seconds to wait after a failed poll. '''
+    self.failed_polls += 1
+    upper = min(self.interval_s * 2 ** self.failed_polls, self.max_interval_s)
+    return random.uniform(self.interval_s, upper)
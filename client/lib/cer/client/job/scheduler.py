@@ -0,0 +1,287 @@
+'''
+  Scheduler backends.
+
+  A backend knows how jobs are prepared, submitted, queried, cancelled and accounted for by one kind of scheduler.
+  All backends drive the scheduler through the remote commands installed on the cluster with
+  server/install <scheduler> (server/bin/common and server/bin/<scheduler>), and report job states in the
+  vocabulary of Slurm (see the states in cer.client.job), so that the rjm tools work the same with every backend.
+
+  The backend is selected by the option scheduler in the section CLUSTER of the configuration file:
+    slurm        Slurm (default). server/bin/slurm
+    loadleveler  IBM LoadLeveler. server/bin/loadleveler. job arrays, task farms and accounting are not supported
+    local        a process pool that runs the jobs on the host rjm connects to, as many at the same time as it
+                 has cores, without queuing them, e.g. on a workstation or a fake cluster. server/bin/local
+'''
+import os
+import json
+import cer.client.util as util
+import cer.client.util.config as config
+import cer.client.ssh as ssh
+import cer.client.job as job
+
+# reads the ids of tasks of task farms, <packid>:<index>, from stdin, and prints <packid>:<index>|<exit code> for
+# each task that has started, with an empty exit code if the task hasn't finished yet. the job directories of
+# the tasks of a task farm are registered by server/bin/common/run_tasks in ~/.rjm/packs/<packid>, and a
+# finished task has left its exit code in the file .rjm_done in its job directory
+TASK_EXIT_CODES_COMMAND = """awk -F: '{
+  if (!($1 in loaded)) {
+    loaded[$1] = 1; f = ENVIRON["HOME"] "/.rjm/packs/" $1
+    while ((getline line < f) > 0) { split(line, t, "|"); dirs[$1 ":" t[1]] = t[2] }
+    close(f)
+  }
+  if ($0 in dirs) {
+    m = dirs[$0] "/.rjm_done"
+    if ((getline rc < m) <= 0) rc = ""
+    close(m); print $0 "|" rc
+  }
+}'"""
+
+class Scheduler(object):
+  '''
+    Interface of a scheduler backend, implemented with the remote commands prepare_job, submit_job,
+    get_job_details (or get_job_statuses) and cancel_batch.
+  '''
+  # name of the backend, as used for the option scheduler of the configuration file
+  name = None
+  # True if many jobs can be submitted as one job array
+  supports_arrays = True
+  # True if many jobs can be packed into one job that runs them as tasks, see server/bin/common/run_tasks
+  supports_packing = True
+
+  def prepare(self, ssh_conn, basedir, records, array=False, pack_cores=None):
+    '''
+      Create the job directories and job description files for many jobs with a single remote call.
+      Each record is a dictionary with the keys jobname, cmds, mem, walltime, jobtype and projectcode.
+      Return one dictionary per record, in the same order as the records, with either the keys
+      jobdir and jobscript, or the key error if the job could not be prepared.
+      If array is True, a job array description for all prepared jobs is created as well, and the
+      dictionaries also contain the keys arrayscript and index.
+      If pack_cores is specified, a task farm description with pack_cores cores is created instead, and the
+      dictionaries also contain the keys packscript and index.
+    '''
+    if array and not self.supports_arrays:
+      raise Exception('job arrays are not supported by %s' % self.name)
+    if pack_cores and not self.supports_packing:
+      raise Exception('task farms are not supported by %s' % self.name)
+    commandline = '%s --basedir "%s" --manifest' % (job.get_remote_command('prepare_job'), basedir)
+    if pack_cores:
+      commandline += ' --pack %s' % int(pack_cores)
+    elif array:
+      commandline += ' --array'
+    manifest = []
+    for record in records:
+      record = dict(record, jobname=record['jobname'].replace(" ", "_"))
+      manifest.append('%s\n' % json.dumps(record))
+
+    rc, stdout, stderr = ssh.run(commandline, ssh_conn, stdin=''.join(manifest))
+    if rc != 0:
+      msg = 'Error: Failed to prepare jobs%s' % os.linesep
+      msg += '%s%s%s' % (os.linesep, stderr, os.linesep)
+      raise Exception(msg)
+    results = [json.loads(line) for line in stdout.strip().splitlines()]
+    if len(results) != len(records):
+      raise Exception('Expected results for %s jobs, but got %s' % (len(records), len(results)))
+    return results
+
+  def submit(self, ssh_conn, jobscript, array_indices=None, pack=False):
+    '''
+      Submit a job and return its job id.
+      If array_indices are specified, the job description file is a job array description, and the id of the
+      job array is returned. The id of an individual array task is <arrayid>_<index>.
+      If pack is True, the job description file is a task farm description, and array_indices are the indices
+      of the tasks to run. The id of an individual task is <packid>:<index>.
+    '''
+    if pack and not self.supports_packing:
+      raise Exception('task farms are not supported by %s' % self.name)
+    if array_indices and not pack and not self.supports_arrays:
+      raise Exception('job arrays are not supported by %s' % self.name)
+    cmd = '%s %s' % (job.get_remote_command('submit_job'), jobscript)
+    if pack:
+      cmd = '%s --pack %s %s' % (job.get_remote_command('submit_job'), jobscript, job.format_index_ranges(array_indices))
+    elif array_indices:
+      cmd = '%s %s' % (cmd, job.format_index_ranges(array_indices))
+    rc, stdout, stderr = ssh.run(cmd, ssh_conn)
+    if rc != 0:
+      msg = 'Error: Failed to submit job%s' % os.linesep
+      msg += '%s%s%s' % (os.linesep, stderr, os.linesep)
+      raise Exception(msg)
+    return stdout.strip()
+
+  def status(self, ssh_conn, jobids):
+    '''
+      Get the state of jobs with a single remote call, and another one for the tasks of task farms that have started.
+      Return a dictionary with an entry for each job id, with the keys state, reason, elapsed and node.
+      For jobs that have left the queue, the state is taken from the accounting system, and reason contains
+      the exit code. The state is STATE_UNKNOWN if the accounting system doesn't know a job (e.g. due to a
+      transient error), and STATE_GONE if the accounting system is not available.
+      A task of a task farm is in the state of its task farm until it has finished, and then COMPLETED or FAILED,
+      depending on its exit code, which is reported in reason. A task that hasn't finished when its task farm has
+      left the queue, or has been killed along with it, is in the state of the task farm, or FAILED if the task
+      farm has completed.
+    '''
+    tasks = dict([(jobid, job.get_pack_id(jobid)) for jobid in jobids if job.get_pack_id(jobid)])
+    if not tasks:
+      return self.query_status(ssh_conn, jobids)
+    details = self.query_status(ssh_conn, list(set([jobid for jobid in jobids if jobid not in tasks] + list(tasks.values()))))
+    started = [taskid for taskid, packid in tasks.items() if details[packid]['state'] not in job.PENDING_STATES]
+    exit_codes = self.task_exit_codes(ssh_conn, started) if started else {}
+    for taskid, packid in tasks.items():
+      d = dict(details[packid])
+      rc = exit_codes.get(taskid)
+      # a task that has been killed by a signal along with its task farm, e.g. when it has been cancelled
+      killed = rc and rc.isdigit() and int(rc) >= 128 and job.has_left_queue(d['state']) and d['state'] not in ['COMPLETED', 'FAILED', job.STATE_GONE]
+      if rc and not killed:
+        d.update(state='COMPLETED' if rc == '0' else 'FAILED', reason='%s:0' % rc)
+      elif job.has_left_queue(d['state']) or d['state'] == job.STATE_UNKNOWN:
+        d.update(state='FAILED' if d['state'] == 'COMPLETED' else d['state'], reason=('%s:0' % rc) if rc else '')
+      details[taskid] = d
+    return dict([(jobid, details[jobid]) for jobid in jobids])
+
+  def query_status(self, ssh_conn, jobids):
+    '''
+      Get the state of jobs with a single remote call of get_job_details, see status.
+      If the remote command get_job_details does not exist, fall back to get_job_statuses. Jobs that are
+      not queued anymore are then reported as STATE_GONE.
+    '''
+    details = {}
+    rc, stdout, stderr = ssh.run(job.get_remote_command('get_job_details'), ssh_conn, stdin='%s\n' % '\n'.join(jobids))
+    if rc == 127:
+      util.get_log().debug('remote command get_job_details not found. using get_job_statuses.')
+      return self.queue_status(ssh_conn, jobids)
+    if rc != 0:
+      msg = 'Error: Failed to get job details.%s' % (os.linesep)
+      msg += '%s%s%s' % (os.linesep, stderr, os.linesep)
+      raise Exception(msg)
+    for line in stdout.strip().splitlines(False):
+      tokens = line.split('|')
+      if len(tokens) != 5:
+        raise Exception('Unexpected number of columns in result from call to getting remote job details: "%s"' % line)
+      details[tokens[0]] = { 'state': tokens[1], 'reason': tokens[2], 'elapsed': tokens[3], 'node': tokens[4] }
+    for jobid in jobids:
+      if jobid not in details:
+        details[jobid] = { 'state': job.STATE_UNKNOWN, 'reason': '', 'elapsed': '', 'node': '' }
+    return details
+
+  def task_exit_codes(self, ssh_conn, taskids):
+    '''
+      Get the exit codes of tasks of task farms with a single remote call. Return a dictionary task id -> exit code
+      for the tasks that have started, with an empty exit code for the tasks that haven't finished yet.
+    '''
+    rc, stdout, stderr = ssh.run(TASK_EXIT_CODES_COMMAND, ssh_conn, stdin=''.join(['%s\n' % taskid for taskid in taskids]))
+    if rc != 0:
+      raise Exception('Error: Failed to get exit codes of tasks.%s%s%s' % (os.linesep, stderr, os.linesep))
+    exit_codes = {}
+    for line in stdout.splitlines():
+      taskid, sep, exit_code = line.partition('|')
+      if sep:
+        exit_codes[taskid] = exit_code.strip()
+    return exit_codes
+
+  def queue_status(self, ssh_conn, jobids):
+    ''' get the state of jobs from the queue only, with get_job_statuses. jobs that are not queued are STATE_GONE '''
+    statusMap = job.get_job_statuses(ssh_conn)
+    details = {}
+    for jobid in jobids:
+      state = self.normalize_state(statusMap.get(jobid, job.STATE_GONE))
+      details[jobid] = { 'state': state, 'reason': '', 'elapsed': '', 'node': '' }
+    return details
+
+  def normalize_state(self, state):
+    ''' translate a state as reported by the scheduler to the vocabulary of Slurm '''
+    return state
+
+  def cancel(self, ssh_conn, jobids, arrayids=[], name_prefixes=[], wait_s=config.CANCEL_WAIT_S):
+    '''
+      Cancel jobs with a single remote call. The remote command cancel_batch reads the jobs from stdin and
+      cancels them in chunks, and waits up to wait_s seconds for them to leave the queue.
+      Besides jobs by id, all tasks of job arrays can be cancelled by the id of the array, and all jobs of the user
+      whose name starts with a prefix by the prefix. The name of a job is the name of its remote job directory.
+      A task of a task farm is cancelled by cancelling its task farm, with all its tasks.
+      Return a dictionary job id -> outcome, with an entry for each cancelled job: CANCEL_CANCELLED,
+      CANCEL_REQUESTED, CANCEL_FINISHED, or 'error: <message>'. Return None if the remote command
+      cancel_batch does not exist.
+    '''
+    tasks = dict([(jobid, job.get_pack_id(jobid)) for jobid in jobids if job.get_pack_id(jobid)])
+    requested = set(jobids)
+    jobids = [jobid for jobid in jobids if jobid not in tasks]
+    jobids.extend(sorted(set([packid for packid in tasks.values() if packid not in jobids])))
+    selectors = list(jobids) + ['array %s' % arrayid for arrayid in arrayids] + ['name %s' % prefix for prefix in name_prefixes]
+    if not selectors:
+      return {}
+    cmd = '%s --wait %s' % (job.get_remote_command('cancel_batch'), int(wait_s))
+    rc, stdout, stderr = ssh.run(cmd, ssh_conn, stdin=''.join(['%s\n' % selector for selector in selectors]))
+    if rc == 127:
+      util.get_log().debug('remote command cancel_batch not found.')
+      return None
+    if rc != 0:
+      raise Exception('Error: Failed to cancel jobs.%s%s%s' % (os.linesep, stderr, os.linesep))
+    outcomes = {}
+    for line in stdout.splitlines():
+      jobid, sep, outcome = line.partition('\t')
+      if sep:
+        outcomes[jobid] = outcome
+    for taskid, packid in tasks.items():
+      if packid in outcomes:
+        outcomes[taskid] = outcomes[packid]
+    for packid in set(tasks.values()) - requested:
+      outcomes.pop(packid, None)
+    return outcomes
+
+  def accounting(self, ssh_conn, jobids):
+    '''
+      Get the final state of jobs that have left the queue.
+      Return a dictionary job id -> dictionary with the keys state, exit_code, elapsed and node, for the jobs that
+      have left the queue. exit_code is None if the scheduler doesn't report it.
+    '''
+    accounted = {}
+    for jobid, d in self.status(ssh_conn, list(jobids)).items():
+      if job.has_left_queue(d['state']):
+        accounted[jobid] = { 'state': d['state'], 'exit_code': get_exit_code(d['reason']), 'elapsed': d['elapsed'], 'node': d['node'] }
+    return accounted
+
+class SlurmScheduler(Scheduler):
+  ''' Slurm. jobs that have left the queue are looked up with sacct '''
+  name = 'slurm'
+
+class LoadLevelerScheduler(Scheduler):
+  ''' IBM LoadLeveler. only the queue is queried, with llq, so jobs that have left the queue are STATE_GONE '''
+  name = 'loadleveler'
+  supports_arrays = False
+  supports_packing = False
+
+  # states as reported by llq -> states of Slurm
+  STATES = {
+    'I': 'PENDING', 'NQ': 'PENDING', 'H': 'PENDING', 'S': 'PENDING', 'HS': 'PENDING', 'D': 'PENDING', 'P': 'PENDING',
+    'V': 'PENDING', 'VP': 'PENDING', 'ST': 'RUNNING', 'R': 'RUNNING', 'CK': 'RUNNING', 'E': 'RUNNING', 'EP': 'RUNNING',
+    'MP': 'RUNNING', 'RP': 'COMPLETING', 'CP': 'COMPLETING', 'XP': 'COMPLETING', 'C': 'COMPLETED', 'CA': 'CANCELLED',
+    'RM': 'CANCELLED', 'TX': 'FAILED', 'NR': 'FAILED', 'SX': 'FAILED', 'X': 'FAILED',
+  }
+
+  def query_status(self, ssh_conn, jobids):
+    return self.queue_status(ssh_conn, jobids)
+
+  def normalize_state(self, state):
+    return self.STATES.get(state, state)
+
+class LocalScheduler(Scheduler):
+  '''
+    Process pool on the host rjm connects to, see server/bin/local/executor. The job description files are the
+    ones of Slurm, and the jobs start as soon as cores are free. Job ids and states are the ones of Slurm.
+  '''
+  name = 'local'
+
+# backends by the name used for the option scheduler of the configuration file
+SCHEDULERS = dict([(s.name, s) for s in [SlurmScheduler, LoadLevelerScheduler, LocalScheduler]])
+# backend if the configuration file doesn't select one
+DEFAULT_SCHEDULER = SlurmScheduler.name
+
+def get_exit_code(reason):
+  ''' get the exit code of a finished job from the reason reported for it, e.g. 1 for 1:0. None if it isn't one '''
+  code = reason.split(':')[0].strip()
+  return int(code) if code.isdigit() else None
+
+def create_scheduler(name):
+  ''' create the backend of a scheduler by name '''
+  if name not in SCHEDULERS:
+    raise Exception('unknown scheduler %s. supported schedulers: %s' % (name, ', '.join(sorted(SCHEDULERS))))
+  return SCHEDULERS[name]()
@@ -0,0 +1,208 @@
+'''
+Local store of the state of jobs, shared by all rjm commands.
+Jobs are indexed by local job directory, job id, batch and state, so that the state of many jobs is loaded with a
+single query instead of reading the .job.ini file of every job. The .job.ini files are still written, as an export
+for tools that read them, but they are not read anymore once a job is in the store.
+'''
+import os
+import json
+import time
+import sqlite3
+import threading
+import traceback
+import cer.client.util as util
+import cer.client.util.config as config
+
+# states of a job in the store
+STATE_PREPARED = 'prepared'
+STATE_SUBMITTED = 'submitted'
+STATE_DOWNLOADED = 'downloaded'
+STATE_CANCELLED = 'cancelled'
+STATE_CLEANED = 'cleaned'
+
+# maximum number of host parameters of a single sqlite query
+MAX_QUERY_PARAMETERS = 500
+
+SCHEMA = [
+  '''CREATE TABLE IF NOT EXISTS jobs (
+       local_directory TEXT PRIMARY KEY,
+       batch TEXT,
+       id TEXT,
+       remote_directory TEXT,
+       state TEXT,
+       properties TEXT NOT NULL,
+       updated REAL
+     )''',
+  'CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch)',
+  'CREATE INDEX IF NOT EXISTS jobs_id ON jobs (id)',
+  'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)',
+]
+
+def get_batch_name(localjobdirfile):
+  ''' get the name of the batch of jobs listed in a local job directory file '''
+  return os.path.realpath(localjobdirfile)
+
+class JobStore(object):
+  '''
+    Jobs in the store are dictionaries in the same format as the content of .job.ini files, i.e. { 'JOB': { ... } }
+    with string values, so that commands can use either of them.
+    Updates are collected and written in a single transaction once batch_size updates are pending or the oldest
+    pending update is older than flush_interval_s, and whenever flush() is called. Only the properties, batch and
+    state that have been updated are written: they are merged into the jobs as they are in the store when the
+    transaction starts, so that several rjm commands can update the same jobs at the same time without
+    overwriting each other's updates. The .job.ini files of the updated jobs are exported after the transaction has
+    been committed. Jobs that have been written are dropped from memory,
+    and loaded again when they are updated later, so that the memory used by the store doesn't grow with the
+    number of jobs that are submitted. Likewise, jobs loaded by get_jobs are only kept until the next call of
+    get_jobs, so that reading a batch window by window only holds one window in memory.
+  '''
+
+  def __init__(self, filename=None, batch_size=config.JOB_STORE_BATCH_SIZE, flush_interval_s=config.JOB_STORE_FLUSH_INTERVAL_S):
+    self.filename = filename or os.path.join(config.get_config_dir(), config.JOB_STORE_FILE_NAME)
+    self.batch_size = batch_size
+    self.flush_interval_s = flush_interval_s
+    self.lock = threading.RLock()
+    self.jobs = {}
+    # local job directory -> updates not written yet: { 'properties': ..., 'batch': ..., 'state': ..., 'export': ... }
+    self.pending = {}
+    self.timer = None
+    self.db = sqlite3.connect(self.filename, timeout=config.JOB_STORE_TIMEOUT_S, check_same_thread=False)
+    # transactions are started and ended explicitly, see flush()
+    self.db.isolation_level = None
+    for statement in SCHEMA:
+      self.db.execute(statement)
+
+  def get_jobs(self, localdirs, batch=None):
+    '''
+      get the jobs of a list of local job directories as dictionary local job directory -> job.
+      jobs are stored by absolute path, so relative directories refer to the current working directory.
+      the jobs are loaded with one query per MAX_QUERY_PARAMETERS directories. directories that are not in the
+      store yet, e.g. because the jobs have been submitted by an earlier version of rjm, are read from their
+      .job.ini file and added to the store, to the batch if specified. directories without .job.ini file are
+      missing from the result.
+    '''
+    keys = dict([(localdir, os.path.abspath(localdir)) for localdir in localdirs])
+    with self.lock:
+      self._evict()
+      missing = [key for key in keys.values() if key not in self.jobs]
+      for chunk in util.chunks(missing, MAX_QUERY_PARAMETERS):
+        self._load('local_directory IN (%s)' % ','.join(['?'] * len(chunk)), chunk)
+      for localdir, key in keys.items():
+        if key not in self.jobs:
+          job_config_file = '%s%s.job.ini' % (localdir, os.path.sep)
+          if os.path.isfile(job_config_file):
+            util.get_log().debug('importing job config file %s into job store' % job_config_file)
+            self.update(localdir, config.read_job_config_file(job_config_file), batch=batch, export=False)
+        elif batch and self.jobs[key]['batch'] != batch:
+          self.update(localdir, {}, batch=batch, export=False)
+      return dict([(localdir, self.jobs[key]['properties']) for localdir, key in keys.items() if key in self.jobs])
+
+  def get_batch_directories(self, batch):
+    ''' get the local job directories of the jobs of a batch, e.g. of jobs generated from a template, sorted by name '''
+    with self.lock:
+      localdirs = set([row[0] for row in self.db.execute('SELECT local_directory FROM jobs WHERE batch = ?', [batch])])
+      localdirs.update([localdir for localdir in self.pending if self.jobs[localdir]['batch'] == batch])
+      return sorted(localdirs)
+
+  def get(self, localdir):
+    ''' get a single job, or None if it is not in the store '''
+    return self.get_jobs([localdir]).get(localdir)
+
+  def update(self, localdir, props_dict, batch=None, state=None, export=True):
+    '''
+      update the properties of a job, in the format of create_or_update_job_config_file, and optionally its batch
+      and state. if export is False, the .job.ini file is not rewritten for this update.
+    '''
+    localdir = os.path.abspath(localdir)
+    with self.lock:
+      if localdir not in self.jobs:
+        # the job may have been written and dropped from memory before
+        self._load('local_directory = ?', [localdir])
+      if localdir not in self.jobs:
+        self.jobs[localdir] = { 'batch': None, 'state': None, 'properties': {} }
+      changes = self.pending.setdefault(localdir, { 'properties': {}, 'batch': None, 'state': None, 'export': False })
+      for j in [self.jobs[localdir], changes]:
+        for key1 in props_dict.keys():
+          section = j['properties'].setdefault(key1, {})
+          for key2 in props_dict[key1].keys():
+            section[key2] = str(props_dict[key1][key2])
+        if batch:
+          j['batch'] = batch
+        if state:
+          j['state'] = state
+      changes['export'] = changes['export'] or export
+      if len(self.pending) >= self.batch_size:
+        self.flush()
+      elif self.timer is None:
+        self.timer = threading.Timer(self.flush_interval_s, self._flush_later)
+        self.timer.daemon = True
+        self.timer.start()
+
+  def flush(self):
+    ''' write all pending updates in a single transaction, then export the .job.ini files of the updated jobs '''
+    with self.lock:
+      if self.timer:
+        self.timer.cancel()
+        self.timer = None
+      if not self.pending:
+        return
+      # the write lock is taken before the jobs are read, so that no other process can update them in between
+      self.db.execute('BEGIN IMMEDIATE')
+      try:
+        current = {}
+        for chunk in util.chunks(list(self.pending.keys()), MAX_QUERY_PARAMETERS):
+          for localdir, batch, state, properties in self.db.execute('SELECT local_directory, batch, state, properties ' +
+              'FROM jobs WHERE local_directory IN (%s)' % ','.join(['?'] * len(chunk)), chunk):
+            current[localdir] = { 'batch': batch, 'state': state, 'properties': json.loads(properties) }
+        now = time.time()
+        rows = []
+        for localdir, changes in self.pending.items():
+          j = current.get(localdir, { 'batch': None, 'state': None, 'properties': {} })
+          for key1, section in changes['properties'].items():
+            j['properties'].setdefault(key1, {}).update(section)
+          j['batch'] = changes['batch'] or j['batch']
+          j['state'] = changes['state'] or j['state']
+          self.jobs[localdir] = j
+          props = j['properties'].get('JOB', {})
+          rows.append((localdir, j['batch'], props.get('id'), props.get('remote_directory'), j['state'],
+                       json.dumps(j['properties']), now))
+        self.db.executemany('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.db.execute('COMMIT')
+      except:
+        self.db.execute('ROLLBACK')
+        raise
+      util.get_log().debug('wrote %s jobs to job store %s' % (len(rows), self.filename))
+      pending = self.pending
+      self.pending = {}
+      for localdir in [localdir for localdir, changes in pending.items() if changes['export']]:
+        try:
+          config.write_job_config_file(localdir, self.jobs[localdir]['properties'])
+        except:
+          util.get_log().warn('failed to export job config file of %s. %s' % (localdir, traceback.format_exc().strip()))
+      for localdir in pending:
+        del self.jobs[localdir]
+
+  def close(self):
+    ''' flush pending updates and close the store '''
+    with self.lock:
+      self.flush()
+      self.db.close()
+
+  def _flush_later(self):
+    ''' flush the pending updates once the oldest of them is flush_interval_s old '''
+    try:
+      self.flush()
+    except:
+      util.get_log().warn('failed to write job store %s. %s' % (self.filename, traceback.format_exc().strip()))
+
+  def _evict(self):
+    ''' drop the jobs without pending updates from memory '''
+    for localdir in [localdir for localdir in self.jobs if localdir not in self.pending]:
+      del self.jobs[localdir]
+
+  def _load(self, where, params):
+    ''' load the jobs matching a where clause into memory. jobs with pending updates are kept as they are '''
+    for localdir, batch, state, properties in self.db.execute(
+        'SELECT local_directory, batch, state, properties FROM jobs WHERE %s' % where, params):
+      if localdir not in self.pending:
+        self.jobs[localdir] = { 'batch': batch, 'state': state, 'properties': json.loads(properties) }
@@ -0,0 +1,83 @@
+'''
+Jobs generated from a template instead of from local job directories.
+A template is a local job directory name and commands with placeholders {<name>}, which are replaced by the values
+of the parameters of each job. The parameters of the jobs are the rows of a CSV file, the cartesian product of
+ranges of values, or both, in which case every row is combined with every element of the product.
+Placeholders that are not the name of a parameter are left as they are, so that e.g. ${HOME} can still be used
+in commands.
+'''
+import re
+import csv
+import itertools
+
+# placeholder of a parameter in a template, e.g. {alpha}
+PLACEHOLDER_PATTERN = re.compile(r'\{(\w+)\}')
+# range of numbers, e.g. 0..99, 001..100 or 0..100..10
+RANGE_PATTERN = re.compile(r'^(-?\d+)\.\.(-?\d+)(?:\.\.(\d+))?$')
+
+def is_template(spec):
+  ''' return True if spec contains placeholders of parameters, e.g. runs/run_{alpha}_{beta} '''
+  return PLACEHOLDER_PATTERN.search(spec) is not None
+
+def get_placeholders(template):
+  ''' get the names of the parameters used in a template '''
+  return PLACEHOLDER_PATTERN.findall(template)
+
+def expand(template, params):
+  ''' replace the placeholders of the parameters in a template by their values '''
+  return PLACEHOLDER_PATTERN.sub(lambda m: str(params.get(m.group(1), m.group(0))), template)
+
+def parse_range(spec):
+  '''
+    Parse the values of a parameter, specified as <name>=<values>, where values is either a range of numbers
+    <first>..<last>[..<step>], with the numbers padded with zeros to the width of the bounds if a bound starts with 0,
+    or a comma-separated list of values. Return (name, list of values).
+  '''
+  if '=' not in spec:
+    raise Exception('invalid parameter range %s. expected <name>=<values>' % spec)
+  name, values = spec.split('=', 1)
+  name = name.strip()
+  if not re.match(r'^\w+$', name):
+    raise Exception('invalid parameter name %s' % name)
+  m = RANGE_PATTERN.match(values.strip())
+  if not m:
+    return (name, [value.strip() for value in values.split(',')])
+  first, last, step = m.group(1), m.group(2), int(m.group(3) or 1)
+  if step < 1:
+    raise Exception('invalid step of parameter range %s' % spec)
+  padded = [bound for bound in [first.lstrip('-'), last.lstrip('-')] if len(bound) > 1 and bound.startswith('0')]
+  width = max(len(first), len(last)) if padded else 0
+  step = step if int(last) >= int(first) else -step
+  return (name, ['%0*d' % (width, i) for i in range(int(first), int(last) + (1 if step > 0 else -1), step)])
+
+def read_parameters(filename):
+  ''' generate the rows of a CSV file with a header line of parameter names as dictionaries, one by one '''
+  with open(filename, 'r') as f:
+    for row in csv.DictReader(f):
+      yield dict([(name.strip(), (value or '').strip()) for name, value in row.items() if name])
+
+def iter_parameters(filename=None, ranges=[]):
+  '''
+    Generate the parameters of the jobs as dictionaries: the rows of the CSV file, if specified, each combined with
+    every element of the cartesian product of the ranges. see parse_range for the format of ranges.
+  '''
+  ranges = [parse_range(spec) for spec in ranges]
+  names = [name for name, values in ranges]
+  rows = read_parameters(filename) if filename else iter([{}])
+  for row in rows:
+    for values in itertools.product(*[values for name, values in ranges]):
+      yield dict(row, **dict(zip(names, values)))
+
+def iter_jobs(localdir_template, parameters):
+  '''
+    Generate (local job directory, parameters) for each element of parameters, e.g. as generated by iter_parameters.
+    Raise an exception if the local job directory template uses a parameter that is not defined.
+  '''
+  names = get_placeholders(localdir_template)
+  if not names:
+    raise Exception('local job directory template %s does not contain any parameter' % localdir_template)
+  for params in parameters:
+    undefined = [name for name in names if name not in params]
+    if undefined:
+      raise Exception('parameter %s of local job directory template %s is not defined' % (undefined[0], localdir_template))
+    yield (expand(localdir_template, params), params)
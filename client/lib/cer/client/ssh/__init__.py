@@ -7,23 +7,28 @@ import logging
 import tempfile
 import stat
 import socket
+import threading
 import cer.client.util as util
 import cer.client.util.config as config
+import cer.client.util.metrics as metrics
+from cer.client.ssh import control
 from datetime import datetime
-from Crypto.PublicKey import RSA
-from Crypto import Random
-from paramiko import SSHClient, SSHException, AutoAddPolicy, RSAKey
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
+
+# paramiko and pycrypto are imported by the functions that use them. importing them takes longer than starting
+# everything else, and commands that don't connect, e.g. with --help, or that run through rjmd, don't need them
 
 logging.getLogger('paramiko.transport').addHandler(logging.NullHandler())
 
+# connections handed out by get_connection, keyed by (host, user, port)
+__connections = {}
+# get_connection may be called from several threads, e.g. by download threads
+__connections_lock = threading.RLock()
+
 def open_connection_username_password(host, user, password, port=22):
   '''
     Open an SSH connection and return the connection object.
   '''
+  from paramiko import SSHClient, AutoAddPolicy
   try:
     client = SSHClient()
     client.set_missing_host_key_policy(AutoAddPolicy())
@@ -54,6 +59,7 @@ def __connect_with_agent(host, port, user):
     Open an SSH connection. If setting up the connection fails with 'Error reading SSH protocol banner'
     (see inline comment in code), wait a random amount of time and retry.
   '''
+  from paramiko import SSHClient, SSHException, AutoAddPolicy
   max_attempts = 10
   attempts = 0
 
@@ -122,28 +128,157 @@ def add_private_key_to_agent(ssh_priv_key):
       os.environ['SSH_ASKPASS_PASSWORD'] = ''
       os.remove(path)
 
+def get_connection(host, user, ssh_priv_key, port=22, keepalive_s=config.DEFAULT_SSH_KEEPALIVE_S,
+                   control_persist_s=config.DEFAULT_SSH_CONTROL_PERSIST_S):
+  '''
+    Return a connection to host for user. A connection that has been handed out before is reused
+    as long as it is alive, and replaced by a new one if it is dead.
+    If control_persist_s is greater than 0, the connection is shared with other rjm commands via
+    a control socket (see cer.client.ssh.control). The first command starts a master process
+    which keeps the SSH session open until it has not been used for control_persist_s seconds.
+  '''
+  with __connections_lock:
+    key = (host, user, port)
+    connection = __connections.get(key)
+    if connection is not None:
+      if is_connection_alive(connection):
+        return connection
+      util.get_log().debug('ssh connection to %s@%s is dead. reconnecting.' % (user, host))
+      close_connection(connection)
+
+    connection = None
+    use_control_socket = control_persist_s > 0 and control.is_supported()
+    if use_control_socket:
+      connection = control.connect(control.get_socket_path(host, user, port))
+    if connection is None:
+      with metrics.span('connect'):
+        connection = open_connection_ssh_agent(host, user, ssh_priv_key, port)
+      connection.get_transport().set_keepalive(keepalive_s)
+      if use_control_socket:
+        try:
+          control.start_master(host, user, ssh_priv_key, port, keepalive_s, control_persist_s)
+        except:
+          util.get_log().debug('failed to start rjm control master: %s' % sys.exc_info()[1])
+    __connections[key] = connection
+    return connection
+
+def forget_connections():
+  '''
+    Forget all connections without closing them. Used in a process forked from a process with open connections,
+    which must not use the connections of its parent.
+  '''
+  global __connections, __connections_lock
+  __connections = {}
+  __connections_lock = threading.RLock()
+
+def get_cluster_connection(conf):
+  '''
+    Return a connection to the cluster as specified in the central configuration.
+    See get_connection.
+  '''
+  cluster = conf['CLUSTER']
+  ssh_conf = conf.get('SSH', {})
+  return get_connection(cluster['remote_host'], cluster['remote_user'], cluster['ssh_priv_key_file'],
+    port=int(ssh_conf.get('port', 22)),
+    keepalive_s=int(ssh_conf.get('keepalive_s', config.DEFAULT_SSH_KEEPALIVE_S)),
+    control_persist_s=int(ssh_conf.get('control_persist_s', config.DEFAULT_SSH_CONTROL_PERSIST_S)))
+
+def is_connection_alive(connection):
+  '''
+    Return True if the SSH session of a connection is still usable.
+  '''
+  if hasattr(connection, 'is_alive'):
+    return connection.is_alive()
+  transport = connection.get_transport()
+  return transport is not None and transport.is_active()
+
 def close_connection(connection):
   '''
     Close an SSH connection.
   '''
   if connection:
+    for key in [k for k, v in __connections.items() if v is connection]:
+      del __connections[key]
     connection.close()
   
-def run(command_and_args, connection):
+def run(command_and_args, connection, stdin=None):
   '''
     Execute a command on a remote host via SSH.
     If a connection is provided, it will be used. The connection will not be closed after the remote
     command execution. Otherwise a new connection is created, and closed after the remote command execution.
+    If stdin is provided, it is sent to the remote command, followed by end-of-file.
+    stdout and stderr are read as output arrives on either of them, and stdin is written by a separate thread,
+    so a remote command that writes a lot to stderr, or writes output before it has read all of its input,
+    can't block.
   '''
-  stdout = StringIO()
-  stderr = StringIO()
+  stdout = []
+  stderr = []
+  started = time.time()
   tmpstdin, tmpstdout, tmpstderr = connection.exec_command(command_and_args)
-  stdout.write(tmpstdout.read())
-  stderr.write(tmpstderr.read())
-  rc = tmpstdout.channel.recv_exit_status()
-  return (rc, stdout.getvalue(), stderr.getvalue())
+  writer = None
+  if stdin is not None:
+    writer = threading.Thread(target=write_stdin, args=(tmpstdin, stdin))
+    writer.daemon = True
+    writer.start()
+  rc = control.relay_channel_output(tmpstdout.channel, stdout.append, stderr.append)
+  if writer:
+    writer.join()
+  metrics.remote_call('ssh', metrics.get_command_name(command_and_args), time.time() - started,
+    sent=get_input_size(stdin), received=sum([len(b) for b in stdout + stderr]))
+  return (rc, decode_output(b''.join(stdout)), decode_output(b''.join(stderr)))
+
+def put(sftp, localfile, remotefile):
+  '''
+    Upload a local file with SFTP, and record the transfer (see cer.client.util.metrics).
+    Return the attributes of the remote file.
+  '''
+  started = time.time()
+  attributes = sftp.put(localfile, remotefile)
+  metrics.remote_call('sftp', 'put', time.time() - started, sent=os.path.getsize(localfile))
+  return attributes
+
+def get(sftp, remotefile, localfile):
+  '''
+    Download a remote file with SFTP, and record the transfer (see cer.client.util.metrics).
+  '''
+  started = time.time()
+  sftp.get(remotefile, localfile)
+  metrics.remote_call('sftp', 'get', time.time() - started, received=os.path.getsize(localfile))
+
+def write_stdin(stdin_file, data):
+  '''
+    Write data to the stdin of a remote command, followed by end-of-file.
+    A remote command may exit without reading all of its input, so failing to write is not an error.
+  '''
+  try:
+    stdin_file.write(data)
+    stdin_file.flush()
+    stdin_file.channel.shutdown_write()
+  except:
+    util.get_log().debug('failed to write stdin of remote command: %s' % sys.exc_info()[1])
+
+def get_input_size(data):
+  '''
+    Return the number of bytes sent as stdin of a remote command. str is sent encoded as UTF-8, as by paramiko.
+  '''
+  if data is None:
+    return 0
+  if not isinstance(data, bytes):
+    data = data.encode('utf-8')
+  return len(data)
+
+def decode_output(data):
+  '''
+    Return the output of a remote command as str.
+  '''
+  if not isinstance(data, str):
+    data = data.decode('utf-8', 'replace')
+  return data
 
 def create_ssh_rsa_key_pair(passphrase, bits=2048):
+  from Crypto.PublicKey import RSA
+  from Crypto import Random
+  from paramiko import RSAKey
   random_generator = Random.new().read
   keypair = RSA.generate(bits, random_generator)
 
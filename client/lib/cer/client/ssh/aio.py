@@ -0,0 +1,135 @@
+'''
+  Execution of remote commands and file transfers with asyncio. Requires Python 3.5 or later, unlike the rest of
+  cer.client, which is why this module is not imported by cer.client.ssh.
+
+  Each remote command and each file transfer uses its own channel of a connection returned by
+  cer.client.ssh.get_connection, so many of them share one SSH session. The output of remote commands is read in
+  the event loop as soon as it arrives, through the file descriptor of the channel, while stdin, opening channels
+  and SFTP transfers, which paramiko only offers as blocking calls, are run in the default executor of the loop.
+
+  Example:
+    async def main(connection):
+      results = await aio.run_concurrently(lambda jobdir: aio.run('du -s %s' % jobdir, connection), jobdirs)
+    asyncio.get_event_loop().run_until_complete(main(ssh.get_cluster_connection(conf)))
+'''
+import time
+import asyncio
+import cer.client.util as util
+import cer.client.util.config as config
+import cer.client.util.metrics as metrics
+import cer.client.ssh as ssh
+from cer.client.ssh import control
+
+async def run(command_and_args, connection, stdin=None, on_stdout=None, on_stderr=None):
+  '''
+    Execute a command on a remote host via SSH, like cer.client.ssh.run. Return (rc, stdout, stderr).
+    If on_stdout or on_stderr is provided, the output of the respective stream is passed to it as bytes as soon as
+    it arrives, and not returned.
+  '''
+  loop = asyncio.get_event_loop()
+  stdout = []
+  stderr = []
+  received = [0]
+  def counted(callback):
+    def relay(data):
+      received[0] += len(data)
+      callback(data)
+    return relay
+  on_stdout = counted(on_stdout or stdout.append)
+  on_stderr = counted(on_stderr or stderr.append)
+  started = time.time()
+  tmpstdin, tmpstdout, tmpstderr = await loop.run_in_executor(None, connection.exec_command, command_and_args)
+  channel = tmpstdout.channel
+  writer = None
+  if stdin is not None:
+    writer = loop.run_in_executor(None, ssh.write_stdin, tmpstdin, stdin)
+  try:
+    rc = await relay_channel_output(channel, on_stdout, on_stderr)
+  finally:
+    if writer:
+      await writer
+    channel.close()
+  metrics.remote_call('ssh', metrics.get_command_name(command_and_args), time.time() - started,
+    sent=ssh.get_input_size(stdin), received=received[0])
+  return (rc, ssh.decode_output(b''.join(stdout)), ssh.decode_output(b''.join(stderr)))
+
+async def relay_channel_output(channel, on_stdout, on_stderr):
+  '''
+    Pass stdout and stderr of a channel to the callback functions as soon as data arrives, until the remote command
+    has finished, like cer.client.ssh.control.relay_channel_output. Return the exit status of the remote command.
+  '''
+  loop = asyncio.get_event_loop()
+  if isinstance(channel, control.ControlChannel):
+    read = lambda: channel.relay_frame(on_stdout, on_stderr)
+  else:
+    read = lambda: __read_channel(channel, on_stdout, on_stderr)
+  done = loop.create_future()
+
+  def on_readable():
+    try:
+      finished = read()
+    except Exception as e:
+      finished = e
+    if finished and not done.done():
+      done.set_result(finished)
+
+  fd = channel.fileno()
+  loop.add_reader(fd, on_readable)
+  try:
+    finished = await done
+  finally:
+    loop.remove_reader(fd)
+  if isinstance(finished, Exception):
+    raise finished
+  if channel.exit_status_ready():
+    return channel.recv_exit_status()
+  # the exit status may follow end-of-file
+  return await loop.run_in_executor(None, channel.recv_exit_status)
+
+def __read_channel(channel, on_stdout, on_stderr):
+  ''' pass the output that has arrived on a paramiko channel to the callback functions. return True at end-of-file. '''
+  while channel.recv_ready():
+    on_stdout(channel.recv(control.BUFSIZE))
+  while channel.recv_stderr_ready():
+    on_stderr(channel.recv_stderr(control.BUFSIZE))
+  return (channel.eof_received or channel.closed) and not channel.recv_ready() and not channel.recv_stderr_ready()
+
+async def put(connection, localpath, remotepath):
+  '''
+    Upload a file via SFTP, through a new SFTP session of the connection.
+  '''
+  return await asyncio.get_event_loop().run_in_executor(None, __transfer, connection, 'put', localpath, remotepath)
+
+async def get(connection, remotepath, localpath):
+  '''
+    Download a file via SFTP, through a new SFTP session of the connection.
+  '''
+  return await asyncio.get_event_loop().run_in_executor(None, __transfer, connection, 'get', remotepath, localpath)
+
+def __transfer(connection, method, source, target):
+  sftp = connection.open_sftp()
+  try:
+    return getattr(ssh, method)(sftp, source, target)
+  finally:
+    sftp.close()
+
+async def run_concurrently(func, items, concurrency=config.DEFAULT_AIO_CONCURRENCY):
+  '''
+    Await func(item) for each item, with up to concurrency calls running at the same time, like
+    cer.client.util.run_concurrently. items are consumed as calls finish, so items may be a generator.
+    Return the results in the order of items. An exception raised by func is logged and returned in place
+    of the result of the item it was raised for.
+  '''
+  results = {}
+  items = iter(enumerate(items))
+
+  async def worker():
+    for i, item in items:
+      try:
+        results[i] = await func(item)
+      except Exception as e:
+        util.get_log().error("call of function '%s' for %s failed. %s" % (getattr(func, '__name__', func), str(item), e))
+        results[i] = e
+
+  await asyncio.gather(*[worker() for i in range(max(1, int(concurrency)))])
+  return [results[i] for i in range(len(results))]
@@ -0,0 +1,519 @@
+'''
+  Sharing of an authenticated SSH session between separate rjm command invocations.
+
+  A master process owns a single paramiko Transport and listens on a local Unix domain socket
+  (the control socket). Each request on the control socket is served through a new channel on
+  that Transport, so commands started one after the other (e.g. rjm_batch_submit followed by
+  rjm_batch_wait) don't need to perform key exchange and authentication again.
+
+  Every message on the control socket is a frame: 1 byte frame type, 4 bytes payload length
+  (network byte order), payload. A client starts with a header frame, and the master replies with
+  frames carrying stdout, stderr and the exit status of the remote command. For SFTP, the master
+  acknowledges the header and then passes raw bytes through in both directions.
+'''
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import select
+import socket
+import struct
+import argparse
+import threading
+import subprocess
+import cer.client.util as util
+import cer.client.util.config as config
+try:
+  import socketserver
+except ImportError:
+  import SocketServer as socketserver
+
+# frame types
+HEADER = b'H'
+STDIN = b'I'
+STDIN_EOF = b'C'
+STDOUT = b'O'
+STDERR = b'E'
+EXIT_STATUS = b'X'
+SFTP_READY = b'S'
+ERROR = b'R'
+
+FRAME_HEADER = struct.Struct('!cI')
+BUFSIZE = 32768
+
+def is_supported():
+  ''' return True if a control socket can be used on this platform. '''
+  # the master is started as 'python -m ...', which is not possible for frozen executables
+  return hasattr(socket, 'AF_UNIX') and not getattr(sys, 'frozen', False)
+
+def get_socket_path(host, user, port):
+  ''' get the absolute path of the control socket for a (host, user, port) combination. '''
+  return '%s%sctl_%s@%s_%s.sock' % (config.get_config_dir(), os.path.sep, user, host, port)
+
+def send_frame(sock, frame_type, payload=b''):
+  ''' send a single frame. '''
+  sock.sendall(FRAME_HEADER.pack(frame_type, len(payload)) + payload)
+
+def __recv_exactly(sock, n):
+  ''' read exactly n bytes from a socket. return None if the socket is closed before. '''
+  chunks = []
+  while n > 0:
+    data = sock.recv(n)
+    if not data:
+      return None
+    chunks.append(data)
+    n -= len(data)
+  return b''.join(chunks)
+
+def recv_frame(sock):
+  ''' read a single frame. return (None, None) if the socket has been closed. '''
+  header = __recv_exactly(sock, FRAME_HEADER.size)
+  if header is None:
+    return (None, None)
+  frame_type, length = FRAME_HEADER.unpack(header)
+  payload = __recv_exactly(sock, length) if length else b''
+  if payload is None:
+    return (None, None)
+  return (frame_type, payload)
+
+def relay_channel_output(channel, on_stdout, on_stderr):
+  '''
+    Pass stdout and stderr of a channel to the callback functions as soon as data arrives,
+    until the remote command has finished. stdout and stderr are read alternately, so that a
+    remote command that produces a lot of output on one stream can't block the other stream.
+    Return the exit status of the remote command.
+  '''
+  if isinstance(channel, ControlChannel):
+    # the master reads both streams, and its frames arrive in the order it has received the output
+    while not channel.relay_frame(on_stdout, on_stderr):
+      pass
+    return channel.recv_exit_status()
+  while True:
+    select.select([channel], [], [], 1.0)
+    while channel.recv_ready():
+      on_stdout(channel.recv(BUFSIZE))
+    while channel.recv_stderr_ready():
+      on_stderr(channel.recv_stderr(BUFSIZE))
+    if ((channel.exit_status_ready() and channel.eof_received) or channel.closed) and \
+       not channel.recv_ready() and not channel.recv_stderr_ready():
+      break
+  return channel.recv_exit_status()
+
+
+class ControlChannel(object):
+  ''' client side of a remote command execution through the control socket. '''
+  def __init__(self, sock):
+    self.sock = sock
+    self.buffers = { STDOUT: bytearray(), STDERR: bytearray() }
+    self.exit_status = None
+
+  def __pump(self, callbacks=None):
+    ''' read the next frame from the master. output is passed to callbacks[stream] if given, and buffered otherwise. '''
+    frame_type, payload = recv_frame(self.sock)
+    if frame_type is None:
+      self.exit_status = -1
+      frame_type, payload = STDERR, b'connection to rjm control master lost'
+    elif frame_type == EXIT_STATUS:
+      self.exit_status = int(payload)
+    elif frame_type == ERROR:
+      self.exit_status = -1
+      frame_type = STDERR
+    if frame_type in self.buffers and payload:
+      if callbacks:
+        callbacks[frame_type](payload)
+      else:
+        self.buffers[frame_type].extend(payload)
+    if self.exit_status is not None:
+      self.close()
+
+  def fileno(self):
+    ''' the control socket, which becomes readable when the next frame arrives. '''
+    return self.sock.fileno()
+
+  def relay_frame(self, on_stdout, on_stderr):
+    '''
+      Pass buffered output, and the output of the next frame from the master, to the callback functions.
+      Return True once the remote command has finished.
+    '''
+    for stream, callback in [(STDOUT, on_stdout), (STDERR, on_stderr)]:
+      if self.buffers[stream]:
+        callback(bytes(self.buffers[stream]))
+        del self.buffers[stream][:]
+    if self.exit_status is None:
+      self.__pump({ STDOUT: on_stdout, STDERR: on_stderr })
+    return self.exit_status is not None
+
+  def __recv(self, stream, n):
+    buf = self.buffers[stream]
+    while not buf and self.exit_status is None:
+      self.__pump()
+    data = bytes(buf[:n])
+    del buf[:n]
+    return data
+
+  def recv(self, n):
+    return self.__recv(STDOUT, n)
+
+  def recv_stderr(self, n):
+    return self.__recv(STDERR, n)
+
+  def sendall(self, data):
+    send_frame(self.sock, STDIN, data)
+
+  def shutdown_write(self):
+    send_frame(self.sock, STDIN_EOF)
+
+  def exit_status_ready(self):
+    return self.exit_status is not None
+
+  def recv_exit_status(self):
+    while self.exit_status is None:
+      self.__pump()
+    return self.exit_status
+
+  def close(self):
+    try:
+      self.sock.close()
+    except:
+      pass
+
+
+class ControlChannelFile(object):
+  ''' file-like object for one stream of a ControlChannel, similar to paramiko's ChannelFile. '''
+  def __init__(self, channel, stream):
+    self.channel = channel
+    self.stream = stream
+    self.pending = b''
+
+  def read(self, size=-1):
+    chunks = [self.pending]
+    total = len(self.pending)
+    self.pending = b''
+    while size < 0 or total < size:
+      want = BUFSIZE if size < 0 else size - total
+      data = self.channel.recv(want) if self.stream == STDOUT else self.channel.recv_stderr(want)
+      if not data:
+        break
+      chunks.append(data)
+      total += len(data)
+    data = b''.join(chunks)
+    if size >= 0 and len(data) > size:
+      self.pending = data[size:]
+      data = data[:size]
+    return data
+
+  def readline(self):
+    line = self.pending
+    while b'\n' not in line:
+      data = self.channel.recv(BUFSIZE) if self.stream == STDOUT else self.channel.recv_stderr(BUFSIZE)
+      if not data:
+        break
+      line += data
+    pos = line.find(b'\n')
+    if pos >= 0:
+      self.pending = line[pos+1:]
+      line = line[:pos+1]
+    else:
+      self.pending = b''
+    return line
+
+  def __iter__(self):
+    while True:
+      line = self.readline()
+      if not line:
+        break
+      yield line
+
+  def write(self, data):
+    if not isinstance(data, bytes):
+      data = data.encode('utf-8')
+    self.channel.sendall(data)
+
+  def flush(self):
+    pass
+
+  def close(self):
+    if self.stream == STDIN:
+      self.channel.shutdown_write()
+
+
+class ControlSftpSocket(object):
+  ''' the control socket, wrapped for use by paramiko's SFTPClient in place of a Channel. '''
+  def __init__(self, sock, name):
+    self.sock = sock
+    self.name = name
+
+  def get_name(self):
+    return self.name
+
+  def recv(self, n):
+    return self.sock.recv(n)
+
+  def send(self, data):
+    return self.sock.send(data)
+
+  def sendall(self, data):
+    return self.sock.sendall(data)
+
+  def recv_ready(self):
+    return len(select.select([self.sock], [], [], 0)[0]) > 0
+
+  def settimeout(self, timeout):
+    self.sock.settimeout(timeout)
+
+  def gettimeout(self):
+    return self.sock.gettimeout()
+
+  def setblocking(self, blocking):
+    self.sock.setblocking(blocking)
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def close(self):
+    self.sock.close()
+
+
+class ControlConnection(object):
+  '''
+    Client side of the control socket.
+    Offers the subset of paramiko's SSHClient interface used by rjm: exec_command, open_sftp and close.
+  '''
+  def __init__(self, socket_path):
+    self.socket_path = socket_path
+
+  def __request(self, header):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(self.socket_path)
+      send_frame(sock, HEADER, json.dumps(header).encode('utf-8'))
+    except:
+      sock.close()
+      raise
+    return sock
+
+  def is_alive(self):
+    ''' return True if the master is reachable and its SSH session is usable. '''
+    try:
+      sock = self.__request({ 'type': 'ping' })
+    except socket.error:
+      return False
+    try:
+      frame_type, payload = recv_frame(sock)
+      return frame_type == EXIT_STATUS
+    except socket.error:
+      return False
+    finally:
+      sock.close()
+
+  def exec_command(self, command):
+    ''' execute a command on the remote host. return the stdin, stdout and stderr of the command. '''
+    channel = ControlChannel(self.__request({ 'type': 'exec', 'command': command }))
+    return (ControlChannelFile(channel, STDIN), ControlChannelFile(channel, STDOUT), ControlChannelFile(channel, STDERR))
+
+  def open_sftp(self):
+    ''' open an SFTP session on the remote host. '''
+    sock = self.__request({ 'type': 'sftp' })
+    frame_type, payload = recv_frame(sock)
+    if frame_type != SFTP_READY:
+      sock.close()
+      raise Exception('failed to open sftp session through rjm control master: %s' % payload)
+    from paramiko import SFTPClient
+    return SFTPClient(ControlSftpSocket(sock, 'sftp via %s' % self.socket_path))
+
+  def get_transport(self):
+    ''' the transport is owned by the master process. '''
+    return None
+
+  def close(self):
+    ''' nothing to do. the master keeps the SSH session open for other commands. '''
+    pass
+
+
+def connect(socket_path):
+  ''' return a ControlConnection if a master is listening on socket_path, otherwise None. '''
+  if not os.path.exists(socket_path):
+    return None
+  connection = ControlConnection(socket_path)
+  if connection.is_alive():
+    util.get_log().debug('reusing shared ssh session via %s' % socket_path)
+    return connection
+  return None
+
+def start_master(host, user, ssh_priv_key, port, keepalive_s, control_persist_s):
+  ''' start a master process in the background. the master exits when it has been idle for control_persist_s. '''
+  cmd = [sys.executable, '-m', 'cer.client.ssh.control',
+    '--host', host, '--user', user, '--key', ssh_priv_key, '--port', str(port),
+    '--keepalive', str(keepalive_s), '--persist', str(control_persist_s)]
+  devnull = open(os.devnull, 'r+b')
+  try:
+    subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+    util.get_log().debug('started rjm control master for %s@%s' % (user, host))
+  finally:
+    devnull.close()
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+  ''' serve a single request on the control socket. '''
+  def handle(self):
+    self.server.request_started()
+    try:
+      frame_type, payload = recv_frame(self.request)
+      if frame_type != HEADER:
+        return
+      header = json.loads(payload.decode('utf-8'))
+      try:
+        transport = self.server.get_transport()
+      except:
+        send_frame(self.request, ERROR, ('failed to connect: %s' % sys.exc_info()[1]).encode('utf-8'))
+        return
+      if header['type'] == 'ping':
+        send_frame(self.request, EXIT_STATUS, b'0')
+      elif header['type'] == 'exec':
+        self.__exec(transport, header['command'])
+      elif header['type'] == 'sftp':
+        self.__sftp(transport)
+    except socket.error:
+      pass
+    finally:
+      self.server.request_finished()
+
+  def __forward_stdin(self, channel):
+    ''' pass stdin frames from the client on to the remote command. '''
+    try:
+      while True:
+        frame_type, payload = recv_frame(self.request)
+        if frame_type == STDIN:
+          channel.sendall(payload)
+        elif frame_type == STDIN_EOF:
+          channel.shutdown_write()
+        else:
+          # client has gone away
+          channel.close()
+          break
+    except:
+      channel.close()
+
+  def __exec(self, transport, command):
+    channel = transport.open_session()
+    try:
+      channel.exec_command(command)
+      t = threading.Thread(target=self.__forward_stdin, args=(channel,))
+      t.daemon = True
+      t.start()
+      rc = relay_channel_output(channel,
+        lambda data: send_frame(self.request, STDOUT, data),
+        lambda data: send_frame(self.request, STDERR, data))
+      send_frame(self.request, EXIT_STATUS, str(rc).encode('utf-8'))
+    finally:
+      channel.close()
+
+  def __sftp(self, transport):
+    channel = transport.open_session()
+    try:
+      channel.invoke_subsystem('sftp')
+      send_frame(self.request, SFTP_READY)
+      while True:
+        readable, writable, exceptional = select.select([self.request, channel], [], [])
+        if self.request in readable:
+          data = self.request.recv(BUFSIZE)
+          if not data:
+            break
+          channel.sendall(data)
+        if channel in readable:
+          data = channel.recv(BUFSIZE)
+          if not data:
+            break
+          self.request.sendall(data)
+    finally:
+      channel.close()
+
+
+class MasterServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  ''' master process owning the shared SSH session. '''
+  daemon_threads = True
+
+  def __init__(self, socket_path, get_connection, control_persist_s):
+    socketserver.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+    self.get_connection = get_connection
+    self.control_persist_s = control_persist_s
+    self.lock = threading.Lock()
+    self.active_requests = 0
+    self.last_activity = time.time()
+
+  def get_transport(self):
+    ''' return the transport of the SSH session. reconnects if the session is dead. '''
+    with self.lock:
+      return self.get_connection().get_transport()
+
+  def request_started(self):
+    with self.lock:
+      self.active_requests += 1
+
+  def request_finished(self):
+    with self.lock:
+      self.active_requests -= 1
+      self.last_activity = time.time()
+
+  def is_idle(self):
+    with self.lock:
+      return self.active_requests == 0 and time.time() - self.last_activity > self.control_persist_s
+
+def __shutdown_when_idle(server):
+  while not server.is_idle():
+    time.sleep(1)
+  server.shutdown()
+
+def run_master(socket_path, get_connection, control_persist_s):
+  ''' serve requests on the control socket until the master has been idle for control_persist_s. '''
+  # connect before binding the socket, so that clients only ever see a ready master
+  get_connection()
+  if os.path.exists(socket_path):
+    if ControlConnection(socket_path).is_alive():
+      # another master is already serving this socket
+      return
+    os.remove(socket_path)
+  old_umask = os.umask(0o077)
+  try:
+    server = MasterServer(socket_path, get_connection, control_persist_s)
+  except socket.error as e:
+    if e.errno == errno.EADDRINUSE:
+      return
+    raise
+  finally:
+    os.umask(old_umask)
+  try:
+    t = threading.Thread(target=__shutdown_when_idle, args=(server,))
+    t.daemon = True
+    t.start()
+    server.serve_forever()
+  finally:
+    server.server_close()
+    try:
+      os.remove(socket_path)
+    except OSError:
+      pass
+
+def main():
+  import cer.client.ssh as ssh
+  parser = argparse.ArgumentParser(description='rjm control master. keeps an SSH session open for other rjm commands.')
+  parser.add_argument('--host', required=True, type=str)
+  parser.add_argument('--user', required=True, type=str)
+  parser.add_argument('--key', required=True, type=str)
+  parser.add_argument('--port', required=False, type=int, default=22)
+  parser.add_argument('--keepalive', required=False, type=int, default=config.DEFAULT_SSH_KEEPALIVE_S)
+  parser.add_argument('--persist', required=False, type=int, default=config.DEFAULT_SSH_CONTROL_PERSIST_S)
+  args = parser.parse_args()
+
+  def get_connection():
+    return ssh.get_connection(args.host, args.user, args.key, args.port, keepalive_s=args.keepalive, control_persist_s=0)
+
+  # make sure the control socket gets removed when the master is terminated
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+  run_master(get_socket_path(args.host, args.user, args.port), get_connection, args.persist)
+
+if __name__ == '__main__':
+  main()
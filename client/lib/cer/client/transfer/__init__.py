@@ -0,0 +1,179 @@
+import os
+import posixpath
+import threading
+import traceback
+try:
+  import queue as Queue
+except ImportError:
+  import Queue
+import cer.client.ssh as ssh
+import cer.client.util as util
+import cer.client.util.config as config
+import cer.client.util.metrics as metrics
+from cer.client.transfer import archive
+from cer.client.util import Retry
+
+class DownloadPool(object):
+  '''
+    Download files in background threads, so that the caller can go on (e.g. polling for job states)
+    while the files are downloaded.
+    Each thread keeps its own SFTP session over the shared SSH connection. Files are written to a
+    temporary file first, and renamed once the download has finished. Each file is retried on its own.
+    Alternatively, the files of many jobs can be downloaded as a single tar stream (see archive).
+  '''
+
+  def __init__(self, get_connection, concurrency, max_attempts, min_wait_s, max_wait_s, queue_size=config.DOWNLOAD_QUEUE_SIZE):
+    '''
+      get_connection is called by a thread to get the SSH connection to download through.
+      the queue holds up to queue_size files or archives.
+    '''
+    self.get_connection = get_connection
+    self.tasks = Queue.Queue(queue_size)
+    self.thread_data = threading.local()
+    retry = Retry(max_attempts, min_wait_s, max_wait_s)
+    self.download_file = retry(self.__download_file)
+    self.download_archive = retry(self.__download_archive)
+    self.pending = 0
+    self.condition = threading.Condition()
+    self.threads = [threading.Thread(target=self.__work) for i in range(max(1, int(concurrency)))]
+    for t in self.threads:
+      t.daemon = True
+      t.start()
+
+  def __get_sftp(self):
+    ''' get the SFTP session of the current thread '''
+    if getattr(self.thread_data, 'sftp', None) is None:
+      self.thread_data.sftp = self.get_connection().open_sftp()
+    return self.thread_data.sftp
+
+  def __close_sftp(self):
+    ''' close the SFTP session of the current thread '''
+    sftp = getattr(self.thread_data, 'sftp', None)
+    self.thread_data.sftp = None
+    if sftp is not None:
+      try:
+        sftp.close()
+      except:
+        pass
+
+  def __download_file(self, remotefile, localfile):
+    ''' download an individual file. '''
+    util.get_log().debug('downloading remote file %s to local file %s' % (remotefile, localfile))
+    localtempfile = util.get_temp_file_name(localfile)
+    try:
+      ssh.get(self.__get_sftp(), remotefile, localtempfile)
+    except:
+      # the next attempt gets a new session, in case this one is broken
+      self.__close_sftp()
+      raise
+    util.rename_file(localtempfile, localfile)
+
+  def __download_archive(self, jobs, compress):
+    ''' download the files of several jobs as a single archive. '''
+    util.get_log().debug('downloading archive of %s jobs' % len(jobs))
+    return archive.download_archive(self.get_connection(), jobs, compress)
+
+  def __work(self):
+    ''' run queued tasks until None is queued '''
+    while True:
+      item = self.tasks.get()
+      if item is None:
+        break
+      task, on_done = item
+      result = task()
+      try:
+        on_done(result)
+      except:
+        util.get_log().error('failed to finish download: %s' % traceback.format_exc().strip())
+      with self.condition:
+        self.pending -= 1
+        self.condition.notify_all()
+    self.__close_sftp()
+
+  def __queue(self, task, on_done):
+    ''' queue a task. on_done is called with the result of the task '''
+    with self.condition:
+      self.pending += 1
+    self.tasks.put((task, on_done))
+
+  def download(self, files, on_done=None):
+    '''
+      Queue files for download. files is a list of (remote file, local file) tuples.
+      Once all files have been downloaded or have failed, on_done is called from a download thread, with the
+      list of remote files that failed.
+      Block while the queue is full.
+    '''
+    files = list(files)
+    state = { 'remaining': len(files), 'failed': [] }
+    lock = threading.Lock()
+    if not files:
+      if on_done:
+        on_done([])
+      return
+
+    def download_file(remotefile, localfile):
+      try:
+        with metrics.job(os.path.dirname(localfile)):
+          with metrics.span('stage_out'):
+            self.download_file(remotefile, localfile)
+        return None
+      except:
+        util.get_log().warn('failed to download file %s to %s' % (remotefile, localfile))
+        return remotefile
+
+    def file_done(failed):
+      with lock:
+        if failed:
+          state['failed'].append(failed)
+        state['remaining'] -= 1
+        finished = state['remaining'] == 0
+      if finished and on_done:
+        on_done(state['failed'])
+
+    for remotefile, localfile in files:
+      self.__queue(lambda r=remotefile, l=localfile: download_file(r, l), file_done)
+
+  def download_archives(self, jobs, compress=False, on_done=None):
+    '''
+      Queue the files of several jobs for download as archives, one archive per remote parent directory
+      (see archive.download_archive). jobs is a list of (remote job directory, names of files relative to it,
+      local job directory) tuples.
+      Once the archive of a job has been downloaded or has failed, on_done is called from a download thread
+      for each job of the archive, with the local job directory and the list of names of files that failed.
+      Block while the queue is full.
+    '''
+    groups = {}
+    for job in jobs:
+      if job[1]:
+        groups.setdefault(posixpath.dirname(job[0].rstrip('/')), []).append(job)
+      elif on_done:
+        on_done(job[2], [])
+
+    def download_archive(group):
+      try:
+        with metrics.span('stage_out'):
+          return self.download_archive(group, compress)
+      except:
+        util.get_log().warn('failed to download archive of %s jobs' % len(group))
+        return dict([(localdir, list(names)) for remotedir, names, localdir in group])
+
+    def archive_done(group, failed):
+      if on_done:
+        for remotedir, names, localdir in group:
+          on_done(localdir, failed.get(localdir, []))
+
+    for group in groups.values():
+      self.__queue(lambda g=group: download_archive(g), lambda failed, g=group: archive_done(g, failed))
+
+  def wait(self):
+    ''' wait until all queued files have been processed '''
+    with self.condition:
+      while self.pending > 0:
+        self.condition.wait(1)
+
+  def close(self):
+    ''' stop the download threads, once all queued files have been processed '''
+    for t in self.threads:
+      self.tasks.put(None)
+    for t in self.threads:
+      t.join()
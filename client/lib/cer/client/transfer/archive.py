@@ -0,0 +1,132 @@
+import os
+import shutil
+import tarfile
+import posixpath
+import time
+import threading
+try:
+  from shlex import quote
+except ImportError:
+  from pipes import quote
+import cer.client.util as util
+import cer.client.util.metrics as metrics
+
+def get_create_command(parent, compress=False):
+  '''
+    Get the command that writes a tar archive of files to stdout. The names of the files, relative to parent,
+    are read from stdin, separated by null characters. Files that don't exist are skipped.
+    Hard links are stored as regular files, so that each file can be extracted on its own.
+  '''
+  return 'tar -c%sf - --ignore-failed-read --hard-dereference --null -C %s -T -' % ('z' if compress else '', quote(parent))
+
+def get_extract_command(parent, compress=False):
+  ''' get the command that extracts a tar archive read from stdin into parent '''
+  return 'tar -x%sf - -C %s' % ('z' if compress else '', quote(parent))
+
+def upload_archive(ssh_conn, jobs, compress=False):
+  '''
+    Upload the files of several jobs as a single tar stream, extracted on the fly by tar on the cluster.
+    jobs is a list of (local files, remote job directory) tuples. All remote job directories must be in the
+    same parent directory. The files are extracted into the remote job directory without subdirectories.
+    A local file that is used by several jobs is sent only once. The other jobs get a hard link to it.
+  '''
+  parent = posixpath.dirname(jobs[0][1].rstrip('/'))
+  for localfiles, remotedir in jobs:
+    if posixpath.dirname(remotedir.rstrip('/')) != parent:
+      raise Exception('remote job directories of an archive must be in the same directory: %s' % remotedir)
+    for localfile in localfiles:
+      if not os.path.isfile(localfile):
+        raise Exception('file does not exist: %s' % localfile)
+
+  started = time.time()
+  stdin, stdout, stderr = ssh_conn.exec_command(get_extract_command(parent, compress))
+  # member name of each local file that has been sent, by real path of the local file
+  sent = {}
+  size = 0
+  tar = tarfile.open(fileobj=stdin, mode='w|gz' if compress else 'w|')
+  for localfiles, remotedir in jobs:
+    for localfile in localfiles:
+      name = posixpath.join(posixpath.basename(remotedir.rstrip('/')), os.path.basename(localfile))
+      realpath = os.path.realpath(localfile)
+      if realpath in sent:
+        util.get_log().debug('adding %s as link to %s' % (name, sent[realpath]))
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.LNKTYPE
+        info.linkname = sent[realpath]
+        tar.addfile(info)
+      else:
+        util.get_log().debug('adding %s as %s' % (localfile, name))
+        info = tar.gettarinfo(localfile, name)
+        with open(localfile, 'rb') as f:
+          tar.addfile(info, f)
+        sent[realpath] = name
+        size += info.size
+  tar.close()
+  stdin.channel.shutdown_write()
+  rc = stdout.channel.recv_exit_status()
+  metrics.remote_call('ssh', 'tar', time.time() - started, sent=size)
+  if rc != 0:
+    raise Exception('extracting archive in %s failed (exit code %s): %s' % (parent, rc, stderr.read()))
+
+def download_archive(ssh_conn, jobs, compress=False):
+  '''
+    Download the files of several jobs as a single tar stream, created on the fly by tar on the cluster.
+    jobs is a list of (remote job directory, names of files relative to it, local job directory) tuples.
+    All remote job directories must be in the same parent directory. The files are extracted into the
+    local job directory without subdirectories. Each file is written to a temporary file first, and renamed
+    once it is complete.
+    Return a dictionary local job directory -> list of names of the files that have not been received.
+  '''
+  parent = posixpath.dirname(jobs[0][0].rstrip('/'))
+  # member name in the archive -> (local job directory, file name)
+  expected = {}
+  for remotedir, names, localdir in jobs:
+    if posixpath.dirname(remotedir.rstrip('/')) != parent:
+      raise Exception('remote job directories of an archive must be in the same directory: %s' % remotedir)
+    for name in names:
+      expected[posixpath.join(posixpath.basename(remotedir.rstrip('/')), name)] = (localdir, name)
+
+  started = time.time()
+  stdin, stdout, stderr = ssh_conn.exec_command(get_create_command(parent, compress))
+
+  # tar reads the names while it writes the archive. write them in a separate thread, so that neither side blocks
+  def write_names():
+    try:
+      stdin.write(''.join(['%s\0' % member for member in sorted(expected)]))
+      stdin.flush()
+    finally:
+      stdin.channel.shutdown_write()
+  writer = threading.Thread(target=write_names)
+  writer.daemon = True
+  writer.start()
+
+  received = set()
+  size = 0
+  tar = tarfile.open(fileobj=stdout, mode='r|gz' if compress else 'r|')
+  for member in tar:
+    if not member.isfile() or member.name not in expected:
+      continue
+    localdir, name = expected[member.name]
+    localfile = os.path.join(localdir, posixpath.basename(name))
+    localtempfile = util.get_temp_file_name(localfile)
+    util.get_log().debug('extracting %s to %s' % (member.name, localfile))
+    with open(localtempfile, 'wb') as f:
+      shutil.copyfileobj(tar.extractfile(member), f)
+    util.rename_file(localtempfile, localfile)
+    received.add(member.name)
+    size += member.size
+  tar.close()
+  # the end of the archive may be followed by padding
+  stdout.read()
+  writer.join()
+  rc = stdout.channel.recv_exit_status()
+  metrics.remote_call('ssh', 'tar', time.time() - started, received=size)
+  if rc != 0:
+    raise Exception('creating archive in %s failed (exit code %s): %s' % (parent, rc, stderr.read()))
+
+  failed = {}
+  for member, (localdir, name) in expected.items():
+    if member not in received:
+      util.get_log().warn('file %s was not found in the remote job directory' % name)
+      failed.setdefault(localdir, []).append(name)
+  return failed
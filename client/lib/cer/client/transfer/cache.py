@@ -0,0 +1,87 @@
+import os
+import hashlib
+import binascii
+import posixpath
+import cer.client.ssh as ssh
+import cer.client.job as job
+import cer.client.util as util
+
+# name of the directory in the remote base directory that contains the cached files, named by their hash
+CACHE_DIR_NAME = '.rjm_cache'
+# mode of the cached files. they are hard-linked into the job directories, so that a job that writes to an input
+# file in place fails instead of changing the cached file for all jobs that use it
+CACHE_FILE_MODE = 0o444
+
+# hashes of local files, by (real path, size, modification time)
+__hashes = {}
+
+def get_cache_dir(basedir):
+  ''' get the remote directory of the cache of a remote base directory '''
+  return posixpath.join(basedir, CACHE_DIR_NAME)
+
+def get_hash(localfile):
+  ''' get the SHA-256 hash of a local file. the hash of a file is only computed once while it is not modified '''
+  st = os.stat(localfile)
+  key = (os.path.realpath(localfile), st.st_size, st.st_mtime)
+  if key not in __hashes:
+    sha = hashlib.sha256()
+    with open(localfile, 'rb') as f:
+      for block in iter(lambda: f.read(1024 * 1024), b''):
+        sha.update(block)
+    __hashes[key] = sha.hexdigest()
+  return __hashes[key]
+
+def get_missing(ssh_conn, basedir, hashes):
+  ''' return the hashes of the files that are not in the cache of the remote base directory, with a single remote call '''
+  hashes = sorted(set(hashes))
+  if not hashes:
+    return []
+  cmd = '%s --basedir "%s" missing' % (job.get_remote_command('cache_files'), basedir)
+  rc, stdout, stderr = ssh.run(cmd, ssh_conn, stdin=''.join(['%s\n' % h for h in hashes]))
+  if rc != 0:
+    raise Exception('Error: Failed to query the remote file cache.%s%s%s' % (os.linesep, stderr, os.linesep))
+  return stdout.split()
+
+def upload(sftp, localfile, basedir, digest):
+  '''
+    Upload a local file into the cache of the remote base directory.
+    The file is written to a temporary file first, made read-only and renamed once complete, so that an
+    incomplete upload never appears as cached file.
+  '''
+  cachefile = posixpath.join(get_cache_dir(basedir), digest)
+  tmpfile = posixpath.join(get_cache_dir(basedir), '.%s.%s' % (digest, binascii.b2a_hex(os.urandom(4)).decode('ascii')))
+  util.get_log().debug('uploading local file %s to remote cache file %s' % (localfile, cachefile))
+  ssh.put(sftp, localfile, tmpfile)
+  sftp.chmod(tmpfile, CACHE_FILE_MODE)
+  try:
+    sftp.posix_rename(tmpfile, cachefile)
+  except:
+    # the file may have been uploaded in the meantime, or the server doesn't support posix-rename
+    try:
+      sftp.rename(tmpfile, cachefile)
+    except:
+      sftp.remove(tmpfile)
+      sftp.stat(cachefile)
+
+def link(ssh_conn, basedir, links):
+  '''
+    Link files of the cache of the remote base directory into job directories, with a single remote call.
+    links is a list of (hash, remote file) tuples. Files are hard-linked, or symlinked if the job directory is on a
+    different file system than the cache.
+    Return a dictionary remote file -> error message, for the files that could not be linked.
+  '''
+  if not links:
+    return {}
+  cmd = '%s --basedir "%s" link' % (job.get_remote_command('cache_files'), basedir)
+  rc, stdout, stderr = ssh.run(cmd, ssh_conn, stdin=''.join(['%s\t%s\n' % link for link in links]))
+  if rc != 0:
+    raise Exception('Error: Failed to link files of the remote file cache.%s%s%s' % (os.linesep, stderr, os.linesep))
+  lines = stdout.splitlines()
+  if len(lines) != len(links):
+    raise Exception('Expected results for %s files, but got %s' % (len(links), len(lines)))
+  errors = {}
+  for line in lines:
+    remotefile, result = line.split('\t', 1)
+    if result != 'ok':
+      errors[remotefile] = result
+  return errors
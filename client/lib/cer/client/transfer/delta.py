@@ -0,0 +1,113 @@
+import os
+import json
+import struct
+import time
+import hashlib
+import threading
+try:
+  from shlex import quote
+except ImportError:
+  from pipes import quote
+import cer.client.ssh as ssh
+import cer.client.job as job
+import cer.client.util as util
+import cer.client.util.config as config
+import cer.client.util.metrics as metrics
+
+# operations of the stream sent to 'delta_files rebuild':
+# copy block <index> of the base file: COPY + index (8 bytes, big endian)
+COPY = b'C'
+# data that is not in the base file: DATA + length (4 bytes, big endian) + data
+DATA = b'D'
+# operations are written to the channel in chunks of this size
+WRITE_SIZE = 64 * 1024
+
+def get_remote_block_checksums(ssh_conn, remotefile, block_size=config.DELTA_BLOCK_SIZE):
+  ''' get the MD5 checksum of each block of a remote file, with a single remote call '''
+  cmd = '%s checksums --base %s --block-size %s' % (job.get_remote_command('delta_files'), quote(remotefile), block_size)
+  rc, stdout, stderr = ssh.run(cmd, ssh_conn)
+  if rc != 0:
+    raise Exception('Error: Failed to get block checksums of %s.%s%s%s' % (remotefile, os.linesep, stderr, os.linesep))
+  return stdout.split()
+
+def upload(ssh_conn, localfile, basefile, remotefile, digest, block_size=config.DELTA_BLOCK_SIZE, readonly=False):
+  '''
+    Upload a local file by sending only the blocks that are not in a file that already exists on the cluster,
+    e.g. an earlier version of the file uploaded for a previous job.
+    Files are compared block by block, with fixed-size blocks. A block of the local file that matches any block of
+    the base file is copied from there on the cluster, all other blocks are sent. So changes in place and appended
+    data are cheap, while inserting data shifts all following blocks, and sends them again.
+    The cluster writes the file to a temporary file, verifies its SHA-256 hash against digest, and renames it to
+    remotefile, made read-only first if readonly is True. Return the number of bytes of the local file that have
+    been sent.
+  '''
+  base_blocks = {}
+  for index, checksum in enumerate(get_remote_block_checksums(ssh_conn, basefile, block_size)):
+    base_blocks.setdefault(checksum, index)
+
+  cmd = '%s rebuild --base %s --target %s --block-size %s --sha256 %s%s' % (job.get_remote_command('delta_files'),
+    quote(basefile), quote(remotefile), block_size, digest, ' --readonly' if readonly else '')
+  started = time.time()
+  stdin, stdout, stderr = ssh_conn.exec_command(cmd)
+  sent = 0
+  ops = []
+  size = 0
+  with open(localfile, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      index = base_blocks.get(hashlib.md5(block).hexdigest())
+      if index is None:
+        ops.append(DATA + struct.pack('!I', len(block)) + block)
+        sent += len(block)
+        size += len(block) + 5
+      else:
+        ops.append(COPY + struct.pack('!Q', index))
+        size += 9
+      if size >= WRITE_SIZE:
+        stdin.write(b''.join(ops))
+        ops = []
+        size = 0
+  stdin.write(b''.join(ops))
+  stdin.flush()
+  stdin.channel.shutdown_write()
+  stdout.read()
+  error = stderr.read()
+  rc = stdout.channel.recv_exit_status()
+  metrics.remote_call('ssh', 'delta_files', time.time() - started, sent=sent)
+  if rc != 0:
+    raise Exception('Error: Failed to rebuild %s from %s.%s%s%s' % (remotefile, basefile, os.linesep, error, os.linesep))
+  return sent
+
+class UploadHistory(object):
+  '''
+    Remember where on the cluster local files have last been uploaded to, and their hash at that time,
+    so that the next upload of a file can be a delta upload against that copy.
+  '''
+
+  def __init__(self, filename=None):
+    self.filename = filename or os.path.join(config.get_config_dir(), config.UPLOAD_HISTORY_FILE_NAME)
+    self.lock = threading.Lock()
+    self.uploads = {}
+    if os.path.isfile(self.filename):
+      try:
+        with open(self.filename) as f:
+          self.uploads = json.load(f)
+      except:
+        util.get_log().warn('failed to read upload history %s. starting a new one.' % self.filename)
+
+  def get(self, localfile):
+    ''' return a dictionary with the keys remotefile and hash of the last upload of a local file, or None '''
+    with self.lock:
+      return self.uploads.get(os.path.realpath(localfile))
+
+  def record(self, localfile, remotefile, digest=None):
+    ''' record the upload of a local file '''
+    with self.lock:
+      self.uploads[os.path.realpath(localfile)] = { 'remotefile': remotefile, 'hash': digest }
+
+  def save(self):
+    ''' write the history to its file '''
+    with self.lock:
+      tmpfile = util.get_temp_file_name(self.filename)
+      with open(tmpfile, 'w') as f:
+        json.dump(self.uploads, f)
+      util.rename_file(tmpfile, self.filename)
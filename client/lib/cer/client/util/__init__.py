@@ -1,25 +1,36 @@
 import os
 import re
 import sys
+import glob
 import time
 import shlex
 import random
+import itertools
 import logging
+import threading
 import traceback
 from logging import StreamHandler, FileHandler
 from logging.handlers import MemoryHandler
 from datetime import datetime
 from subprocess import Popen, PIPE
+try:
+  from queue import Queue
+except ImportError:
+  from Queue import Queue
+from cer.client.util import metrics
 
 # default logging configuration
 FORMAT = '%(asctime)s|%(levelname)-8s|%(message)s'
 LOGGER = logging.getLogger('RJM')
 DEFAULT_LOG_LEVEL='INFO'
-LOGGER.setLevel(eval("logging.%s" % DEFAULT_LOG_LEVEL))
+LOGGER.setLevel(getattr(logging, DEFAULT_LOG_LEVEL))
 handler = StreamHandler() 
 handler.setFormatter(logging.Formatter(FORMAT))
 LOGGER.addHandler(handler)
 
+# range of numbers in a pattern of local job directories, e.g. {0..999} or {0001..1000}
+RANGE_PATTERN = re.compile(r'\{(\d+)\.\.(\d+)\}')
+
 def platform_is_windows():
   ''' return True if code runs on Windows, otherwise False. '''
   if sys.platform.lower().startswith('win'):
@@ -49,9 +60,9 @@ def run(command_and_args, error_on_stderr=True, error_on_nonzero_rc=True):
 def setup_logging(logfile, loglevel):
   ''' change default logging configuration (see above) '''
   if loglevel:
-    LOGGER.setLevel(eval("logging.%s" % loglevel.upper()))
+    LOGGER.setLevel(getattr(logging, loglevel.upper()))
   if logfile:
-    file_handler = FileHandler(filename=logfile, mode='w+b')
+    file_handler = FileHandler(filename=logfile, mode='w')
     file_handler.setFormatter(logging.Formatter(FORMAT))
     mem_handler = MemoryHandler(capacity=8192, flushLevel=logging.DEBUG, target=file_handler)
     for h in LOGGER.handlers:
@@ -83,13 +94,58 @@ class Retry(object):
           if i < self.max_attempts:
             self.log.warn("attempt #%s to call function '%s' with parameters %s failed. %s" %
                           (i, f.__name__, str(args), traceback.format_exc().strip()))
-            time.sleep(random.uniform(self.min_wait_s, self.max_wait_s))
+            wait_s = random.uniform(self.min_wait_s, self.max_wait_s)
+            metrics.retried(f.__name__, wait_s)
+            time.sleep(wait_s)
           else:
             self.log.error("attempt #%s to call function '%s' with parameters %s failed. giving up. %s" %
                            (i, f.__name__, str(args), traceback.format_exc().strip()))
             raise
     return wrapped_f
 
+def run_concurrently(func, items, concurrency):
+  ''' call func for each item, with up to concurrency calls running at the same time in separate threads.
+      items are handed to the threads through a bounded queue, so items may be a generator.
+      an exception raised by func is logged and affects only the item it was raised for.
+      return when func has been called for all items. if generating the items raises an exception, the calls
+      already started are finished before the exception is raised.
+  '''
+  concurrency = max(1, int(concurrency))
+  q = Queue(maxsize=2*concurrency)
+  done = object()
+
+  def worker():
+    while True:
+      item = q.get()
+      if item is done:
+        break
+      try:
+        func(item)
+      except:
+        get_log().error("call of function '%s' for %s failed. %s" % (func.__name__, str(item), traceback.format_exc().strip()))
+
+  threads = [threading.Thread(target=worker) for i in range(concurrency)]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  try:
+    for item in items:
+      q.put(item)
+  finally:
+    for t in threads:
+      q.put(done)
+    for t in threads:
+      t.join()
+
+def chunks(items, size):
+  ''' split items into lists of at most size items. items may be a generator. '''
+  iterator = iter(items)
+  while True:
+    chunk = list(itertools.islice(iterator, size))
+    if not chunk:
+      break
+    yield chunk
+
 def read_lines_from_file(filename):
   ''' read all lines from a file and return them as an array.
       leading and trailing whitespaces are deleted.
@@ -116,16 +172,76 @@ def read_lines_from_file(filename):
         lines.append(line.strip())
   return lines
 
+def get_temp_file_name(localfile):
+  ''' get the name of the temporary file a download is written to, before it is renamed to localfile '''
+  return os.path.join(os.path.dirname(localfile), '.%s' % os.path.basename(localfile))
+
+def rename_file(old, new):
+  ''' rename a file.
+      note, that on Windows os.rename() causes an exception if the new file already exists.
+      that's the reason for removing the existing file first.
+  '''
+  get_log().debug('renaming %s to %s' % (old, new))
+  if os.path.exists(new):
+    os.remove(new)
+  os.rename(old, new)
+  if not os.path.isfile(new):
+    raise Exception('renaming file %s to %s failed.' % (old, new))
+
 def get_local_job_directories(localjobdirfile):
-  ''' get the list of local job directories from file. '''
-  localdirs = []
-  localdirstmp = read_lines_from_file(localjobdirfile)
-  for localdir in localdirstmp:
+  ''' get the list of local job directories from file, or from a pattern, see iter_local_job_directories. '''
+  return list(iter_local_job_directories(localjobdirfile))
+
+def iter_local_job_directories(spec):
+  '''
+    Generate the local job directories of a batch one by one, so that a batch of any size can be processed
+    without reading all of its directories first. spec is one of:
+    - the name of a file that contains the names of the local job directories, one name per line.
+      the file is read as the directories are consumed.
+    - a pattern with ranges of numbers, e.g. sweep/run_{0..999999} or sweep/a{1..3}_b{01..10}. numbers are
+      padded with zeros to the width of the bounds if a bound starts with 0.
+    - a glob pattern, e.g. sweep/run_*. only directories match.
+    Directories that don't exist are skipped with a warning.
+    Raise an exception right away if spec is neither an existing file nor a pattern.
+  '''
+  if os.path.isfile(spec):
+    localdirs = __read_lines_lazily(spec)
+  elif RANGE_PATTERN.search(spec):
+    localdirs = __expand_ranges(RANGE_PATTERN.split(spec))
+  elif re.search(r'[*?[]', spec):
+    return (localdir for localdir in glob.iglob(spec) if os.path.isdir(localdir))
+  else:
+    raise Exception('file does not exist: %s' % spec)
+  return __skip_missing_directories(localdirs)
+
+def __read_lines_lazily(filename):
+  ''' generate the lines of a file without leading and trailing whitespaces. empty lines are ignored. '''
+  with open(filename, 'r') as f:
+    for line in f:
+      line = line.strip()
+      if line:
+        yield line
+
+def __expand_ranges(parts):
+  ''' generate the names of a pattern with ranges of numbers, split by RANGE_PATTERN into text, first, last, text, ... '''
+  if len(parts) == 1:
+    yield parts[0]
+    return
+  text, first, last = parts[:3]
+  padded = (len(first) > 1 and first.startswith('0')) or (len(last) > 1 and last.startswith('0'))
+  width = max(len(first), len(last)) if padded else 0
+  step = 1 if int(last) >= int(first) else -1
+  for i in itertools.islice(itertools.count(int(first), step), abs(int(last) - int(first)) + 1):
+    for rest in __expand_ranges(parts[3:]):
+      yield '%s%0*d%s' % (text, width, i, rest)
+
+def __skip_missing_directories(localdirs):
+  ''' generate the local job directories that exist '''
+  for localdir in localdirs:
     if os.path.exists(localdir):
-      localdirs.append(localdir)
+      yield localdir
     else:
       get_log().warn('local job directory does not exist: %s. Skipping.' % localdir)
-  return localdirs
 
 def get_path_to_exe(exe):
   ''' 
@@ -17,6 +17,73 @@ DEFAULT_REMOTE_HOST = 'login.uoa.nesi.org.nz'
 DEFAULT_UPLOAD = 'rjm_uploads.txt'
 # Name of the file that contains the list of files to be downloaded after the job is done
 DEFAULT_DOWNLOAD = 'rjm_downloads.txt'
+# default number of seconds between keepalive messages on an SSH session
+DEFAULT_SSH_KEEPALIVE_S = 30
+# default number of seconds a shared SSH session is kept open after it has last been used.
+# 0 disables sharing an SSH session between rjm commands
+DEFAULT_SSH_CONTROL_PERSIST_S = 600
+# default number of jobs submitted at the same time by rjm_batch_submit.
+# each job in flight uses up to 2 channels of the SSH session, and OpenSSH allows 10 by default (MaxSessions)
+DEFAULT_SUBMIT_CONCURRENCY = 4
+# number of jobs prepared with a single remote call by rjm_batch_submit, if jobs are prepared in bulk
+PREPARE_BATCH_SIZE = 500
+# number of cores of a task farm of rjm_batch_submit --pack, unless specified with --packcores
+DEFAULT_PACK_CORES = 8
+# default number of files downloaded at the same time by rjm_batch_wait, each through its own SFTP session
+DEFAULT_DOWNLOAD_CONCURRENCY = 4
+# number of seconds the cluster waits for cancelled jobs to leave the queue before rjm_batch_cancel polls them
+CANCEL_WAIT_S = 10
+# number of remote job directories removed with a single remote call by rjm_batch_clean
+CLEAN_BATCH_SIZE = 1000
+# default number of remote job directories removed at the same time on the cluster by rjm_batch_clean
+DEFAULT_CLEAN_CONCURRENCY = 8
+# default number of remote commands and file transfers run at the same time by cer.client.ssh.aio.
+# each uses a channel of the SSH session, and OpenSSH allows 10 by default (MaxSessions)
+DEFAULT_AIO_CONCURRENCY = 8
+# maximum number of files waiting for download. queuing more files blocks until downloads have finished
+DOWNLOAD_QUEUE_SIZE = 1000
+# size of the blocks compared by delta uploads. a block that differs from the remote copy is sent completely
+DELTA_BLOCK_SIZE = 256 * 1024
+# files smaller than this are always uploaded completely
+DELTA_MIN_SIZE = 1024 * 1024
+# name of the file in the configuration directory that records where local files have last been uploaded to
+UPLOAD_HISTORY_FILE_NAME = 'uploads.json'
+# name of the file in the configuration directory that stores the state of all jobs
+JOB_STORE_FILE_NAME = 'jobs.db'
+# number of job updates written to the job store in a single transaction
+JOB_STORE_BATCH_SIZE = 500
+# job updates are written to the job store at the latest after this number of seconds
+JOB_STORE_FLUSH_INTERVAL_S = 5
+# number of seconds to wait for the job store while another rjm command writes to it
+JOB_STORE_TIMEOUT_S = 60
+# number of local job directories of a batch that are read and looked up in the job store at once
+JOB_WINDOW_SIZE = 500
+# name of the directory in the configuration directory that contains the submission journals of batches
+JOURNAL_DIR_NAME = 'journals'
+# number of records written to a submission journal at once
+JOURNAL_GROUP_SIZE = 100
+# records are written to a submission journal at the latest after this number of seconds
+JOURNAL_FLUSH_INTERVAL_S = 1
+# name of the socket in the configuration directory that rjmd, the rjm daemon, listens on
+DAEMON_SOCKET_NAME = 'rjmd.sock'
+# name of the log file of rjmd in the configuration directory
+DAEMON_LOG_FILE_NAME = 'rjmd.log'
+# number of seconds to wait for a newly started rjmd to accept commands
+DAEMON_START_TIMEOUT_S = 10
+# job statuses polled by rjmd for one command are reused for other commands for at most this number of seconds
+DAEMON_MAX_STATUS_AGE_S = 10
+# rjmd polls the statuses of all jobs that any command has asked for within this number of seconds together
+DAEMON_WATCH_TTL_S = 600
+# number of seconds a command gets to exit after its client has gone away, before it is killed
+DAEMON_KILL_GRACE_S = 10
+# number of consecutive polls a job may be unknown to the scheduler before it is considered to be gone
+MAX_UNKNOWN_POLLS = 3
+# the polling interval grows up to this factor while all jobs are pending, or while polls fail
+MAX_POLLING_BACKOFF_FACTOR = 8
+# polls brought forward because a job reaches its walltime are not scheduled sooner than this
+MIN_POLLING_INTERVAL_S = 5
+# time after the walltime of a job until the scheduler is expected to have terminated it
+WALLTIME_GRACE_S = 10
 
 class ConfigReader(ConfigParser):
   def as_dict(self):
@@ -27,6 +94,9 @@ class ConfigReader(ConfigParser):
       d[k].pop('__name__', None)
     return d
 
+# the parsed configuration, and the name, modification time and size of the configuration file it has been read from
+__config_cache = {}
+
 def get_config_dir():
   ''' get the absolute path of the configuration directory. '''
   if util.platform_is_windows():
@@ -48,13 +118,20 @@ def get_pub_ssh_key():
   return '%s%s%s.pub' % (get_config_dir(), os.path.sep, SSH_PRIV_KEY)
   
 def get_config():
-  ''' return the main configuration as dictionary. '''
+  ''' return the main configuration as dictionary.
+      the configuration file is parsed once per process, and again only if it has changed since.
+  '''
   configFile = get_config_file()
   if not os.path.isfile(configFile):
     raise Exception('configuration file %s does not exist.' % configFile)
-  cr = ConfigReader();
-  cr.read(configFile)
-  return cr.as_dict()
+  st = os.stat(configFile)
+  key = (configFile, st.st_mtime, st.st_size)
+  if __config_cache.get('key') != key:
+    cr = ConfigReader();
+    cr.read(configFile)
+    __config_cache.update(key=key, config=cr.as_dict())
+  # callers may modify their copy
+  return dict([(section, dict(values)) for section, values in __config_cache['config'].items()])
 
 def create_config_dir():
   ''' create the configuration directory.
@@ -74,6 +151,7 @@ def create_config_file(host, user, fingerprint, default_project_code, default_re
   create_config_dir()
   f = open(get_config_file(), "w+")
   f.write('[CLUSTER]%s' % os.linesep)
+  f.write('scheduler=%s%s' % ('slurm', os.linesep))
   f.write('remote_host=%s%s' % (host, os.linesep))
   f.write('remote_user=%s%s' % (user, os.linesep))
   f.write('ssh_priv_key_file=%s%s' % (get_priv_ssh_key(), os.linesep))
@@ -85,6 +163,12 @@ def create_config_file(host, user, fingerprint, default_project_code, default_re
   f.write('remote_is_job_done=%s%s' % ('/share/apps/remoteapi/0.3/is_job_done', os.linesep))
   f.write('remote_get_job_statuses=%s%s' % ('/share/apps/remoteapi/0.3/get_job_statuses', os.linesep))
   f.write('remote_cancel_jobs=%s%s' % ('/share/apps/remoteapi/0.3/cancel_jobs', os.linesep))
+  f.write('remote_get_job_details=%s%s' % ('/share/apps/remoteapi/0.3/get_job_details', os.linesep))
+  f.write('remote_watch_jobs=%s%s' % ('/share/apps/remoteapi/0.3/watch_jobs', os.linesep))
+  f.write('remote_cache_files=%s%s' % ('/share/apps/remoteapi/0.3/cache_files', os.linesep))
+  f.write('remote_delta_files=%s%s' % ('/share/apps/remoteapi/0.3/delta_files', os.linesep))
+  f.write('remote_clean_jobs=%s%s' % ('/share/apps/remoteapi/0.3/clean_jobs', os.linesep))
+  f.write('remote_cancel_batch=%s%s' % ('/share/apps/remoteapi/0.3/cancel_batch', os.linesep))
   f.write('%s' % os.linesep)
   f.write('[FILE_TRANSFER]%s' % os.linesep)
   f.write('uploads_file=%s%s' % (rjm_upload, os.linesep))
@@ -94,6 +178,10 @@ def create_config_file(host, user, fingerprint, default_project_code, default_re
   f.write('max_attempts=%s%s' % ('5', os.linesep))
   f.write('min_wait_s=%s%s' % ('0.5', os.linesep))
   f.write('max_wait_s=%s%s' % ('5', os.linesep))
+  f.write('%s' % os.linesep)
+  f.write('[SSH]%s' % os.linesep)
+  f.write('keepalive_s=%s%s' % (DEFAULT_SSH_KEEPALIVE_S, os.linesep))
+  f.write('control_persist_s=%s%s' % (DEFAULT_SSH_CONTROL_PERSIST_S, os.linesep))
   f.close()
 
 def read_job_config_file(job_config_file):
@@ -124,10 +212,24 @@ def create_or_update_job_config_file(localdir, props_dict):
     if not config.has_section(key1):
       config.add_section(key1)
     for key2 in props_dict[key1].keys():
-      config.set(key1, key2, props_dict[key1][key2])
+      config.set(key1, key2, str(props_dict[key1][key2]))
   
   with open(configfile, 'w+b') as f:
     config.write(f)
   
   if not os.path.isfile(configfile):
     raise Exception("Creation or update of job config file %s failed." % configfile)
+
+def write_job_config_file(localdir, props_dict):
+  ''' write the metadata file for job in local job directory (ini-format), replacing the existing file '''
+  configfile = '%s%s.job.ini' % (localdir, os.path.sep)
+  config = ConfigParser()
+  for key1 in props_dict.keys():
+    config.add_section(key1)
+    for key2 in props_dict[key1].keys():
+      config.set(key1, key2, str(props_dict[key1][key2]))
+
+  tmpfile = util.get_temp_file_name(configfile)
+  with open(tmpfile, 'w') as f:
+    config.write(f)
+  util.rename_file(tmpfile, configfile)
@@ -0,0 +1,222 @@
+'''
+Instrumentation of the rjm commands, to find out where the time of a slow batch goes.
+
+Recorded are
+  - spans: the time spent in each phase of a command, e.g. prepare, stage_in, submit, poll or stage_out, as a
+    whole and per job.
+  - remote calls: each remote command run by cer.client.ssh.run, and each file transferred by SFTP, with its
+    duration and the number of bytes sent and received.
+  - retries: the number of failed attempts that have been retried by the Retry decorator, and the time slept
+    before the next attempt, per function.
+Remote calls and retries are attributed to the job of the current thread, see job().
+
+Nothing is recorded until enable() is called, so that long-running processes like rjmd, which never write
+metrics, don't collect them. At the end of a command, write() writes a summary with percentiles as JSON,
+or as Prometheus text file (see https://prometheus.io/docs/instrumenting/exposition_formats/) if the name of
+the file ends with .prom, e.g. for the textfile collector of the node exporter.
+
+This module must not import other modules of cer.client at import time, because cer.client.util imports it.
+'''
+import os
+import json
+import time
+import threading
+import contextlib
+
+# percentiles in summaries
+PERCENTILES = [50, 90, 99]
+# file name extension of Prometheus text files
+PROMETHEUS_EXTENSION = '.prom'
+
+__lock = threading.RLock()
+__thread_data = threading.local()
+__state = {}
+
+def reset(enabled=False):
+  ''' discard anything that has been recorded '''
+  with __lock:
+    __state.update(enabled=enabled, started=time.time(), spans={}, calls={}, retries={}, jobs={},
+                   bytes={ 'sent': 0, 'received': 0 })
+
+def enable():
+  ''' start recording, and discard anything that has been recorded before '''
+  reset(True)
+
+def disable():
+  ''' stop recording '''
+  __state['enabled'] = False
+
+def is_enabled():
+  return __state['enabled']
+
+reset()
+
+def get_command_name(command_and_args):
+  ''' get the name of the program a remote command runs, e.g. prepare_job for /path/to/prepare_job --manifest '''
+  words = command_and_args.strip().split(None, 1)
+  return os.path.basename(words[0].strip('"\'')) if words else ''
+
+@contextlib.contextmanager
+def job(localdir):
+  ''' attribute spans, remote calls and retries of the current thread to the job of a local job directory '''
+  previous = getattr(__thread_data, 'job', None)
+  __thread_data.job = localdir
+  try:
+    yield
+  finally:
+    __thread_data.job = previous
+
+@contextlib.contextmanager
+def span(phase):
+  ''' record the time spent in a phase, for the job of the current thread, if any '''
+  if not __state['enabled']:
+    yield
+    return
+  started = time.time()
+  try:
+    yield
+  finally:
+    duration = time.time() - started
+    with __lock:
+      __state['spans'].setdefault(phase, []).append(duration)
+      j = __get_job()
+      if j is not None:
+        j['phases'][phase] = j['phases'].get(phase, 0) + duration
+
+def timed(phase):
+  ''' decorator to record each call of a function as span of a phase '''
+  def decorator(f):
+    def wrapped_f(*args, **kwargs):
+      with span(phase):
+        return f(*args, **kwargs)
+    wrapped_f.__name__ = f.__name__
+    wrapped_f.__doc__ = f.__doc__
+    return wrapped_f
+  return decorator
+
+def remote_call(kind, name, duration, sent=0, received=0):
+  ''' record a remote call, e.g. kind ssh and name prepare_job, or kind sftp and name put '''
+  if not __state['enabled']:
+    return
+  with __lock:
+    __state['calls'].setdefault('%s:%s' % (kind, name), []).append(duration)
+    __state['bytes']['sent'] += sent
+    __state['bytes']['received'] += received
+    j = __get_job()
+    if j is not None:
+      j['round_trips'] += 1
+      j['bytes'] += sent + received
+
+def retried(function, sleep_s):
+  ''' record a failed attempt to call a function, which is retried after sleeping sleep_s seconds '''
+  if not __state['enabled']:
+    return
+  with __lock:
+    r = __state['retries'].setdefault(function, { 'count': 0, 'sleep_s': 0.0 })
+    r['count'] += 1
+    r['sleep_s'] += sleep_s
+    j = __get_job()
+    if j is not None:
+      j['retries'] += 1
+
+def __get_job():
+  ''' get the record of the job of the current thread, or None. must be called with the lock held '''
+  localdir = getattr(__thread_data, 'job', None)
+  if localdir is None:
+    return None
+  j = __state['jobs'].get(localdir)
+  if j is None:
+    j = __state['jobs'][localdir] = { 'phases': {}, 'round_trips': 0, 'bytes': 0, 'retries': 0 }
+  return j
+
+def percentile(values, p):
+  ''' nearest-rank percentile of a sorted list of values '''
+  return values[max(0, min(len(values) - 1, int(-(-p * len(values) // 100)) - 1))]
+
+def describe(values):
+  ''' count, sum, percentiles and maximum of a list of values '''
+  values = sorted(values)
+  d = { 'count': len(values), 'sum': sum(values) }
+  if values:
+    d.update([('p%s' % p, percentile(values, p)) for p in PERCENTILES])
+    d['max'] = values[-1]
+  return d
+
+def summary(command):
+  ''' get a summary of everything recorded since enable() as dictionary '''
+  with __lock:
+    jobs = __state['jobs']
+    phases = sorted(set([phase for j in jobs.values() for phase in j['phases']]))
+    return {
+      'command': command,
+      'started': __state['started'],
+      'wall_s': time.time() - __state['started'],
+      'phases_s': dict([(phase, describe(durations)) for phase, durations in __state['spans'].items()]),
+      'remote_calls_s': dict([(name, describe(durations)) for name, durations in __state['calls'].items()]),
+      'bytes': dict(__state['bytes']),
+      'retries': dict([(function, dict(r)) for function, r in __state['retries'].items()]),
+      'jobs': {
+        'count': len(jobs),
+        'phases_s': dict([(phase, describe([j['phases'].get(phase, 0) for j in jobs.values()])) for phase in phases]),
+        'round_trips': describe([j['round_trips'] for j in jobs.values()]),
+        'bytes': describe([j['bytes'] for j in jobs.values()]),
+        'retries': describe([j['retries'] for j in jobs.values()]),
+      },
+      'job_details': dict([(localdir, dict(j, phases=dict(j['phases']))) for localdir, j in jobs.items()]),
+    }
+
+def format_prometheus(s):
+  ''' format a summary as Prometheus text file. per-job details are only reported as percentiles '''
+  lines = []
+  command = { 'command': s['command'] }
+
+  def metric(name, kind, help, samples):
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s %s' % (name, kind))
+    for suffix, labels, value in samples:
+      lines.append('%s%s{%s} %s' % (name, suffix, ','.join(['%s="%s"' % (k, __escape(labels[k])) for k in sorted(labels)]), repr(float(value))))
+
+  def quantiles(d, labels):
+    samples = [('', dict(labels, quantile=str(p / 100.0)), d['p%s' % p]) for p in PERCENTILES if 'p%s' % p in d]
+    return samples + [('_sum', labels, d['sum']), ('_count', labels, d['count'])]
+
+  metric('rjm_phase_seconds', 'summary', 'time spent in a phase of an rjm command.',
+    [sample for phase, d in sorted(s['phases_s'].items()) for sample in quantiles(d, dict(command, phase=phase))])
+  metric('rjm_remote_call_seconds', 'summary', 'duration of remote commands and SFTP transfers.',
+    [sample for name, d in sorted(s['remote_calls_s'].items())
+     for sample in quantiles(d, dict(command, kind=name.split(':', 1)[0], name=name.split(':', 1)[1]))])
+  metric('rjm_job_phase_seconds', 'summary', 'time spent in a phase per job.',
+    [sample for phase, d in sorted(s['jobs']['phases_s'].items()) for sample in quantiles(d, dict(command, phase=phase))])
+  metric('rjm_job_round_trips', 'summary', 'remote calls per job.', quantiles(s['jobs']['round_trips'], command))
+  metric('rjm_job_bytes', 'summary', 'bytes transferred per job.', quantiles(s['jobs']['bytes'], command))
+  metric('rjm_transferred_bytes_total', 'counter', 'bytes transferred to and from the cluster.',
+    [('', dict(command, direction=direction), value) for direction, value in sorted(s['bytes'].items())])
+  metric('rjm_retries_total', 'counter', 'failed attempts that have been retried.',
+    [('', dict(command, function=function), r['count']) for function, r in sorted(s['retries'].items())])
+  metric('rjm_retry_sleep_seconds_total', 'counter', 'time slept before retrying failed attempts.',
+    [('', dict(command, function=function), r['sleep_s']) for function, r in sorted(s['retries'].items())])
+  metric('rjm_jobs', 'gauge', 'jobs that spans or remote calls have been attributed to.', [('', command, s['jobs']['count'])])
+  metric('rjm_wall_seconds', 'gauge', 'wall time of an rjm command.', [('', command, s['wall_s'])])
+  metric('rjm_last_run_timestamp_seconds', 'gauge', 'time an rjm command has started.', [('', command, s['started'])])
+  return '\n'.join(lines) + '\n'
+
+def __escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def write(filename, command):
+  '''
+    Write a summary of everything recorded since enable() to a file, as Prometheus text file if the name of the
+    file ends with .prom, otherwise as JSON. The file is replaced atomically, so that a collector never reads a
+    partially written file.
+  '''
+  s = summary(command)
+  if filename.endswith(PROMETHEUS_EXTENSION):
+    content = format_prometheus(s)
+  else:
+    content = json.dumps(s, indent=2, sort_keys=True)
+  tmpfile = os.path.join(os.path.dirname(os.path.abspath(filename)), '.%s.tmp' % os.path.basename(filename))
+  with open(tmpfile, 'w') as f:
+    f.write(content)
+  if os.path.exists(filename) and os.name == 'nt':
+    os.remove(filename)
+  os.rename(tmpfile, filename)
@@ -6,6 +6,6 @@ setup(
   description='Library for remote execution and file transfer',
   author='Martin Feller',
   author_email='m.feller@auckland.ac.nz',
-  packages=['cer', 'cer.client', 'cer.client.util', 'cer.client.ssh', 'cer.client.job'],
+  packages=['cer', 'cer.client', 'cer.client.util', 'cer.client.ssh', 'cer.client.job', 'cer.client.transfer', 'cer.client.daemon'],
   install_requires=['paramiko', 'pycrypto']
 )
@@ -0,0 +1,278 @@
+'''
+Benchmark of the rjm batch tools against a fake cluster on localhost, see fakecluster.py.
+
+A scenario creates local job directories with input files, then runs rjm_batch_submit.py, rjm_batch_wait.py and
+rjm_batch_clean.py for them, one after the other, each as a separate process like a user would. For each phase,
+it reports the wall time, the throughput, the remote commands and SFTP requests per job and the bytes transferred.
+For the wait phase, it also reports how long it took rjm to detect that a job has finished, measured from the
+end of the job script to the first access of the job directory by rjm.
+
+Example: compare the default code path with bulk preparation and the remote file cache, at 20 ms latency
+  python benchmark.py -s small-inputs -j 1000 --latency-ms 20 --json serial.json
+  python benchmark.py -s small-inputs -j 1000 --latency-ms 20 --submit-args='-b -s -n 8' --baseline serial.json
+'''
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import tempfile
+import subprocess
+import paramiko
+
+import fakecluster
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+BINDIR = os.path.join(ROOT, 'client', 'bin')
+
+# scenarios. input and output sizes are in bytes. output files are created sparse on the fake cluster
+SCENARIOS = {
+  'smoke': { 'jobs': 20, 'inputs': 2, 'input_size': 1024, 'outputs': 1, 'output_size': 1024 },
+  'small-inputs': { 'jobs': 10000, 'inputs': 5, 'input_size': 1024, 'outputs': 1, 'output_size': 1024 },
+  'large-outputs': { 'jobs': 1000, 'inputs': 1, 'input_size': 1024, 'outputs': 1, 'output_size': 1024 ** 3 },
+}
+
+# metrics compared with a baseline: True if higher is better
+METRICS = {
+  'submit.jobs_per_s': True,
+  'submit.round_trips_per_job': False,
+  'wait.detect_p50_s': False,
+  'wait.detect_p95_s': False,
+  'wait.bytes_per_s': True,
+  'wait.round_trips_per_job': False,
+  'clean.jobs_per_s': True,
+  'clean.round_trips_per_job': False,
+}
+
+h = {
+  'scenario':
+    'scenario to run: %s. the number of jobs and files can be changed with the options below.' % ', '.join(sorted(SCENARIOS)),
+  'jobs': 'number of jobs.',
+  'inputs': 'number of input files per job.',
+  'inputsize': 'size of each input file in bytes.',
+  'outputs': 'number of output files per job.',
+  'outputsize': 'size of each output file in bytes.',
+  'latency': 'round trip time of a remote command or SFTP request, in milliseconds. default: 0',
+  'bandwidth': 'bandwidth in each direction, in MB/s. default: unlimited',
+  'runtime': 'runtime of each job in seconds. default: 1',
+  'queue': 'time each job is pending before it runs, in seconds. default: 0.5',
+  'slots': 'number of job scripts the fake cluster runs at the same time. default: 8',
+  'scheduler': 'scheduler of the fake cluster: slurm, with stand-ins for the Slurm commands that run the jobs after ' +
+    'the queue time and runtime, or local, the process pool of server/bin/local, which runs the jobs as soon as they ' +
+    'are submitted, for their runtime. default: slurm',
+  'submitargs': 'additional arguments of rjm_batch_submit.py, e.g. \'-b -s -n 8\'.',
+  'waitargs': 'additional arguments of rjm_batch_wait.py, e.g. \'-e\'. default: -z 1',
+  'cleanargs': 'additional arguments of rjm_batch_clean.py.',
+  'controlpersist': 'keep the SSH session of the rjm tools open in a control master for this many seconds after its ' +
+    'last use, so that the tools share one session, and remote commands and SFTP go through the control socket. ' +
+    'default: 0 (no control master)',
+  'clientpython': 'python interpreter that runs the rjm tools. default: %s' % sys.executable,
+  'serverpython': 'python 2 interpreter that runs the python scripts of server/bin. default: python2',
+  'workdir': 'directory for the local job directories and the fake cluster. default: a temporary directory, ' +
+    'which is removed afterwards',
+  'json': 'write the results to this file as JSON.',
+  'baseline': 'compare the results with the results of an earlier run, written with --json. ' +
+    'exit with code 1 if a metric is worse than the baseline by more than the tolerance.',
+  'tolerance': 'relative change of a metric that is tolerated when comparing with a baseline. default: 0.2',
+}
+
+def percentile(values, p):
+  ''' nearest-rank percentile, or None if there are no values '''
+  if not values:
+    return None
+  values = sorted(values)
+  return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+def create_jobs(jobsdir, jobs, inputs, input_size, outputs):
+  ''' create the local job directories with their input files and lists of files to upload and download '''
+  localdirs = []
+  for i in range(jobs):
+    localdir = os.path.join(jobsdir, 'job_%06d' % i)
+    os.makedirs(localdir)
+    names = ['input_%s.dat' % n for n in range(inputs)]
+    for name in names:
+      with open(os.path.join(localdir, name), 'wb') as f:
+        f.write(os.urandom(input_size))
+    with open(os.path.join(localdir, 'rjm_uploads.txt'), 'w') as f:
+      f.write(''.join(['%s\n' % name for name in names]))
+    with open(os.path.join(localdir, 'rjm_downloads.txt'), 'w') as f:
+      f.write(''.join(['output_%s.dat\n' % n for n in range(outputs)]))
+    localdirs.append(localdir)
+  localdirfile = os.path.join(jobsdir, 'localdirs.txt')
+  with open(localdirfile, 'w') as f:
+    f.write(''.join(['%s\n' % localdir for localdir in localdirs]))
+  return localdirfile
+
+def write_client_config(home, cluster, control_persist_s=0):
+  ''' write the rjm configuration file and the SSH key of the client '''
+  for d in [os.path.join(home, '.remote_jobs'), os.path.join(home, '.ssh')]:
+    os.makedirs(d)
+  key = os.path.join(home, '.ssh', 'id_rsa')
+  paramiko.RSAKey.generate(2048).write_private_key_file(key)
+  lines = ['[CLUSTER]', 'scheduler=%s' % cluster.scheduler, 'remote_host=127.0.0.1', 'remote_user=bench', 'ssh_priv_key_file=%s' % key,
+           'ssh_fingerprint=none', 'default_project_code=bench00001', 'default_remote_directory=%s' % cluster.basedir]
+  lines.extend(['remote_%s=%s' % (name, os.path.join(cluster.bindir, name)) for name in sorted(os.listdir(cluster.bindir))])
+  lines.extend(['', '[FILE_TRANSFER]', 'uploads_file=rjm_uploads.txt', 'downloads_file=rjm_downloads.txt',
+                '', '[RETRY]', 'max_attempts=5', 'min_wait_s=0.5', 'max_wait_s=5',
+                '', '[SSH]', 'port=%s' % cluster.port, 'keepalive_s=30',
+                'control_persist_s=%s' % control_persist_s, ''])
+  with open(os.path.join(home, '.remote_jobs', 'config.ini'), 'w') as f:
+    f.write('\n'.join(lines))
+
+def run_phase(name, tool, toolargs, args, env, logdir, cluster, jobs):
+  ''' run an rjm tool and return the metrics of the phase '''
+  before = cluster.stats.snapshot()
+  cmd = [args.clientpython, os.path.join(BINDIR, tool)] + toolargs
+  print('%s: %s' % (name, ' '.join(cmd[1:])))
+  started = time.time()
+  with open(os.path.join(logdir, '%s.log' % name), 'w') as log:
+    rc = subprocess.call(cmd, env=env, cwd=os.path.join(args.workdir, 'jobs'), stdout=log, stderr=subprocess.STDOUT)
+  finished = time.time()
+  if rc != 0:
+    raise Exception('%s failed with exit code %s. see %s' % (tool, rc, os.path.join(logdir, '%s.log' % name)))
+  after = cluster.stats.snapshot()
+  delta = dict([(k, v - before['counters'].get(k, 0)) for k, v in after['counters'].items()])
+  commands = dict([(k, v - before['commands'].get(k, 0)) for k, v in after['commands'].items() if v - before['commands'].get(k, 0)])
+  wall = finished - started
+  transferred = delta.get('bytes_up', 0) + delta.get('bytes_down', 0)
+  return {
+    'started': started,
+    'wall_s': wall,
+    'jobs_per_s': jobs / wall if wall > 0 else None,
+    'connections': delta.get('connections', 0),
+    'commands': commands,
+    'sftp_requests': delta.get('sftp_requests', 0),
+    'round_trips_per_job': (delta.get('commands', 0) + delta.get('sftp_requests', 0)) / float(jobs),
+    'bytes_up': delta.get('bytes_up', 0),
+    'bytes_down': delta.get('bytes_down', 0),
+    'bytes_per_s': transferred / wall if wall > 0 else None,
+  }
+
+def detection_latencies(cluster, since):
+  ''' time from the end of each job script, or since, whichever is later, to the first access of its job directory '''
+  return [cluster.stats.first_access[jobdir] - max(finished, since) for jobdir, finished in cluster.get_finished().items()
+          if jobdir in cluster.stats.first_access]
+
+def run(args):
+  scenario = dict(SCENARIOS[args.scenario])
+  for key in ['jobs', 'inputs', 'input_size', 'outputs', 'output_size']:
+    if getattr(args, key) is not None:
+      scenario[key] = getattr(args, key)
+  jobs = scenario['jobs']
+
+  cluster = fakecluster.FakeCluster(args.workdir, args.serverpython, args.latency_ms / 1000.0, args.bandwidth * 1024 * 1024,
+                                    args.queue_s, args.runtime_s, args.slots, args.scheduler)
+  cluster.install()
+  cluster.start()
+  home = os.path.join(args.workdir, 'home')
+  logdir = os.path.join(args.workdir, 'logs')
+  os.makedirs(logdir)
+  write_client_config(home, cluster, args.control_persist_s)
+  print('creating %s local job directories...' % jobs)
+  localdirfile = create_jobs(os.path.join(args.workdir, 'jobs'), jobs, scenario['inputs'], scenario['input_size'], scenario['outputs'])
+  env = dict(os.environ, HOME=home, PYTHONPATH=os.path.join(ROOT, 'client', 'lib'), RJM_NO_DAEMON='1')
+  cmd = ' ; '.join(['truncate -s %s output_%s.dat' % (scenario['output_size'], n) for n in range(scenario['outputs'])] +
+                   ['cat input_*.dat > /dev/null'])
+  if args.scheduler == 'local':
+    # the jobs run for real
+    cmd = 'sleep %s ; %s' % (args.runtime_s, cmd)
+
+  results = { 'scenario': args.scenario, 'parameters': dict(scenario, latency_ms=args.latency_ms, bandwidth_mb_s=args.bandwidth,
+    runtime_s=args.runtime_s, queue_s=args.queue_s, slots=args.slots, scheduler=args.scheduler, submit_args=args.submit_args, wait_args=args.wait_args,
+    clean_args=args.clean_args, control_persist_s=args.control_persist_s) }
+  try:
+    results['submit'] = run_phase('submit', 'rjm_batch_submit.py', ['-f', localdirfile, '-c', cmd, '-m', '1G', '-w', '1:0:0',
+      '-j', 'serial'] + shlex.split(args.submit_args), args, env, logdir, cluster, jobs)
+    results['wait'] = run_phase('wait', 'rjm_batch_wait.py', ['-f', localdirfile] + shlex.split(args.wait_args),
+      args, env, logdir, cluster, jobs)
+    latencies = detection_latencies(cluster, results['wait']['started'])
+    results['wait'].update(detected=len(latencies), detect_p50_s=percentile(latencies, 50), detect_p95_s=percentile(latencies, 95),
+                           detect_max_s=percentile(latencies, 100))
+    results['clean'] = run_phase('clean', 'rjm_batch_clean.py', ['-f', localdirfile] + shlex.split(args.clean_args),
+      args, env, logdir, cluster, jobs)
+  finally:
+    cluster.stop()
+  return results
+
+def report(results):
+  print('')
+  print('%-8s %10s %10s %12s %12s %12s %14s' % ('phase', 'wall [s]', 'jobs/s', 'commands', 'sftp req.', 'round trips/job', 'MB/s'))
+  for phase in ['submit', 'wait', 'clean']:
+    r = results[phase]
+    print('%-8s %10.2f %10.1f %12s %12s %15.2f %14.2f' % (phase, r['wall_s'], r['jobs_per_s'], sum(r['commands'].values()),
+      r['sftp_requests'], r['round_trips_per_job'], (r['bytes_per_s'] or 0) / 1024.0 / 1024.0))
+  for phase in ['submit', 'wait', 'clean']:
+    print('%s remote commands: %s' % (phase, ', '.join(['%s=%s' % item for item in sorted(results[phase]['commands'].items())])))
+  w = results['wait']
+  if w['detected']:
+    print('time to detect finished jobs: p50 %.2f s, p95 %.2f s, max %.2f s (%s jobs)' %
+      (w['detect_p50_s'], w['detect_p95_s'], w['detect_max_s'], w['detected']))
+
+def get_metric(results, metric):
+  phase, name = metric.split('.', 1)
+  return results.get(phase, {}).get(name)
+
+def compare(results, baseline, tolerance):
+  ''' print the change of each metric relative to the baseline. return the metrics that are worse than tolerated '''
+  regressions = []
+  print('')
+  print('%-28s %12s %12s %9s' % ('metric', 'baseline', 'current', 'change'))
+  for metric, higher_is_better in sorted(METRICS.items()):
+    old, new = get_metric(baseline, metric), get_metric(results, metric)
+    if old is None or new is None:
+      continue
+    change = (new - old) / float(old) if old else 0.0
+    worse = -change if higher_is_better else change
+    flag = ''
+    if worse > tolerance:
+      regressions.append(metric)
+      flag = ' REGRESSION'
+    print('%-28s %12.3f %12.3f %+8.1f%%%s' % (metric, old, new, change * 100, flag))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the rjm batch tools against a fake cluster on localhost.')
+  parser.add_argument('-s','--scenario', help=h['scenario'], required=False, choices=sorted(SCENARIOS), default='smoke')
+  parser.add_argument('-j','--jobs', help=h['jobs'], required=False, type=int)
+  parser.add_argument('--inputs', help=h['inputs'], required=False, type=int)
+  parser.add_argument('--input-size', dest='input_size', help=h['inputsize'], required=False, type=int)
+  parser.add_argument('--outputs', help=h['outputs'], required=False, type=int)
+  parser.add_argument('--output-size', dest='output_size', help=h['outputsize'], required=False, type=int)
+  parser.add_argument('--latency-ms', dest='latency_ms', help=h['latency'], required=False, type=float, default=0)
+  parser.add_argument('--bandwidth', help=h['bandwidth'], required=False, type=float, default=0)
+  parser.add_argument('--runtime-s', dest='runtime_s', help=h['runtime'], required=False, type=float, default=1)
+  parser.add_argument('--queue-s', dest='queue_s', help=h['queue'], required=False, type=float, default=0.5)
+  parser.add_argument('--slots', help=h['slots'], required=False, type=int, default=8)
+  parser.add_argument('--scheduler', help=h['scheduler'], required=False, choices=['slurm', 'local'], default='slurm')
+  parser.add_argument('--submit-args', dest='submit_args', help=h['submitargs'], required=False, type=str, default='')
+  parser.add_argument('--wait-args', dest='wait_args', help=h['waitargs'], required=False, type=str, default='-z 1')
+  parser.add_argument('--clean-args', dest='clean_args', help=h['cleanargs'], required=False, type=str, default='')
+  parser.add_argument('--control-persist-s', dest='control_persist_s', help=h['controlpersist'], required=False, type=int, default=0)
+  parser.add_argument('--client-python', dest='clientpython', help=h['clientpython'], required=False, type=str, default=sys.executable)
+  parser.add_argument('--server-python', dest='serverpython', help=h['serverpython'], required=False, type=str, default='python2')
+  parser.add_argument('-w','--workdir', help=h['workdir'], required=False, type=str)
+  parser.add_argument('--json', help=h['json'], required=False, type=str)
+  parser.add_argument('--baseline', help=h['baseline'], required=False, type=str)
+  parser.add_argument('--tolerance', help=h['tolerance'], required=False, type=float, default=0.2)
+  args = parser.parse_args()
+
+  temporary = args.workdir is None
+  args.workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='rjm-benchmark-'))
+  try:
+    results = run(args)
+  finally:
+    if temporary:
+      shutil.rmtree(args.workdir, ignore_errors=True)
+  report(results)
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+  if args.baseline:
+    with open(args.baseline) as f:
+      if compare(results, json.load(f), args.tolerance):
+        sys.exit(1)
+
+if __name__ == '__main__':
+  main()
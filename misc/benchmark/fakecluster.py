@@ -0,0 +1,423 @@
+'''
+A fake cluster on localhost, for benchmarking the rjm tools without a real cluster.
+
+The fake cluster consists of
+  - an SSH and SFTP server, based on paramiko, that runs remote commands with bash on the local machine.
+    The network between rjm and the cluster is simulated: each remote command and each SFTP request other than
+    reading or writing data is delayed by latency_s, and the data of remote commands and SFTP transfers is
+    limited to bandwidth bytes per second in each direction.
+  - the remote commands for slurm, installed with server/install into one directory as on a cluster, with stand-ins for sbatch, squeue, sacct and scancel
+    (see scheduler.py) on the PATH of the remote commands.
+  - a job executor that starts pending jobs after queue_s seconds, and runs their job scripts once runtime_s
+    seconds have passed, up to slots job scripts at the same time.
+With scheduler local, the remote commands for local are installed instead, and the jobs run in the
+process pool of server/bin/local/executor, up to slots at the same time, as soon as they are submitted.
+The server counts remote commands, SFTP requests and bytes transferred, and records when each job has finished
+and when its job directory has first been accessed afterwards, see Stats.
+'''
+import os
+import sys
+import time
+import sqlite3
+import logging
+import socket
+import threading
+import subprocess
+import paramiko
+from paramiko import SFTPServer, SFTPServerInterface, SFTPAttributes, SFTPHandle, SFTP_OK
+
+import scheduler
+
+BUFSIZE = 32768
+
+# clients that disconnect without closing their channels are expected, don't report them
+logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+class Throttle(object):
+  ''' limit the rate of data passing through to bytes_per_s. no limit if bytes_per_s is 0 '''
+  def __init__(self, bytes_per_s):
+    self.bytes_per_s = float(bytes_per_s)
+    self.lock = threading.Lock()
+    self.available = time.time()
+
+  def consume(self, nbytes):
+    if self.bytes_per_s <= 0:
+      return
+    with self.lock:
+      now = time.time()
+      start = max(now, self.available)
+      self.available = start + nbytes / self.bytes_per_s
+      delay = self.available - now
+    if delay > 0:
+      time.sleep(delay)
+
+
+class Stats(object):
+  ''' counters of the fake cluster. snapshot() returns a copy that can be compared with a later one '''
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.commands = {}
+    self.first_access = {}
+
+  def add(self, name, value=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def command(self, command):
+    ''' count a remote command, by the name of the program it runs '''
+    name = os.path.basename(command.strip().split(' ', 1)[0].strip('"\'')) if command.strip() else ''
+    with self.lock:
+      self.counters['commands'] = self.counters.get('commands', 0) + 1
+      self.commands[name] = self.commands.get(name, 0) + 1
+
+  def access(self, jobdir):
+    ''' record the first access of a job directory '''
+    if jobdir not in self.first_access:
+      with self.lock:
+        self.first_access.setdefault(jobdir, time.time())
+
+  def snapshot(self):
+    with self.lock:
+      return { 'counters': dict(self.counters), 'commands': dict(self.commands) }
+
+
+class FakeCluster(object):
+  '''
+    The fake cluster, with its SSH server listening on localhost. The remote commands run with home as their home
+    directory, and the remote commands for scheduler are installed with server/install into serverdir, and run
+    through wrappers in bindir with the python interpreter of the cluster.
+  '''
+  def __init__(self, workdir, server_python, latency_s=0, bandwidth=0, queue_s=0.5, runtime_s=1, slots=8, scheduler='slurm'):
+    self.workdir = workdir
+    self.scheduler = scheduler
+    self.home = os.path.join(workdir, 'cluster')
+    self.serverdir = os.path.join(self.home, 'rjm', 'server')
+    self.bindir = os.path.join(self.home, 'rjm', 'bin')
+    self.slurmdir = os.path.join(self.home, 'slurm', 'bin')
+    self.basedir = os.path.join(self.home, 'jobs')
+    self.state = os.path.join(self.home, 'slurm', 'state.db')
+    self.server_python = server_python
+    self.latency_s = latency_s
+    self.upload = Throttle(bandwidth)
+    self.download = Throttle(bandwidth)
+    self.queue_s = queue_s
+    self.runtime_s = runtime_s
+    self.slots = threading.Semaphore(slots)
+    self.stats = Stats()
+    # job directory -> time its job script has finished
+    self.finished = {}
+    self.host_key = paramiko.RSAKey.generate(2048)
+    self.sock = None
+    self.port = None
+    self.stopped = threading.Event()
+    self.env = dict(os.environ, HOME=self.home, PATH='%s%s%s' % (self.slurmdir, os.pathsep, os.environ.get('PATH', '')),
+                    RJM_LOCAL_SLOTS=str(slots))
+
+  def install(self):
+    ''' create the directories of the cluster, and install the remote commands and the scheduler commands '''
+    for d in [self.bindir, self.slurmdir, self.basedir]:
+      if not os.path.isdir(d):
+        os.makedirs(d)
+    installer = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'server', 'install')
+    subprocess.check_call([installer, self.scheduler, self.serverdir])
+    for name in os.listdir(self.serverdir):
+      script = os.path.join(self.serverdir, name)
+      with open(script) as f:
+        interpreter = self.server_python if 'python' in f.readline() else 'bash'
+      self.__write_wrapper(os.path.join(self.bindir, name), 'exec "%s" "%s" "$@"' % (interpreter, script))
+    if self.scheduler != 'slurm':
+      return
+    for name in scheduler.COMMANDS:
+      self.__write_wrapper(os.path.join(self.slurmdir, name), 'exec "%s" "%s" --state "%s" %s "$@"' %
+        (sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scheduler.py'), self.state, name))
+    scheduler.connect(self.state).close()
+
+  def __write_wrapper(self, path, command):
+    with open(path, 'w') as f:
+      f.write('#!/bin/sh\n%s\n' % command)
+    os.chmod(path, 0o755)
+
+  def start(self):
+    ''' start the SSH server on a free port of localhost, and the job executor '''
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.sock.bind(('127.0.0.1', 0))
+    self.sock.listen(100)
+    self.port = self.sock.getsockname()[1]
+    for target in [self.__accept] + ([self.__execute] if self.scheduler == 'slurm' else []):
+      t = threading.Thread(target=target)
+      t.daemon = True
+      t.start()
+
+  def stop(self):
+    self.stopped.set()
+    if self.sock:
+      self.sock.close()
+
+  def delay(self):
+    ''' simulate the round trip of a request '''
+    if self.latency_s > 0:
+      time.sleep(self.latency_s)
+
+  def __accept(self):
+    while not self.stopped.is_set():
+      try:
+        client, address = self.sock.accept()
+      except socket.error:
+        return
+      self.stats.add('connections')
+      transport = paramiko.Transport(client)
+      transport.add_server_key(self.host_key)
+      transport.set_subsystem_handler('sftp', SFTPServer, FakeSFTPServer, self)
+      try:
+        transport.start_server(server=FakeSSHServer(self))
+      except Exception:
+        transport.close()
+
+  def run_command(self, channel, command):
+    ''' run a remote command, and relay stdin, stdout, stderr and the exit status '''
+    self.delay()
+    p = subprocess.Popen(['bash', '-c', command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, cwd=self.home, env=self.env)
+
+    def relay_stdin():
+      try:
+        while True:
+          data = channel.recv(BUFSIZE)
+          if not data:
+            break
+          self.upload.consume(len(data))
+          self.stats.add('bytes_up', len(data))
+          p.stdin.write(data)
+          p.stdin.flush()
+      except (IOError, OSError, socket.error):
+        pass
+      finally:
+        try:
+          p.stdin.close()
+        except (IOError, OSError):
+          pass
+
+    def relay_output(stream, send):
+      while True:
+        data = os.read(stream.fileno(), BUFSIZE)
+        if not data:
+          break
+        self.download.consume(len(data))
+        self.stats.add('bytes_down', len(data))
+        send(data)
+
+    threads = [threading.Thread(target=relay_stdin),
+               threading.Thread(target=relay_output, args=(p.stdout, channel.sendall)),
+               threading.Thread(target=relay_output, args=(p.stderr, channel.sendall_stderr))]
+    for t in threads:
+      t.daemon = True
+      t.start()
+    threads[1].join()
+    threads[2].join()
+    channel.send_exit_status(p.wait())
+    channel.shutdown_write()
+    channel.close()
+
+  def get_finished(self):
+    ''' get the time each job script has finished, by job directory '''
+    if self.scheduler == 'slurm':
+      return dict(self.finished)
+    finished = {}
+    db = sqlite3.connect(os.path.join(self.home, '.rjm', 'local', 'jobs.db'), timeout=60)
+    try:
+      rows = db.execute('SELECT workdir, array_index, finished FROM jobs WHERE finished IS NOT NULL').fetchall()
+    finally:
+      db.close()
+    for workdir, array_index, t in rows:
+      # the job directory of an array task is the directory the job script changes to
+      if array_index is not None:
+        with open(os.path.join(workdir, '.array.dirs.txt')) as f:
+          workdir = f.read().splitlines()[array_index]
+      finished[os.path.abspath(workdir)] = t
+      finished.update(self.__get_finished_tasks(workdir))
+    return finished
+
+  def __get_finished_tasks(self, workdir):
+    ''' get the time each task of a task farm described in workdir has finished, by job directory '''
+    finished = {}
+    if not os.path.exists(os.path.join(workdir, '.pack.dirs.txt')):
+      return finished
+    with open(os.path.join(workdir, '.pack.dirs.txt')) as f:
+      for jobdir in f.read().splitlines():
+        marker = os.path.join(jobdir, '.rjm_done')
+        if os.path.exists(marker):
+          finished[os.path.abspath(jobdir)] = os.path.getmtime(marker)
+    return finished
+
+  def access(self, path):
+    ''' record the first access of a file in a job directory after its job has finished '''
+    jobdir = os.path.dirname(os.path.abspath(path))
+    # the tasks of a task farm finish one by one, while the task farm is running
+    if jobdir in self.finished or (jobdir not in self.stats.first_access and os.path.exists(os.path.join(jobdir, '.rjm_done'))):
+      self.stats.access(jobdir)
+
+  def __execute(self):
+    ''' start pending jobs and run the job scripts of jobs whose runtime has passed '''
+    db = scheduler.connect(self.state)
+    running = set()
+    while not self.stopped.is_set():
+      now = time.time()
+      db.execute("UPDATE jobs SET state = 'RUNNING', started = ? WHERE state = 'PENDING' AND submitted <= ?", [now, now - self.queue_s])
+      due = db.execute("SELECT id, script, workdir, output, error, array_id, array_index, args FROM jobs WHERE state = 'RUNNING' AND started <= ?",
+                       [now - self.runtime_s]).fetchall()
+      for job in due:
+        if job[0] not in running:
+          running.add(job[0])
+          self.slots.acquire()
+          t = threading.Thread(target=self.__run_job, args=job)
+          t.daemon = True
+          t.start()
+      time.sleep(0.1)
+
+  def __run_job(self, jobid, script, workdir, output, error, array_id, array_index, script_args):
+    try:
+      env = dict(self.env, SLURM_JOB_ID=array_id or jobid,
+                 SLURM_CPUS_PER_TASK=scheduler.read_directives(script).get('cpus-per-task', '1'))
+      if array_id:
+        env.update(SLURM_ARRAY_JOB_ID=array_id, SLURM_ARRAY_TASK_ID=str(array_index))
+      with open(os.path.join(workdir, output or 'slurm-%s.out' % jobid), 'ab') as stdout:
+        with open(os.path.join(workdir, error or 'slurm-%s.out' % jobid), 'ab') as stderr:
+          rc = subprocess.call(['bash', script] + (script_args or '').split(), cwd=workdir, env=env, stdout=stdout, stderr=stderr)
+      db = scheduler.connect(self.state)
+      try:
+        db.execute("UPDATE jobs SET state = ?, exit_code = ?, finished = ? WHERE id = ? AND state = 'RUNNING'",
+                   ['COMPLETED' if rc == 0 else 'FAILED', rc, time.time(), jobid])
+      finally:
+        db.close()
+      # the job directory of an array task is the directory the job script changes to
+      jobdir = workdir
+      if array_id:
+        with open(os.path.join(workdir, '.array.dirs.txt')) as f:
+          jobdir = f.read().splitlines()[array_index]
+      self.finished[os.path.abspath(jobdir)] = time.time()
+      self.finished.update(self.__get_finished_tasks(workdir))
+      self.stats.add('jobs_finished')
+    finally:
+      self.slots.release()
+
+
+class FakeSSHServer(paramiko.ServerInterface):
+  ''' accept any user and key, and run remote commands in a thread of their own '''
+  def __init__(self, cluster):
+    self.cluster = cluster
+
+  def get_allowed_auths(self, username):
+    return 'publickey,password'
+
+  def check_auth_publickey(self, username, key):
+    return paramiko.AUTH_SUCCESSFUL
+
+  def check_auth_password(self, username, password):
+    return paramiko.AUTH_SUCCESSFUL
+
+  def check_channel_request(self, kind, chanid):
+    self.cluster.stats.add('channels')
+    return paramiko.OPEN_SUCCEEDED
+
+  def check_channel_exec_request(self, channel, command):
+    if isinstance(command, bytes):
+      command = command.decode('utf-8')
+    self.cluster.stats.command(command)
+    t = threading.Thread(target=self.cluster.run_command, args=(channel, command))
+    t.daemon = True
+    t.start()
+    return True
+
+
+class FakeSFTPHandle(SFTPHandle):
+  def __init__(self, cluster, f, flags):
+    SFTPHandle.__init__(self, flags)
+    self.cluster = cluster
+    self.readfile = self.writefile = f
+
+  def read(self, offset, length):
+    data = SFTPHandle.read(self, offset, length)
+    if isinstance(data, bytes):
+      self.cluster.download.consume(len(data))
+      self.cluster.stats.add('bytes_down', len(data))
+    return data
+
+  def write(self, offset, data):
+    self.cluster.upload.consume(len(data))
+    self.cluster.stats.add('bytes_up', len(data))
+    return SFTPHandle.write(self, offset, data)
+
+  def stat(self):
+    return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+  def chattr(self, attr):
+    return SFTP_OK
+
+
+class FakeSFTPServer(SFTPServerInterface):
+  ''' SFTP access to the local file system, with every request other than reading and writing data delayed '''
+  def __init__(self, server, cluster, *args, **kwargs):
+    SFTPServerInterface.__init__(self, server, *args, **kwargs)
+    self.cluster = cluster
+
+  def __request(self, name, path, f):
+    self.cluster.delay()
+    self.cluster.stats.add('sftp_requests')
+    self.cluster.access(path)
+    try:
+      return f()
+    except OSError as e:
+      return SFTPServer.convert_errno(e.errno)
+
+  def open(self, path, flags, attr):
+    def f():
+      fd = os.open(path, flags, 0o644)
+      mode = 'rb'
+      if flags & os.O_WRONLY:
+        mode = 'ab' if flags & os.O_APPEND else 'wb'
+      elif flags & os.O_RDWR:
+        mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+      return FakeSFTPHandle(self.cluster, os.fdopen(fd, mode), flags)
+    return self.__request('open', path, f)
+
+  def list_folder(self, path):
+    def f():
+      entries = []
+      for name in os.listdir(path):
+        attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+        attr.filename = name
+        entries.append(attr)
+      return entries
+    return self.__request('list_folder', path, f)
+
+  def stat(self, path):
+    return self.__request('stat', path, lambda: SFTPAttributes.from_stat(os.stat(path)))
+
+  def lstat(self, path):
+    return self.__request('lstat', path, lambda: SFTPAttributes.from_stat(os.lstat(path)))
+
+  def remove(self, path):
+    return self.__request('remove', path, lambda: os.remove(path) or SFTP_OK)
+
+  def rename(self, oldpath, newpath):
+    return self.__request('rename', newpath, lambda: os.rename(oldpath, newpath) or SFTP_OK)
+
+  def posix_rename(self, oldpath, newpath):
+    return self.rename(oldpath, newpath)
+
+  def mkdir(self, path, attr):
+    return self.__request('mkdir', path, lambda: os.mkdir(path) or SFTP_OK)
+
+  def rmdir(self, path):
+    return self.__request('rmdir', path, lambda: os.rmdir(path) or SFTP_OK)
+
+  def chattr(self, path, attr):
+    return self.__request('chattr', path, lambda: SFTP_OK)
+
+  def symlink(self, target_path, path):
+    return self.__request('symlink', path, lambda: os.symlink(target_path, path) or SFTP_OK)
+
+  def readlink(self, path):
+    return self.__request('readlink', path, lambda: os.readlink(path))
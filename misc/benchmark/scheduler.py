@@ -0,0 +1,187 @@
+'''
+Stand-in for the Slurm commands sbatch, squeue, sacct and scancel, for the fake cluster of the benchmark.
+
+The state of the jobs is kept in an sqlite database, which is shared with the job executor of the fake cluster
+(see fakecluster.py). sbatch only records a job as pending. The executor starts it, and runs its job script once
+its runtime has passed. Only the options used by the remote commands for slurm are supported.
+
+Usage: scheduler.py --state <database> {sbatch,squeue,sacct,scancel} [options of the command]
+'''
+import os
+import re
+import sys
+import time
+import sqlite3
+
+SCHEMA = [
+  '''CREATE TABLE IF NOT EXISTS jobs (
+       id TEXT PRIMARY KEY,
+       array_id TEXT,
+       name TEXT,
+       script TEXT,
+       workdir TEXT,
+       output TEXT,
+       error TEXT,
+       array_index INTEGER,
+       state TEXT,
+       exit_code INTEGER,
+       submitted REAL,
+       started REAL,
+       finished REAL,
+       args TEXT
+     )''',
+  'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)',
+  'CREATE TABLE IF NOT EXISTS counter (next_id INTEGER)',
+]
+
+# states of jobs that are in the queue
+QUEUED_STATES = ['PENDING', 'RUNNING', 'COMPLETING']
+
+def connect(filename):
+  ''' open the state database, and create it if it doesn't exist '''
+  db = sqlite3.connect(filename, timeout=60, isolation_level=None)
+  db.execute('PRAGMA journal_mode=WAL')
+  for statement in SCHEMA:
+    db.execute(statement)
+  return db
+
+def read_directives(script):
+  ''' read the #SBATCH options of a job script '''
+  directives = {}
+  with open(script) as f:
+    for line in f:
+      m = re.match(r'^#SBATCH\s+--([\w-]+)=(.*)$', line.strip())
+      if m:
+        directives[m.group(1)] = m.group(2).strip()
+  return directives
+
+def expand_indices(indices):
+  ''' expand array indices, e.g. 0-9,12 or 1-100%10 '''
+  expanded = []
+  for r in indices.split('%')[0].split(','):
+    first, _, last = r.partition('-')
+    expanded.extend(range(int(first), int(last or first) + 1))
+  return expanded
+
+def sbatch(db, argv):
+  # the options come before the job script, and the arguments of the job script after it
+  scripts = [i for i, a in enumerate(argv) if not a.startswith('-')]
+  if scripts:
+    argv, script_args = argv[:scripts[0] + 1], argv[scripts[0] + 1:]
+  options = dict([a[2:].split('=', 1) for a in argv if a.startswith('--') and '=' in a])
+  if not scripts or not os.path.isfile(argv[-1]):
+    sys.stderr.write('sbatch: error: Unable to open file %s\n' % (argv[-1] if scripts else ''))
+    return 1
+  script = os.path.abspath(argv[-1])
+  directives = read_directives(script)
+  directives.update(options)
+  workdir = directives.get('workdir', directives.get('chdir', os.getcwd()))
+  name = directives.get('job-name', os.path.basename(script))
+  now = time.time()
+  db.execute('BEGIN IMMEDIATE')
+  try:
+    row = db.execute('SELECT next_id FROM counter').fetchone()
+    jobid = row[0] if row else 1000
+    db.execute('DELETE FROM counter')
+    db.execute('INSERT INTO counter VALUES (?)', [jobid + 1])
+    if 'array' in directives:
+      for index in expand_indices(directives['array']):
+        db.execute('INSERT INTO jobs VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)', ['%s_%s' % (jobid, index), str(jobid), name,
+          script, workdir, directives.get('output'), directives.get('error'), index, 'PENDING', None, now, None, None, ' '.join(script_args)])
+    else:
+      db.execute('INSERT INTO jobs VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)', [str(jobid), None, name, script, workdir,
+        directives.get('output'), directives.get('error'), None, 'PENDING', None, now, None, None, ' '.join(script_args)])
+    db.execute('COMMIT')
+  except:
+    db.execute('ROLLBACK')
+    raise
+  print('Submitted batch job %s' % jobid)
+  return 0
+
+def format_elapsed(started, finished):
+  if not started:
+    return '0:00'
+  s = int((finished or time.time()) - started)
+  return '%d:%02d:%02d' % (s // 3600, (s // 60) % 60, s % 60) if s >= 3600 else '%d:%02d' % (s // 60, s % 60)
+
+def squeue(db, argv):
+  fmt = None
+  jobids = None
+  i = 0
+  while i < len(argv):
+    a = argv[i]
+    if a in ['-o', '--format', '-j', '--job', '--jobs', '-u', '--user']:
+      value = argv[i + 1]
+      i += 1
+    elif '=' in a:
+      a, value = a.split('=', 1)
+    else:
+      value = None
+    if a in ['-o', '--format']:
+      fmt = value
+    elif a in ['-j', '--job', '--jobs']:
+      jobids = set(value.split(','))
+    i += 1
+  rows = db.execute('SELECT id, array_id, name, state, started, finished FROM jobs WHERE state IN (%s) ORDER BY submitted' %
+    ','.join(['?'] * len(QUEUED_STATES)), QUEUED_STATES).fetchall()
+  if jobids is not None:
+    rows = [r for r in rows if r[0] in jobids or r[1] in jobids]
+    if not rows and not [j for j in jobids if db.execute('SELECT 1 FROM jobs WHERE id = ? OR array_id = ?', [j, j]).fetchone()]:
+      sys.stderr.write('slurm_load_jobs error: Invalid job id specified\n')
+      return 1
+  if fmt is None:
+    print('             JOBID PARTITION     NAME     USER ST       TIME  NODES NODELIST(REASON)')
+  for jobid, array_id, name, state, started, finished in rows:
+    fields = { 'i': jobid, 'A': array_id or jobid, 'j': name, 'T': state, 'M': format_elapsed(started, finished),
+               'r': 'None' if state == 'RUNNING' else 'Priority', 'N': 'node001' if state == 'RUNNING' else '' }
+    if fmt is None:
+      print('%18s %9s %8s %8s %2s %10s %6s %s' % (jobid, 'compute', name[:8], 'bench', 'R' if state == 'RUNNING' else 'PD',
+        fields['M'], 1, fields['N'] or '(Priority)'))
+    else:
+      print(re.sub(r'%(\w)', lambda m: fields.get(m.group(1), ''), fmt))
+  return 0
+
+def sacct(db, argv):
+  jobids = []
+  for i, a in enumerate(argv):
+    if a in ['-j', '--jobs']:
+      jobids = argv[i + 1].split(',')
+    elif a.startswith('--jobs='):
+      jobids = a[len('--jobs='):].split(',')
+  for jobid in jobids:
+    row = db.execute('SELECT state, exit_code, started, finished FROM jobs WHERE id = ?', [jobid]).fetchone()
+    if row:
+      state, exit_code, started, finished = row
+      print('%s|%s|%s:0|%s|%s' % (jobid, state, exit_code or 0, format_elapsed(started, finished), 'node001' if started else ''))
+  return 0
+
+def scancel(db, argv):
+  rc = 0
+  for jobid in [a for a in argv if not a.startswith('-')]:
+    rows = db.execute('SELECT id, state FROM jobs WHERE id = ? OR array_id = ?', [jobid, jobid]).fetchall()
+    if not rows:
+      sys.stderr.write('scancel: error: Kill job error on job id %s: Invalid job id specified\n' % jobid)
+      rc = 1
+      continue
+    queued = [r[0] for r in rows if r[1] in QUEUED_STATES]
+    if not queued:
+      sys.stderr.write('scancel: error: Kill job error on job id %s: Job/step already completing or completed\n' % jobid)
+      rc = 1
+    for j in queued:
+      db.execute("UPDATE jobs SET state = 'CANCELLED', finished = ? WHERE id = ? AND state IN ('PENDING', 'RUNNING')", [time.time(), j])
+  return rc
+
+COMMANDS = { 'sbatch': sbatch, 'squeue': squeue, 'sacct': sacct, 'scancel': scancel }
+
+def main(argv):
+  if len(argv) < 3 or argv[0] != '--state' or argv[2] not in COMMANDS:
+    sys.stderr.write('Usage: scheduler.py --state <database> {%s} [options]\n' % ','.join(sorted(COMMANDS)))
+    return 2
+  db = connect(argv[1])
+  try:
+    return COMMANDS[argv[2]](db, argv[3:])
+  finally:
+    db.close()
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,145 @@
+'''
+Benchmark of the startup time of the rjm tools: the time from starting a new process until it has imported what it
+needs and parsed its arguments, measured with --help, and the time to import the client modules.
+
+Each case runs in a new process repeatedly, and the median wall time is reported, as well as the time over the
+startup of the python interpreter alone. The tools run with a configuration in a temporary home directory, and
+without rjmd (cold) or, with --daemon, through a running rjmd (warm).
+
+Example: check that startup hasn't become slower than in an earlier run
+  python startup.py --json startup.json
+  python startup.py --baseline startup.json
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+BINDIR = os.path.join(ROOT, 'client', 'bin')
+
+# rjm tools whose startup is measured with --help
+SCRIPTS = ['rjm_batch_submit.py', 'rjm_batch_wait.py', 'rjm_batch_cancel.py', 'rjm_batch_clean.py', 'rjmd.py']
+# client modules whose import time is measured
+MODULES = ['cer.client.util', 'cer.client.ssh', 'cer.client.job', 'cer.client.job.store', 'cer.client.transfer']
+
+h = {
+  'clientpython': 'python interpreter that runs the rjm tools. default: %s' % sys.executable,
+  'repeat': 'number of times each case runs. default: 10',
+  'daemon': 'also measure the startup of the rjm tools through a running rjmd.',
+  'json': 'write the results to this file as JSON.',
+  'baseline': 'compare the results with the results of an earlier run, written with --json. ' +
+    'exit with code 1 if a case is slower than in the baseline by more than the tolerance.',
+  'tolerance': 'relative slowdown of a case that is tolerated when comparing with a baseline. default: 0.25',
+  'maxms': 'exit with code 1 if the median startup time of an rjm tool over the interpreter startup is above this ' +
+    'number of milliseconds.',
+}
+
+def write_config(home):
+  ''' write a configuration that is complete enough for the rjm tools to start '''
+  confdir = os.path.join(home, '.remote_jobs')
+  os.makedirs(confdir)
+  with open(os.path.join(confdir, 'config.ini'), 'w') as f:
+    f.write('\n'.join(['[CLUSTER]', 'remote_host=127.0.0.1', 'remote_user=bench', 'ssh_priv_key_file=%s' % os.path.join(confdir, 'key'),
+      'ssh_fingerprint=none', 'default_project_code=bench00001', 'default_remote_directory=/tmp',
+      'remote_prepare_job=/bin/prepare_job', 'remote_submit_job=/bin/submit_job', 'remote_is_job_done=/bin/is_job_done',
+      'remote_get_job_statuses=/bin/get_job_statuses', 'remote_cancel_jobs=/bin/cancel_jobs',
+      '', '[FILE_TRANSFER]', 'uploads_file=rjm_uploads.txt', 'downloads_file=rjm_downloads.txt',
+      '', '[RETRY]', 'max_attempts=1', 'min_wait_s=0', 'max_wait_s=0', '']))
+
+def measure(cmd, env, repeat):
+  ''' run a command repeatedly, and return the median wall time in seconds '''
+  times = []
+  with open(os.devnull, 'w') as devnull:
+    for i in range(repeat):
+      started = time.time()
+      rc = subprocess.call(cmd, env=env, stdout=devnull, stderr=devnull)
+      times.append(time.time() - started)
+      if rc != 0:
+        raise Exception('%s failed with exit code %s' % (' '.join(cmd), rc))
+  return sorted(times)[len(times) // 2]
+
+def run(args, home):
+  env = dict(os.environ, HOME=home, PYTHONPATH=os.path.join(ROOT, 'client', 'lib'), RJM_NO_DAEMON='1')
+  python = [args.clientpython]
+  results = { 'interpreter_s': measure(python + ['-c', 'pass'], env, args.repeat), 'cases': {} }
+  cases = [('import %s' % module, python + ['-c', 'import %s' % module], env) for module in MODULES]
+  cases.extend([('%s --help' % script, python + [os.path.join(BINDIR, script), '--help'], env) for script in SCRIPTS])
+  if args.daemon:
+    warm = dict(env)
+    del warm['RJM_NO_DAEMON']
+    subprocess.check_call(python + [os.path.join(BINDIR, 'rjmd.py'), 'start'], env=warm)
+    cases.extend([('%s --help (rjmd)' % script, python + [os.path.join(BINDIR, script), '--help'], warm)
+                  for script in SCRIPTS if script != 'rjmd.py'])
+  try:
+    for name, cmd, case_env in cases:
+      t = measure(cmd, case_env, args.repeat)
+      results['cases'][name] = { 'wall_s': t, 'over_interpreter_s': max(0.0, t - results['interpreter_s']) }
+  finally:
+    if args.daemon:
+      subprocess.call(python + [os.path.join(BINDIR, 'rjmd.py'), 'stop'], env=warm)
+  return results
+
+def report(results):
+  print('python interpreter startup: %.1f ms' % (results['interpreter_s'] * 1000))
+  print('%-40s %12s %18s' % ('case', 'wall [ms]', 'over python [ms]'))
+  for name, r in sorted(results['cases'].items()):
+    print('%-40s %12.1f %18.1f' % (name, r['wall_s'] * 1000, r['over_interpreter_s'] * 1000))
+
+def compare(results, baseline, tolerance):
+  ''' print the change of each case relative to the baseline. return the cases that are slower than tolerated '''
+  regressions = []
+  print('')
+  print('%-40s %12s %12s %9s' % ('case', 'baseline', 'current', 'change'))
+  for name, r in sorted(results['cases'].items()):
+    if name not in baseline['cases']:
+      continue
+    old, new = baseline['cases'][name]['over_interpreter_s'], r['over_interpreter_s']
+    change = (new - old) / old if old else 0.0
+    flag = ''
+    if change > tolerance:
+      regressions.append(name)
+      flag = ' REGRESSION'
+    print('%-40s %12.1f %12.1f %+8.1f%%%s' % (name, old * 1000, new * 1000, change * 100, flag))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the startup time of the rjm tools.')
+  parser.add_argument('--client-python', dest='clientpython', help=h['clientpython'], required=False, type=str, default=sys.executable)
+  parser.add_argument('-r','--repeat', help=h['repeat'], required=False, type=int, default=10)
+  parser.add_argument('-d','--daemon', help=h['daemon'], required=False, action='store_true')
+  parser.add_argument('--json', help=h['json'], required=False, type=str)
+  parser.add_argument('--baseline', help=h['baseline'], required=False, type=str)
+  parser.add_argument('--tolerance', help=h['tolerance'], required=False, type=float, default=0.25)
+  parser.add_argument('--max-ms', dest='maxms', help=h['maxms'], required=False, type=float)
+  args = parser.parse_args()
+
+  home = tempfile.mkdtemp(prefix='rjm-startup-')
+  try:
+    write_config(home)
+    results = run(args, home)
+  finally:
+    shutil.rmtree(home, ignore_errors=True)
+  report(results)
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+  failed = []
+  if args.baseline:
+    with open(args.baseline) as f:
+      failed.extend(compare(results, json.load(f), args.tolerance))
+  if args.maxms is not None:
+    slow = [name for name, r in sorted(results['cases'].items())
+            if not name.startswith('import ') and r['over_interpreter_s'] * 1000 > args.maxms]
+    for name in slow:
+      print('%s takes longer than %s ms' % (name, args.maxms))
+    failed.extend(slow)
+  if failed:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()